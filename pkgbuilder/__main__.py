@@ -15,6 +15,7 @@ from . import DS, _, __version__
 from pkgbuilder.exceptions import NetworkError, PBException
 import pkgbuilder.aur
 import pkgbuilder.build
+import pkgbuilder.ccache
 import pkgbuilder.exceptions
 import pkgbuilder.transaction
 import pkgbuilder.utils
@@ -145,6 +146,55 @@ def main(source='AUTO', quit=True):
         argopt.add_argument(
             '--deep', action='store_true', dest='deepclone',
             help=_('use deep git clones'))
+        argopt.add_argument(
+            '--mirror', action='store_true', dest='mirror',
+            help=_('clone from local mirrors of AUR repositories'))
+        argopt.add_argument(
+            '--nomirror', action='store_true', dest='nomirror',
+            help=_('clone directly from the AUR (default)'))
+        argopt.add_argument(
+            '--snapshot', action='store_true', dest='snapshot',
+            help=_('download snapshot tarballs instead of cloning'))
+        argopt.add_argument(
+            '--nosnapshot', action='store_true', dest='nosnapshot',
+            help=_('clone git repositories (default)'))
+        argopt.add_argument(
+            '--prefetch', action='store_true', dest='prefetch',
+            help=_('retrieve the sources of all packages before building '
+                   '(default)'))
+        argopt.add_argument(
+            '--noprefetch', action='store_true', dest='noprefetch',
+            help=_('retrieve sources when building every package'))
+        argopt.add_argument(
+            '--tmpfs', action='store_true', dest='tmpfs',
+            help=_('build in memory (tmpfs) if there is enough space'))
+        argopt.add_argument(
+            '--notmpfs', action='store_true', dest='notmpfs',
+            help=_('build on disk (default)'))
+        argopt.add_argument(
+            '--compression', action='store', dest='compression',
+            choices=('default',) + tuple(
+                sorted(pkgbuilder.build.COMPRESSION_PROFILES)),
+            help=_('compression of packages that are installed right away'))
+        argopt.add_argument(
+            '--compiler-cache', action='store', dest='compilercache',
+            choices=pkgbuilder.ccache.TOOLS + ('none',),
+            help=_('compiler cache to use for builds'))
+
+        argopt.add_argument(
+            '-j', '--jobs', action='store', type=int, dest='jobs',
+            metavar=_('N'), help=_('build up to N packages at once'))
+        argopt.add_argument(
+            '--cores', action='store', type=int, dest='cores',
+            metavar=_('N'), help=_('use up to N CPU cores for all builds '
+                                   'together'))
+        argopt.add_argument(
+            '--fetch-jobs', action='store', type=int, dest='fetchjobs',
+            metavar=_('N'), help=_('fetch up to N repositories at once'))
+        argopt.add_argument(
+            '--lookahead', action='store', type=int, dest='lookahead',
+            metavar=_('N'), help=_('retrieve sources up to N packages ahead '
+                                   'of the current build'))
 
         argopt.add_argument(
             '--ignore', action='append', dest='ignorelist', metavar='PACKAGE',
@@ -187,8 +237,47 @@ def main(source='AUTO', quit=True):
                                     args.confirm, args.noconfirm)
         DS.deepclone = DS.get_setting('--deep', 'options', 'deepclone',
                                       args.deepclone, args.shallowclone)
+        DS.mirror = DS.get_setting('--mirror', 'options', 'mirror',
+                                   args.mirror, args.nomirror)
+        DS.mirrordir = DS.config.get('extras', 'mirrordir') or None
+        DS.snapshot = DS.get_setting('--snapshot', 'options', 'snapshot',
+                                     args.snapshot, args.nosnapshot)
+        DS.prefetch = DS.get_setting('--prefetch', 'options', 'prefetch',
+                                     args.prefetch, args.noprefetch)
+        DS.srcdest = DS.config.get('extras', 'srcdest') or None
+        DS.tmpfs = DS.get_setting('--tmpfs', 'options', 'tmpfs',
+                                  args.tmpfs, args.notmpfs)
+        DS.tmpfsdir = DS.config.get('extras', 'tmpfsdir') or None
+        DS.compression = (args.compression or
+                          DS.config.get('options', 'compression'))
+        DS.compilercache = (args.compilercache or
+                            DS.config.get('options', 'compilercache'))
+        if DS.compilercache not in pkgbuilder.ccache.TOOLS:
+            DS.compilercache = None
+        DS.compilercachesize = max(0, DS.config.getint('options',
+                                                       'compilercachesize'))
+        DS.compilercachedir = (DS.config.get('extras', 'compilercachedir') or
+                               None)
+        DS.nocompilercache = [
+            i.strip() for i in
+            DS.config.get('extras', 'nocompilercache').split(',')
+            if i.strip()]
+        if args.lookahead is not None:
+            DS.lookahead = max(0, args.lookahead)
+        else:
+            DS.lookahead = max(0, DS.config.getint('options', 'lookahead'))
+        DS.buildcachesize = max(0, DS.config.getint('options',
+                                                    'buildcachesize'))
+        DS.buildcachedir = DS.config.get('extras', 'buildcachedir') or None
+        DS.artifactstore = DS.config.get('extras', 'artifactstore') or None
+        DS.pacmancache = DS.config.getboolean('options', 'pacmancache')
         DS.colors_status = DS.get_setting('--colors', 'options', 'colors',
                                           args.colors, args.nocolors)
+        DS.jobs = max(1, args.jobs or DS.config.getint('options', 'jobs'))
+        DS.cores = max(0, args.cores or DS.config.getint('options', 'cores'))
+        DS.jobserver = DS.config.getboolean('options', 'jobserver')
+        DS.fetchjobs = max(1, args.fetchjobs or
+                           DS.config.getint('options', 'fetchjobs'))
         pkgnames = args.pkgnames
 
         if DS.get_setting('--debug', 'options', 'debug',
@@ -292,16 +381,19 @@ def main(source='AUTO', quit=True):
 
         user_chdir = DS.config.get('extras', 'chdir').strip()
 
+        # Packages are fetched and built in builddir; the working directory
+        # of the process is never changed.
         if user_chdir:
-            DS.log.debug('Changing directory to %s (via config)', user_chdir)
-            os.makedirs(user_chdir, exist_ok=True)
-            os.chdir(user_chdir)
+            DS.log.debug('Building in %s (via config)', user_chdir)
+            builddir = os.path.abspath(user_chdir)
+            os.makedirs(builddir, exist_ok=True)
         elif DS.pacman:
             DS.log.debug('-S passed, building in /tmp/.')
-            path = '/tmp/pkgbuilder-{0}'.format(str(DS.uid))
-            if not os.path.exists(path):
-                os.mkdir(path)
-            os.chdir(path)
+            builddir = '/tmp/pkgbuilder-{0}'.format(str(DS.uid))
+            if not os.path.exists(builddir):
+                os.mkdir(builddir)
+        else:
+            builddir = os.path.abspath(os.curdir)
 
         if args.upgrade:
             DS.root_crash()
@@ -316,7 +408,7 @@ def main(source='AUTO', quit=True):
             pkgnames = upnames + pkgnames
 
         if DS.fetch and pkgnames:
-            pkgbuilder.build.fetch_runner(pkgnames)
+            pkgbuilder.build.fetch_runner(pkgnames, destdir=builddir)
             if quit:
                 exit(0)
 
@@ -329,7 +421,8 @@ def main(source='AUTO', quit=True):
                 except pkgbuilder.exceptions.AURError as e:
                     print(_('Error while processing {0}: {1}').format(u, e))
 
-            pkgbuilder.build.fetch_runner(tofetch, preprocessed=True)
+            pkgbuilder.build.fetch_runner(tofetch, preprocessed=True,
+                                          destdir=builddir)
             if quit:
                 exit(0)
 
@@ -342,11 +435,28 @@ def main(source='AUTO', quit=True):
             sigs = []
             tovalidate = set(pkgnames)
 
-            for pkgname in pkgnames:
+            if DS.jobs > 1:
+                # One plan for everything, so that independent packages can
+                # be built at the same time.
+                DS.log.info('Building with {0} jobs'.format(DS.jobs))
                 try:
-                    DS.log.info('Building {0}'.format(pkgname))
-                    out = pkgbuilder.build.auto_build(pkgname, DS.depcheck,
-                                                      DS.pkginst, pkgnames)
+                    graph = pkgbuilder.build.plan_build(
+                        pkgnames, DS.depcheck, DS.pkginst, destdir=builddir)
+                    out = pkgbuilder.build.build_plan(graph, DS.pkginst,
+                                                      DS.jobs)
+                    toinstall += out[1][0]
+                    sigs += out[1][1]
+                except PBException as e:
+                    DS.fancy_error(str(e))
+                    if e.exit:
+                        exit(1)
+            else:
+                # One plan for all targets, too, so that shared dependencies
+                # are fetched, checked and built once.
+                try:
+                    out = pkgbuilder.build.auto_build(
+                        pkgnames, DS.depcheck, DS.pkginst, pkgnames,
+                        builddir)
                     if out:
                         toinstall += out[1][0]
                         sigs += out[1][1]
@@ -354,9 +464,9 @@ def main(source='AUTO', quit=True):
                     DS.fancy_error(str(e))
                     if e.exit:
                         exit(1)
-                    else:
-                        DS.fancy_error2(_("skipping package {0}").format(
-                            pkgname))
+
+            if DS.compiler_cache is not None:
+                DS.compiler_cache.report()
 
             if DS.pkginst:
                 # If there is nothing to install, but the user asked to install
@@ -374,7 +484,8 @@ def main(source='AUTO', quit=True):
                     pkgpaths=toinstall,
                     sigpaths=sigs,
                     asdeps=False,
-                    filename=pkgbuilder.transaction.generate_filename(),
+                    filename=pkgbuilder.transaction.generate_filename(
+                        directory=builddir),
                     delete=True)
                 tx.run(standalone=False, validate=DS.validation)
                 qs = tx.exitcode
@@ -14,6 +14,7 @@ Call the AUR API.
 import pkgbuilder
 from pkgbuilder.exceptions import ConnectionError, HTTPError, NetworkError
 import requests
+import requests.adapters
 import requests.exceptions
 import json
 
@@ -42,6 +43,12 @@ class AUR(object):
 
     multiinfo is implemented in another function, :meth:`multiinfo()`.
 
+    All requests go through one HTTP session (:attr:`http`), which keeps
+    connections open for reuse, also between threads.
+
+    .. versionchanged:: 4.3.0
+       Uses a pooled HTTP session.  Added :meth:`download()`.
+
     .. note:: Most people don’t actually want this and will prefer to use
               ``pkgbuilder.utils.{info,search,msearch}()`` instead.
     """
@@ -51,6 +58,15 @@ class AUR(object):
     _rpc = '/rpc/?v='
     emptystr = '{"version":%s,"type":"%s","resultcount":0,"results":[]}'
     ua = 'PKGBUILDer/' + pkgbuilder.__version__
+    poolsize = 16
+
+    def __init__(self):
+        """Initialize the client and its HTTP session."""
+        self.http = requests.Session()
+        self.http.headers['User-Agent'] = self.ua
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.poolsize)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
 
     @property
     def rpc(self):
@@ -67,8 +83,7 @@ class AUR(object):
         if search_by is not None:
             params['search_by'] = search_by
         try:
-            req = requests.get(self.rpc, params=params,
-                               headers={'User-Agent': self.ua})
+            req = self.http.get(self.rpc, params=params)
             req.raise_for_status()
         except requests.exceptions.ConnectionError as e:
             raise ConnectionError(e.args[0].args[0], e)
@@ -86,9 +101,8 @@ class AUR(object):
             return self.emptystr % (self.rpcver, 'multiinfo')
 
         try:
-            req = requests.get(self.rpc,
-                               params={'type': 'multiinfo', 'arg[]': args},
-                               headers={'User-Agent': self.ua})
+            req = self.http.get(self.rpc,
+                                params={'type': 'multiinfo', 'arg[]': args})
             req.raise_for_status()
         except requests.exceptions.ConnectionError as e:
             raise ConnectionError(e.args[0].args[0], e)
@@ -99,6 +113,23 @@ class AUR(object):
 
         return req.text
 
+    def download(self, urlpath):
+        """Download a file from the AUR (eg. a snapshot) and return its data.
+
+        .. versionadded:: 4.3.0
+        """
+        try:
+            req = self.http.get(self.base + urlpath)
+            req.raise_for_status()
+        except requests.exceptions.ConnectionError as e:
+            raise ConnectionError(e.args[0].args[0], e)
+        except requests.exceptions.HTTPError as e:
+            raise HTTPError(req, e)
+        except requests.exceptions.RequestException as e:
+            raise NetworkError(str(e), e)
+
+        return req.content
+
     def request(self, rtype, arg, search_by=None):
         """Make a request and return the AURDict."""
         return json.loads(self.jsonreq(rtype, arg, search_by))
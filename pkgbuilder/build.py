@@ -7,33 +7,50 @@
 """
 Build AUR packages.
 
+Functions that take a `session` use it for settings, pacman and AUR access
+and output.  The default session is ``DS``.
+
 :Copyright: © 2011-2018, Chris Warrick.
 :License: BSD (see /LICENSE).
 """
 
 from . import DS, _
 import pkgbuilder.aur
+import pkgbuilder.deps
 import pkgbuilder.exceptions
+import pkgbuilder.fetch
 import pkgbuilder.package
+import pkgbuilder.plan
+import pkgbuilder.scheduler
 import pkgbuilder.transaction
 import pkgbuilder.ui
 import pkgbuilder.utils
-import sys
 import os
 import platform
-import pyalpm
-import srcinfo.parse
-import re
 import subprocess
+import collections
+import contextlib
 import functools
 import glob
-
-__all__ = ('auto_build', 'clone', 'asp_export', 'prepare_deps', 'depcheck',
+import hashlib
+import io
+import shlex
+import shutil
+import tarfile
+import tempfile
+
+__all__ = ('auto_build', 'find_package', 'group_targets', 'resolve_closure',
+           'plan_build', 'plan_rpc', 'plan_srcinfo', 'fetch_node',
+           'fetch_nodes', 'verify_node', 'build_key', 'build_plan',
+           'checkout_state', 'check_checkouts', 'clone', 'snapshot',
+           'fetch_aur', 'asp_export', 'asp_update', 'fetch_asp',
+           'fetch_sources', 'parse_srcinfo', 'prepare_deps', 'depcheck',
+           'find_packagefile', 'split_pkgfile', 'select_packagefiles',
            'fetch_runner', 'build_runner')
 
 
 def auto_build(pkgname, performdepcheck=True,
-               pkginstall=True, completelist=None):
+               pkginstall=True, completelist=None, destdir=None, session=None):
     """A function that builds everything, that should be used by everyone.
 
     This function makes building AUR deps possible.
@@ -46,117 +63,1365 @@ def auto_build(pkgname, performdepcheck=True,
         Please take care of it.  Running PKGBUILDer/PBWrapper standalone or
         .__main__.main() will do that.
 
+    .. versionchanged:: 4.3.0
+       The whole AUR dependency tree is resolved up front (see
+       :func:`plan_build`) and built once, in topological order.
+       `pkgname` may be a list of names (see :func:`group_targets`).
+       `completelist` is ignored.  Packages are fetched into and built in
+       `destdir` (default: the current directory).
     """
-    if completelist is None:
-        completelist = []
-    build_result = build_runner(pkgname, performdepcheck, pkginstall)
+    ds = session or DS
+    if isinstance(pkgname, str):
+        pkgnames = [pkgname]
+    else:
+        pkgnames = pkgname
     try:
-        if build_result[0] == 0:
-            DS.fancy_msg(_('The build succeeded.'))
-        elif build_result[0] >= 0 and build_result[0] < 256:
-            raise pkgbuilder.exceptions.MakepkgError(build_result[0])
-        elif build_result[0] == 72336:
-            # existing package, do nothing
-            pass
-        elif build_result[0] == 72337:
-            DS.fancy_warning(_('Building more AUR packages is required.'))
-            if not pkginstall:
-                raise pkgbuilder.exceptions.PBException(
-                    _('Cannot install dependencies and continue building '
-                      'because -w, --buildonly was specified.  Please run '
-                      'without -w, --buildonly or install dependencies '
-                      'manually and try again.'),
-                    'auto_build deps')
-
-            toinstall2 = []
-            sigs2 = []
-            for pkgname2 in build_result[1]:
-                toinstall = []
-                if pkgname2 in completelist:
-                    if (completelist.index(pkgname2) <
-                            completelist.index(pkgname)):
-                        # Already built the package.
-                        toinstall, sigs = find_packagefile(
-                            os.path.join(os.getcwd(), pkgname2))
-                        if toinstall:
-                            DS.fancy_msg2(_('found an existing package for '
-                                            '{0}').format(pkgname2))
-                        # Note that the package will be reinstalled later.
-                        # This, however, isn’t a problem.
-                    else:
-                        # We won’t rebuild it and reinstall it later.  Doing
-                        # that solely because I can and because this won’t
-                        # introduce hacks.
-                        completelist.remove(pkgname2)
-
-                if not toinstall:
-                    try:
-                        br = auto_build(
-                            pkgname2, performdepcheck, pkginstall,
-                            build_result[1])
-                        toinstall, sigs = br[1]
-                    except IndexError:
-                        return br
-
-                toinstall2 += toinstall
-                sigs2 += sigs
-
-            if toinstall2:
-                tx = pkgbuilder.transaction.Transaction(
-                    pkgnames=build_result[1],
-                    pkgpaths=toinstall2,
-                    sigpaths=sigs2,
-                    asdeps=True,
-                    filename=pkgbuilder.transaction.generate_filename(),
-                    delete=True)
-                tx.run(standalone=False, validate=DS.validation)
-
-            return auto_build(pkgname, performdepcheck, pkginstall,
-                              completelist)
-
-        return build_result
+        graph = plan_build(pkgnames, performdepcheck, pkginstall,
+                           destdir=destdir, session=ds)
+        return build_plan(graph, pkginstall, session=ds)
     # Non-critical exceptions that shouldn’t crash PKGBUILDer as a whole are
     # handled here.  Some are duplicated for various reasons.
     except pkgbuilder.exceptions.MakepkgError as e:
-        DS.fancy_error(_('makepkg (or someone else) failed and '
+        ds.fancy_error(_('makepkg (or someone else) failed and '
                          'returned {0}.').format(e.retcode))
         return []
     except pkgbuilder.exceptions.AURError as e:
-        DS.fancy_error(str(e))
+        ds.fancy_error(str(e))
         return []
     except pkgbuilder.exceptions.PackageError as e:
-        DS.fancy_error(str(e))
+        ds.fancy_error(str(e))
         return []
 
 
-def clone(pkgbase):
-    """Clone or update a git repo.
+def find_package(pkgname, source='build', session=None):
+    """Find a package in the AUR, or in the repositories if it is not there.
+
+    :return: an AURPackage or ABSPackage
+    :raises PackageNotFoundError: if the package cannot be found
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    try:
+        return pkgbuilder.utils.info([pkgname], session=ds)[0]
+    except IndexError:
+        ds.log.info('{0} not found in the AUR, checking in repositories'.format(
+            pkgname))
+        found = ds.dbindex.find_satisfier(pkgname, 'sync')
+        if found:
+            # The index is not tied to our pyalpm handle; ask the handle.
+            for db in ds.pyc.get_syncdbs():
+                if db.name == found.db:
+                    abspkg = db.get_pkg(found.name)
+                    if abspkg:
+                        return pkgbuilder.package.ABSPackage.from_pyalpm(
+                            abspkg)
+    raise pkgbuilder.exceptions.PackageNotFoundError(pkgname, source)
+
+
+def group_targets(pkgnames, session=None):
+    """Group package names by package base, with a single multiinfo request.
+
+    Split packages of one package base have to be built together, as
+    makepkg builds all of them at once.  Names that are not in the AUR get
+    a group of their own.
+
+    :return: lists of names, in order of first appearance
+    :rtype: list
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    pkgbases = {p.name: p.packagebase for p in
+                pkgbuilder.utils.info(pkgnames, session=ds)}
+    groups = collections.OrderedDict()
+    for name in pkgnames:
+        groups.setdefault(pkgbases.get(name, name), []).append(name)
+    return list(groups.values())
+
+
+def plan_build(pkgnames, performdepcheck=True, pkginstall=True,
+               rpcplan=True, destdir=None, session=None):
+    """Resolve the AUR dependency tree of `pkgnames` into a build plan.
+
+    Every package base ends up fetched (from the AUR or ASP) into `destdir`
+    (default: the current directory), and is fetched and checked exactly
+    once, even if it is required by many packages, or if many of its split
+    packages are.
+
+    With `rpcplan`, the dependency tree is resolved from AUR RPC metadata
+    (see :func:`plan_rpc`) before anything is cloned.  Otherwise, package
+    bases are fetched and have their .SRCINFO checked one at a time (see
+    :func:`plan_srcinfo`).
+
+    :return: a :class:`pkgbuilder.plan.BuildGraph`
+    :raises PBException: if AUR dependencies are needed, but
+                         `pkginstall` is False
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    if rpcplan:
+        graph = plan_rpc(pkgnames, performdepcheck, destdir, pkginstall,
+                         session=ds)
+    else:
+        graph = plan_srcinfo(pkgnames, performdepcheck, destdir, pkginstall,
+                             session=ds)
+
+    if not pkginstall and any(node.depends for node in graph):
+        raise pkgbuilder.exceptions.PBException(
+            _('Cannot install dependencies and continue building '
+              'because -w, --buildonly was specified.  Please run '
+              'without -w, --buildonly or install dependencies '
+              'manually and try again.'),
+            'plan_build')
+
+    for node in graph:
+        # Only for packages that are installed right away: the pacman cache
+        # has no place in -w builds, and has official binaries of ABS ones.
+        if (node.existing is None and ds.pacmancache and pkginstall and
+                not node.is_abs):
+            _find_in_pacman_cache(node, session=ds)
+        if node.existing is None and (ds.build_cache is not None or
+                                      ds.artifact_store is not None):
+            _find_cached(node, graph, pkginstall, session=ds)
+
+    return graph
+
+
+def plan_srcinfo(pkgnames, performdepcheck=True, destdir=None,
+                 pkginstall=True, session=None):
+    """Build a plan by fetching package bases and reading their .SRCINFO.
+
+    Package bases are fetched and checked breadth-first, one at a time.
+
+    :param bool pkginstall: whether the packages will be installed (for
+                            finding existing package files)
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    graph = pkgbuilder.plan.BuildGraph(destdir)
+    queue = collections.deque((name, None) for name in pkgnames)
+    while queue:
+        name, dependent = queue.popleft()
+        node = graph.get(name)
+        if node is None:
+            pkg = find_package(name, session=ds)
+            pkgbase = pkgbuilder.plan.BuildNode.pkgbase_of(pkg)
+            isnew = pkgbase not in graph.nodes
+            node = graph.add(pkg)
+        else:
+            isnew = False
+
+        if dependent is None:
+            node.targets.add(name)
+        else:
+            node.required.add(name)
+            graph.add_dependency(dependent, node)
+
+        if isnew:
+            for dep in prepare_node(node, graph, performdepcheck,
+                                    pkginstall, session=ds):
+                queue.append((dep, node))
+
+    return graph
+
+
+def plan_rpc(pkgnames, performdepcheck=True, destdir=None, pkginstall=True,
+             session=None):
+    """Build a plan from AUR RPC metadata, then fetch and verify it.
+
+    The dependency tree is resolved with one multiinfo request per level of
+    the tree, without cloning anything.  All package bases in the plan are
+    then fetched at once (AUR repositories are cloned in parallel), and
+    their .SRCINFO files are checked against the plan.  If a .SRCINFO file
+    disagrees with the RPC metadata (eg. because of architecture-specific
+    dependencies, or dependencies of repository packages, which the RPC
+    does not know about), the plan is updated from .SRCINFO.
+
+    :param bool pkginstall: whether the packages will be installed (for
+                            finding existing package files)
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    graph = resolve_closure(pkgnames, performdepcheck, destdir, session=ds)
+    nodes = list(graph)
+    while nodes:
+        queue = []
+        for node in fetch_nodes(nodes, pkginstall=pkginstall, session=ds):
+            queue += verify_node(node, graph, performdepcheck, session=ds)
+        nodes = _resolve_rpc(graph, queue, performdepcheck, session=ds)
+
+    return graph
+
+
+def resolve_closure(names, performdepcheck=True, destdir=None, session=None):
+    """Resolve the AUR dependency closure of `names`, without fetching.
+
+    Dependencies, make dependencies and check dependencies are followed
+    breadth-first, using AUR RPC metadata, with one multiinfo request per
+    level of the tree.  Dependencies that can be satisfied from the local or
+    sync databases are not followed (they are listed in ``node.repodeps`` if
+    they need to be installed).  Packages that are not in the AUR are looked
+    up in the repositories, but their dependencies are not known until they
+    are exported from ASP.
+
+    The result can be inspected with :meth:`BuildGraph.toposort()
+    <pkgbuilder.plan.BuildGraph.toposort>`, :meth:`BuildGraph.cycles()
+    <pkgbuilder.plan.BuildGraph.cycles>` and :meth:`BuildGraph.groups()
+    <pkgbuilder.plan.BuildGraph.groups>`.
+
+    :param list names: package names
+    :param bool performdepcheck: whether to follow dependencies at all
+    :param str destdir: directory the graph will be fetched into (default:
+                        the current directory)
+    :return: a :class:`pkgbuilder.plan.BuildGraph`
+    :raises PackageNotFoundError: if a package or dependency cannot be found
+    :raises PackageError: if a versioned dependency cannot be satisfied
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    graph = pkgbuilder.plan.BuildGraph(destdir)
+    _resolve_rpc(graph, [(name, None, None) for name in names],
+                 performdepcheck, session=ds)
+    return graph
+
+
+def _resolve_rpc(graph, queue, performdepcheck=True, session=None):
+    """Add packages in `queue` and their AUR dependencies to `graph`.
+
+    `queue` is a list of ``(name, dependent, dep)`` items, where `dependent`
+    is the node that requires `name` (None for targets), and `dep` is the
+    full dependency specification.  Each level of the dependency tree costs
+    a single multiinfo request.
+
+    :return: new nodes
+    :rtype: list
+    """
+    ds = session or DS
+    new = []
+    while queue:
+        wanted = []
+        for name, _dependent, _dep in queue:
+            if name not in graph and name not in wanted:
+                wanted.append(name)
+        if wanted:
+            ds.log.debug('Resolving {0}'.format(', '.join(wanted)))
+            found = {p.name: p for p in
+                     pkgbuilder.utils.info(wanted, session=ds)}
+        else:
+            found = {}
+
+        nextqueue = []
+        for name, dependent, dep in queue:
+            node = graph.get(name)
+            if node is None:
+                pkg = found.get(name)
+                if pkg is None and dependent is None:
+                    # Not in the AUR, try the repositories.
+                    pkg = find_package(name, session=ds)
+                elif pkg is None:
+                    raise pkgbuilder.exceptions.PackageNotFoundError(
+                        name, 'depcheck')
+                pkgbase = pkgbuilder.plan.BuildNode.pkgbase_of(pkg)
+                isnew = pkgbase not in graph.nodes
+                node = graph.add(pkg)
+                if isnew:
+                    new.append(node)
+                    if performdepcheck and not pkg.is_abs:
+                        nextqueue += _rpc_deps(node, session=ds)
+
+            if dependent is None:
+                node.targets.add(name)
+            elif dependent is not node:
+                spec = pkgbuilder.deps.parse_depspec(dep)
+                if not spec.satisfied_by(node.pkg.version):
+                    raise pkgbuilder.exceptions.PackageError(
+                        _('Failed to fulfill package dependency '
+                          'requirement: {0}').format(dep),
+                        req=dep, source=dependent.pkg)
+                node.required.add(name)
+                graph.add_dependency(dependent, node)
+
+        queue = nextqueue
+    return new
+
+
+def _rpc_deps(node, session=None):
+    """Return AUR dependencies of `node`, according to the RPC.
+
+    Dependencies found in the repositories are added to ``node.repodeps``.
+
+    :return: ``(name, node, dep)`` items for :func:`_resolve_rpc`
+    """
+    ds = session or DS
+    index = ds.dbindex
+    aurdeps = []
+    for dep in (node.pkg.depends + node.pkg.makedepends +
+                node.pkg.checkdepends):
+        spec = pkgbuilder.deps.parse_depspec(dep)
+        test = None if spec.version is None else spec.satisfied_by
+        if index.find_satisfier(spec.name, 'local', test):
+            continue
+        elif index.find_satisfier(spec.name, 'sync', test):
+            if spec.name not in node.repodeps:
+                node.repodeps.append(spec.name)
+        elif spec.name != node.pkg.name:
+            aurdeps.append((spec.name, node, dep))
+    return aurdeps
+
+
+def _announce_node(node, session=None):
+    """Display information about a package base that is about to be fetched.
+    """
+    ds = session or DS
+    pkg = node.pkg
+    ds.fancy_msg(_('Retrieving {0}...').format(pkg.name))
+    pkgbuilder.utils.print_package_search(pkg,
+                                          prefix=ds.colors['blue'] +
+                                          '  ->' + ds.colors['all_off'] +
+                                          ds.colors['bold'] + ' ',
+                                          prefixp='  -> ', session=ds)
+    print(ds.colors['all_off'], end='', file=ds.stream)
+
+
+def _existing_files(node, pkginstall=True, session=None):
+    """Return package files for `node` in its checkout, if all are there.
+
+    Package files must exist for every package that is needed from the node
+    (targets and packages required by other nodes), in the version the plan
+    is for.
+
+    :return: ``(pkgpaths, sigpaths)``, or None
+    """
+    ds = session or DS
+    names = (node.targets | node.required) or {node.pkg.name}
+    existing = select_packagefiles(
+        find_packagefile(node.path, pkginstall, session=ds), names,
+        node.pkg.version)
+    if names <= {split_pkgfile(path)[0] for path in existing[0]}:
+        return existing
+    return None
+
+
+def _find_existing(node, pkginstall=True, session=None):
+    """Check if package files for `node` already exist.
+
+    :return: whether they were found (and stored in ``node.existing``)
+    """
+    ds = session or DS
+    existing = _existing_files(node, pkginstall, session=ds)
+    if existing is not None:
+        names = (node.targets | node.required) or {node.pkg.name}
+        ds.fancy_msg2(_('found an existing package for '
+                        '{0}').format(', '.join(sorted(names))))
+        node.existing = existing
+        return True
+    return False
+
+
+_VCS_PREFIXES = ('bzr+', 'fossil+', 'git+', 'git://', 'hg+', 'svn+',
+                 'svn://')
+
+
+def _is_vcs(data, arch):
+    """Check if parsed .SRCINFO `data` has VCS sources."""
+    for section in [data] + list(data['packages'].values()):
+        for field in ('source', 'source_' + arch):
+            for source in section.get(field, []):
+                if source.rpartition('::')[2].startswith(_VCS_PREFIXES):
+                    return True
+    return False
+
+
+def _find_in_pacman_cache(node, session=None):
+    """Check if the pacman cache has the package files `node` would build.
+
+    Only the exact file names ``makepkg --packagelist`` reports are looked
+    up.  VCS packages are skipped, as their version is not known before
+    building, and so are ABS packages, which would resolve to the official
+    binaries.
+
+    :return: whether they were found (and stored in ``node.existing``)
+    """
+    ds = session or DS
+    if node.is_abs:
+        return False
+    srcinfo_path = os.path.join(node.path, '.SRCINFO')
+    names = (node.targets | node.required) or {node.pkg.name}
+    try:
+        if _is_vcs(parse_srcinfo(srcinfo_path, 'pacman_cache', session=ds),
+                   platform.machine()):
+            return False
+        paths = ds.srcinfo_cache.packagelist(node.path,
+                                             _pkgext(True, session=ds))
+    except (OSError, subprocess.CalledProcessError,
+            pkgbuilder.exceptions.PackageError) as e:
+        ds.log.warning('Cannot check the pacman cache for {0}: {1}'.format(
+            node.pkgbase, e))
+        return False
+
+    index = ds.pacman_cache
+    pkgs = []
+    sigs = []
+    for path in paths:
+        name, version, _arch = split_pkgfile(path)
+        if name not in names or version != node.pkg.version:
+            continue
+        cached = index.find(os.path.basename(path))
+        if cached is None:
+            return False
+        pkgs.append(cached)
+        sig = index.find(os.path.basename(path) + '.sig')
+        if sig is not None:
+            sigs.append(sig)
+
+    if names <= {split_pkgfile(path)[0] for path in pkgs}:
+        ds.fancy_msg2(_('found {0} in the pacman cache').format(
+            ', '.join(sorted(names))))
+        node.existing = (pkgs, sigs)
+        return True
+    return False
+
+
+def build_key(node, graph, pkginstall=True, session=None):
+    """Compute the build cache key of a fetched package base.
+
+    The key is a hash of everything the build depends on: the PKGBUILD,
+    the .SRCINFO, local source files (and install scripts and changelogs),
+    the architecture, and the versions the dependencies will be built
+    against (planned versions for AUR packages, installed or repository
+    versions for others).
+
+    :param bool pkginstall: whether the packages will be installed (they
+                            may be compressed differently then)
+    :return: the key, or None if the package base cannot be cached (VCS
+             packages, whose sources change without any change in the
+             PKGBUILD)
+    :rtype: str
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    arch = platform.machine()
+    srcinfo_path = os.path.join(node.path, '.SRCINFO')
+    data = parse_srcinfo(srcinfo_path, 'build_key', session=ds)
+    if _is_vcs(data, arch):
+        return None
+    local = {'PKGBUILD', '.SRCINFO'}
+    for section in [data] + list(data['packages'].values()):
+        for field in ('source', 'source_' + arch):
+            for source in section.get(field, []):
+                filename, _sep, url = source.rpartition('::')
+                if '://' not in url:
+                    local.add(filename or os.path.basename(url))
+        for field in ('install', 'changelog'):
+            if section.get(field):
+                local.add(section[field])
+
+    h = hashlib.sha256()
+    h.update('arch {0}\n'.format(arch).encode('utf-8'))
+    pkgext = _pkgext(pkginstall, session=ds)
+    if pkgext:
+        h.update('pkgext {0}\n'.format(pkgext).encode('utf-8'))
+    for name in sorted(local):
+        path = os.path.join(node.path, name)
+        if os.path.isfile(path):
+            h.update('file {0} {1}\n'.format(
+                name, ds.srcinfo_cache.digest(path)).encode('utf-8'))
+    index = ds.dbindex
+    for dep in prepare_deps(srcinfo_path, session=ds):
+        name = pkgbuilder.deps.parse_depspec(dep).name
+        if name in graph.packages:
+            version = graph.packages[name].version
+        else:
+            pkg = (index.find_satisfier(name, 'local') or
+                   index.find_satisfier(name, 'sync'))
+            version = None if pkg is None else pkg.version
+        h.update('dep {0} {1}\n'.format(dep, version).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _find_cached(node, graph, pkginstall=True, session=None):
+    """Restore package files for `node` from the build cache, if possible.
+
+    The local build cache is checked first, then the shared artifact store.
+
+    :return: whether they were found (and stored in ``node.existing``)
+    """
+    ds = session or DS
+    try:
+        node.cachekey = build_key(node, graph, pkginstall, session=ds)
+    except (OSError, pkgbuilder.exceptions.PackageError) as e:
+        ds.log.warning('Cannot compute build key for {0}: {1}'.format(
+            node.pkgbase, e))
+        return False
+    if node.cachekey is None:
+        return False
+    ds.log.debug('Build key for {0}: {1}'.format(node.pkgbase,
+                                                 node.cachekey))
+    for cache in (ds.build_cache, ds.artifact_store):
+        if cache is None:
+            continue
+        try:
+            if cache.lookup(node.cachekey, node.path) is not None:
+                break
+        except OSError as e:
+            ds.log.warning('Cannot restore {0} from {1}: {2}'.format(
+                node.pkgbase, cache, e))
+    else:
+        return False
+    existing = _existing_files(node, pkginstall, session=ds)
+    if existing is None:
+        return False
+    ds.fancy_msg2(_('found a cached build of {0}').format(node.pkgbase))
+    node.existing = existing
+    return True
+
+
+def _publish(node, pkginstall=True, session=None):
+    """Store the packages built for `node` in the build cache and store.
+
+    Failing to store them (e.g. when a shared store is unavailable) does
+    not fail the build.
+    """
+    ds = session or DS
+    built = select_packagefiles(
+        find_packagefile(node.path, pkginstall, session=ds),
+        node.subpackages, node.pkg.version)
+    if not built[0]:
+        return
+    for cache in (ds.build_cache, ds.artifact_store):
+        if cache is None:
+            continue
+        try:
+            cache.store(node.cachekey, built[0] + built[1])
+        except OSError as e:
+            ds.log.warning('Cannot store {0} in {1}: {2}'.format(
+                node.pkgbase, cache, e))
+            ds.fancy_warning2(_('Cannot store {0} in {1}: {2}').format(
+                node.pkgbase, cache.path, e))
+
+
+def fetch_node(node, quiet=False, session=None):
+    """Fetch a planned package base into ``node.path``.
+
+    :param bool quiet: whether to silence git
+    :return: path to the .SRCINFO file
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    pkg = node.pkg
+    destdir = os.path.dirname(node.path)
+    srcinfo_path = os.path.join(node.path, '.SRCINFO')
+    if pkg.is_abs:
+        _export_asp(pkg, destdir, True, session=ds)
+    else:
+        fetch_aur(pkg, destdir, quiet, session=ds)
+        if not os.path.exists(srcinfo_path):
+            raise pkgbuilder.exceptions.EmptyRepoError(pkg.packagebase)
+    return srcinfo_path
+
+
+def fetch_nodes(nodes, workers=None, pkginstall=True, session=None):
+    """Fetch planned package bases, cloning AUR repositories in parallel.
+
+    Package bases that already have a package file are skipped.  If some
+    repositories cannot be fetched, all others are still fetched before a
+    :exc:`FetchError` listing the failures is raised.
+
+    :param int workers: maximum number of concurrent clones (default:
+                        ``fetchjobs`` of the session)
+    :param bool pkginstall: whether the packages will be installed (for
+                            finding existing package files)
+    :return: nodes that were fetched
+    :rtype: list
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    tofetch = []
+    for node in nodes:
+        _announce_node(node, session=ds)
+        if not _find_existing(node, pkginstall, session=ds):
+            tofetch.append(node)
+
+    asp = [node.pkg for node in tofetch if node.is_abs]
+    if asp:
+        errors = fetch_asp(asp, os.path.dirname(tofetch[0].path), True,
+                           workers, session=ds)
+        if errors:
+            raise pkgbuilder.exceptions.FetchError(errors)
+
+    aur = [node for node in tofetch if not node.is_abs]
+    if len(aur) > 1:
+        ds.fancy_msg(_('Cloning {0} package bases...').format(len(aur)))
+        # Resolve checkouts that need a remote check in one batch first.
+        check_checkouts({node.path: node.pkg for node in aur}, workers,
+                        session=ds)
+        pool = pkgbuilder.fetch.FetchPool(workers, session=ds)
+        pool.run([(node.pkgbase, functools.partial(
+            fetch_node, node, quiet=True, session=ds)) for node in aur])
+        if pool.errors:
+            raise pkgbuilder.exceptions.FetchError(pool.errors)
+    elif aur:
+        try:
+            fetch_node(aur[0], session=ds)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise pkgbuilder.exceptions.FetchError({aur[0].pkgbase: e})
+    return tofetch
+
+
+def verify_node(node, graph, performdepcheck=True, session=None):
+    """Check the .SRCINFO of a fetched package base against the plan.
+
+    .SRCINFO is authoritative: the dependencies of `node` are replaced by
+    the ones found in it.
+
+    :return: ``(name, node, dep)`` items for AUR dependencies that are not
+             in the plan yet
+    :rtype: list
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    srcinfo_path = os.path.join(node.path, '.SRCINFO')
+    graph.register(node, find_subpackages(srcinfo_path, session=ds))
+    if not performdepcheck:
+        return []
+
+    ds.fancy_msg(_('Checking dependencies of {0}...').format(node.pkgbase))
+    depends = prepare_deps(srcinfo_path, session=ds)
+    aurdeps, node.repodeps = check_deps(depends, node.pkg, node.subpackages,
+                                        graph.packages, session=ds)
+    planned = node.depends
+    node.depends = set()
+    missing = []
+    for name in aurdeps:
+        dep = graph.get(name)
+        if dep is None:
+            missing.append((name, node, name))
+        elif dep is not node:
+            dep.required.add(name)
+            graph.add_dependency(node, dep)
+
+    if missing or node.depends != planned:
+        ds.fancy_warning2(_('.SRCINFO of {0} does not match the AUR '
+                            'metadata, updating the plan').format(
+                                node.pkgbase))
+    return missing
+
+
+def prepare_node(node, graph, performdepcheck=True, pkginstall=True,
+                 session=None):
+    """Fetch a planned package base and check its dependencies.
+
+    :return: names of AUR packages the package base depends on
+    :rtype: list
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    _announce_node(node, session=ds)
+    if _find_existing(node, pkginstall, session=ds):
+        return []
+
+    srcinfo_path = fetch_node(node, session=ds)
+    graph.register(node, find_subpackages(srcinfo_path, session=ds))
+
+    if performdepcheck:
+        ds.fancy_msg2(_('Checking dependencies...'))
+        depends = prepare_deps(srcinfo_path, session=ds)
+        aurdeps, node.repodeps = check_deps(depends, node.pkg,
+                                            node.subpackages, session=ds)
+        return aurdeps
+    else:
+        return []
+
+
+def check_deps(depends, pkgobj, subpackages, aurcache=None, session=None):
+    """Check dependencies with :func:`depcheck` and report the results.
+
+    `aurcache` is passed to :func:`depcheck`.
+
+    :return: ``(aurdeps, repodeps)``: names of AUR packages that need to be
+             built (not including `subpackages`, as they are built together
+             with `pkgobj`) and names of dependencies found in the repos
+    :rtype: tuple
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    deps = depcheck(depends, pkgobj, aurcache, session=ds)
+    pkgtypes = [_('found in system'), _('found in repos'),
+                _('found in the AUR')]
+    aurbuild = []
+    repodeps = []
+    if not deps:
+        ds.fancy_msg2(_('none found'))
+
+    for dpkg, pkgtype in deps.items():
+        if pkgtype == 2 and dpkg not in subpackages:
+            # If we didn’t check for subpackages, we would get an infinite
+            # loop if subpackages depended on each other
+            aurbuild.append(dpkg)
+        elif pkgtype == 1:
+            repodeps.append(dpkg)
+        elif dpkg in subpackages:
+            ds.log.debug("Package depends on itself, ignoring")
+
+        ds.fancy_msg2(': '.join((dpkg, pkgtypes[pkgtype])))
+    return aurbuild, repodeps
+
+
+def makepkg_params(session=None):
+    """Return the makepkg command line to use, based on settings in ``DS``.
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    mpparams = ['makepkg', '-sf']
+
+    if ds.clean:
+        mpparams.append('-c')
+
+    if not ds.pgpcheck:
+        mpparams.append('--skippgpcheck')
+
+    if not ds.confirm:
+        mpparams.append('--noconfirm')
+
+    if not ds.depcheck:
+        mpparams.append('--nodeps')
+
+    if not ds.colors_status:
+        mpparams.append('--nocolor')
+
+    return mpparams
+
+
+#: package compression profiles for packages that are installed right away
+#: (``default`` keeps makepkg.conf settings): the ``PKGEXT`` of each, and
+#: the ``COMPRESSZST`` command, if any.  ``{cores}`` is replaced by the
+#: number of cores makepkg may use.  makepkg.conf settings win over the
+#: environment, so ``COMPRESSZST`` is set in a generated config file (see
+#: :func:`makepkg_conf`).
+COMPRESSION_PROFILES = {
+    'fast': {'PKGEXT': '.pkg.tar.zst',
+             'COMPRESSZST': ('zstd', '-c', '-T{cores}', '-1', '-')},
+    'none': {'PKGEXT': '.pkg.tar'},
+}
+
+
+def _pkgext(pkginstall=True, session=None):
+    """Return the PKGEXT of the compression profile (None: default)."""
+    ds = session or DS
+    if not pkginstall or ds.compression not in COMPRESSION_PROFILES:
+        return None
+    return COMPRESSION_PROFILES[ds.compression]['PKGEXT']
+
+
+def makepkg_conf(compresszst, session=None):
+    """Return a makepkg config file that sets ``COMPRESSZST``.
+
+    The file sources the system configuration (``MAKEPKG_CONF``, default:
+    ``/etc/makepkg.conf``, and its ``.d`` directory) first, so only the
+    compressor changes; makepkg reads the user’s ``makepkg.conf`` after it,
+    as usual.  Files are kept in ``DS.cachedir``, named after their
+    contents.
+
+    :param list compresszst: the ``COMPRESSZST`` command
+    :return: path to the file, or None if it cannot be written
+    :rtype: str
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    system = os.environ.get('MAKEPKG_CONF', '/etc/makepkg.conf')
+    contents = '\n'.join([
+        '# Generated by PKGBUILDer.  Do not edit.',
+        'source {0}'.format(shlex.quote(system)),
+        'for conf in {0}/*.conf; do'.format(shlex.quote(system + '.d')),
+        '    [[ -f $conf ]] && source "$conf"',
+        'done',
+        'COMPRESSZST=({0})'.format(' '.join(shlex.quote(arg)
+                                            for arg in compresszst)),
+        ''])
+    digest = hashlib.sha256(contents.encode('utf-8')).hexdigest()[:16]
+    path = os.path.join(ds.cachedir, 'makepkg-{0}.conf'.format(digest))
+    if os.path.exists(path):
+        return path
+    try:
+        os.makedirs(ds.cachedir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=ds.cachedir, delete=False,
+                                         encoding='utf-8') as fh:
+            fh.write(contents)
+        os.replace(fh.name, path)
+    except OSError as e:
+        ds.log.warning('Cannot write makepkg config {0}: {1}'.format(path, e))
+        return None
+    return path
+
+
+def makepkg_env(pkginstall=True, session=None):
+    """Return the environment for makepkg, based on settings in ``DS``.
+
+    If ``DS.srcdest`` is set, it is used as ``SRCDEST``, so that all
+    packages share one source directory.  If ``DS.cores`` is set,
+    ``MAKEFLAGS`` is set to use all of them (see
+    :class:`pkgbuilder.scheduler.CPUBudget`); otherwise, the user’s
+    ``MAKEFLAGS`` is left alone (parallel builds get theirs from
+    :class:`pkgbuilder.scheduler.ParallelBuilder`).  If `pkginstall` is
+    set, packages are compressed as ``DS.compression`` says (see
+    :data:`COMPRESSION_PROFILES`); ``MAKEPKG_CONF`` points to a generated
+    config file then, if the profile needs one.
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    budget = pkgbuilder.scheduler.CPUBudget(session=ds)
+    env = dict(os.environ)
+    if ds.cores:
+        env = budget.environment(env)
+    if ds.srcdest:
+        env['SRCDEST'] = ds.srcdest
+    if _pkgext(pkginstall, session=ds):
+        profile = COMPRESSION_PROFILES[ds.compression]
+        env['PKGEXT'] = profile['PKGEXT']
+        if 'COMPRESSZST' in profile:
+            conf = makepkg_conf(
+                [arg.format(cores=budget.cores)
+                 for arg in profile['COMPRESSZST']], session=ds)
+            if conf:
+                env['MAKEPKG_CONF'] = conf
+    return env
+
+
+def _sources_params(session=None):
+    """Return the makepkg command line that retrieves and verifies sources."""
+    ds = session or DS
+    params = ['makepkg', '--verifysource', '--nodeps', '--noconfirm',
+              '--nocolor']
+    if not ds.pgpcheck:
+        params.append('--skippgpcheck')
+    return params
+
+
+def _fetch_node_sources(node, params, env, session=None):
+    """Run makepkg to download and verify the sources of `node`."""
+    ds = session or DS
+    if node.existing is not None:
+        return
+    proc = subprocess.run(params, cwd=node.path, env=env,
+                          stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT)
+    if proc.returncode != 0:
+        ds.log.error('Retrieving sources of {0} failed:\n{1}'.format(
+            node.pkgbase, proc.stdout.decode('utf-8', 'replace')))
+        raise pkgbuilder.exceptions.MakepkgError(proc.returncode)
+
+
+def fetch_sources(nodes, workers=None, session=None):
+    """Download and verify the sources of planned package bases in parallel.
+
+    ``makepkg --verifysource`` is run for every package base that does not
+    have a package already, in a :class:`pkgbuilder.fetch.FetchPool`.  The
+    sources end up in ``SRCDEST`` (see :func:`makepkg_env`), with checksums
+    verified, so the builds only have to extract them.
+
+    Failures are reported, but not raised: makepkg tries again (and fails
+    properly) when the package is built.
+
+    :param int workers: maximum number of concurrent downloads (default:
+                        ``fetchjobs`` of the session)
+    :return: exceptions of package bases that failed, by package base
+    :rtype: dict
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    nodes = [node for node in nodes if node.existing is None]
+    if not nodes:
+        return {}
+
+    params = _sources_params(session=ds)
+    env = makepkg_env(session=ds)
+    ds.fancy_msg(_('Retrieving sources of {0} package bases...').format(
+        len(nodes)))
+    pool = pkgbuilder.fetch.FetchPool(workers, session=ds)
+    pool.run([(node.pkgbase, functools.partial(
+        _fetch_node_sources, node, params, env, session=ds))
+        for node in nodes])
+    return pool.errors
+
+
+def _run_makepkg(node, mpparams, logfile=None, env=None, session=None):
+    """Run makepkg in ``node.path`` and return its status.
+
+    With ``DS.tmpfs``, the build is done in tmpfs if it fits there, and done
+    again on disk if it ran out of space.  With ``DS.compilercache``, the
+    compiler cache is used, unless the package base opts out.
+    """
+    ds = session or DS
+    with contextlib.ExitStack() as stack:
+        ccache = ds.compiler_cache
+        if ccache is not None and ccache.enabled_for(
+                node.pkgbase, _pkgoptions(node, session=ds)):
+            env = stack.enter_context(ccache.build(node.pkgbase, env))
+
+        tmpfs = ds.tmpfs_builds
+        if tmpfs is None:
+            return _call_makepkg(node, mpparams, logfile, env, session=ds)
+        with tmpfs.builddir(node) as builddir:
+            mpstatus = _call_makepkg(node, mpparams, logfile, env, builddir,
+                                     session=ds)
+            if mpstatus != 0 and builddir is not None:
+                tmpfs.failed(node)
+        if mpstatus != 0 and node.pkgbase in tmpfs.full:
+            ds.fancy_warning2(_('{0} ran out of space in tmpfs, building '
+                                'on disk').format(node.pkgbase))
+            mpstatus = _call_makepkg(node, mpparams, logfile, env,
+                                     session=ds)
+        return mpstatus
+
+
+def _pkgoptions(node, session=None):
+    """Return the ``options`` of all packages of `node` (a set)."""
+    ds = session or DS
+    try:
+        data = parse_srcinfo(os.path.join(node.path, '.SRCINFO'),
+                             'options', session=ds)
+    except (OSError, pkgbuilder.exceptions.PackageError):
+        return set()
+    options = set(data.get('options', []))
+    for section in data['packages'].values():
+        options.update(section.get('options', []))
+    return options
+
+
+def _call_makepkg(node, mpparams, logfile=None, env=None, builddir=None,
+                  session=None):
+    """Run makepkg once, with `builddir` as ``BUILDDIR`` if not None."""
+    ds = session or DS
+    if builddir is not None:
+        env = dict(os.environ if env is None else env)
+        env['BUILDDIR'] = builddir
+    ds.log.info("Running makepkg: {0} (BUILDDIR: {1})".format(mpparams,
+                                                              builddir))
+    if logfile is None:
+        mpstatus = subprocess.call(mpparams, shell=False, cwd=node.path,
+                                   env=env)
+    else:
+        if '--noconfirm' not in mpparams:
+            mpparams.append('--noconfirm')
+        with open(logfile, 'wb') as fh:
+            mpstatus = subprocess.call(mpparams, shell=False, cwd=node.path,
+                                       env=env, stdin=subprocess.DEVNULL,
+                                       stdout=fh, stderr=subprocess.STDOUT)
+    ds.log.info("makepkg status: {0}".format(mpstatus))
+    return mpstatus
+
+
+def build_node(node, pkginstall=True, logfile=None, env=None, session=None):
+    """Build a planned package base with makepkg.
+
+    :param str logfile: file to write makepkg output to (None: print it).
+                        makepkg does not read from the terminal then.
+    :param dict env: environment for makepkg (None: inherit it)
+    :return: ``[status, (pkgpaths, sigpaths)]``, like :func:`build_runner`
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    if node.existing is not None:
+        if pkginstall:
+            node.result = [72336, node.existing]
+        else:
+            node.result = [72336, ([], [])]
+        return node.result
+
+    ds.fancy_msg(_('Building {0}...').format(node.pkg.name))
+    mpparams = makepkg_params(session=ds)
+    mpstatus = _run_makepkg(node, mpparams, logfile, env, session=ds)
+
+    if mpstatus == 0 and node.cachekey:
+        _publish(node, pkginstall, session=ds)
+
+    if pkginstall:
+        toinstall = find_packagefile(node.path, pkginstall, session=ds)
+    else:
+        toinstall = ([], [])
+
+    ds.log.info("Found package files: {0}".format(toinstall))
+    node.result = [mpstatus, toinstall]
+    return node.result
+
+
+def install_repo_deps(graph, session=None):
+    """Install all repository dependencies of a plan in one transaction.
+
+    Needed before running many makepkg processes at once, as their ``-s``
+    installs would fight for the pacman lock.  ``node.repodeps`` covers
+    depends, makedepends and checkdepends (see :func:`prepare_deps`), so
+    makepkg has nothing left to install.
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    repodeps = []
+    for node in graph:
+        for dep in node.repodeps:
+            if dep not in repodeps:
+                repodeps.append(dep)
+
+    if repodeps:
+        ds.fancy_msg(_('Installing dependencies from repositories...'))
+        pacargs = [ds.paccommand, '-S', '--asdeps', '--needed']
+        if not ds.confirm:
+            pacargs.append('--noconfirm')
+        ret = ds.sudo(pacargs + repodeps)
+        if ret != 0:
+            raise pkgbuilder.exceptions.PBException(
+                _('Failed to install dependencies: {0}').format(
+                    ', '.join(repodeps)), 'install_repo_deps')
+
+
+def install_deps(nodes, session=None):
+    """Install built dependencies (with ``--asdeps``).
+
+    Packages that were also asked for by name are installed without
+    ``--asdeps``, so that pacman does not report them as orphans later.
+    pacman access is reloaded afterwards, so that ``DS.dbindex`` knows about
+    the new packages.
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    for asdeps in (True, False):
+        pkgnames = []
+        pkgpaths = []
+        sigpaths = []
+        for node in nodes:
+            names = [name for name in sorted(node.required)
+                     if (name in node.targets) != asdeps]
+            pkgnames += names
+            selected = select_packagefiles(node.result[1], names)
+            pkgpaths += selected[0]
+            sigpaths += selected[1]
+
+        if not pkgpaths:
+            continue
+        tx = pkgbuilder.transaction.Transaction(
+            pkgnames=pkgnames,
+            pkgpaths=pkgpaths,
+            sigpaths=sigpaths,
+            asdeps=asdeps,
+            filename=pkgbuilder.transaction.generate_filename(
+                directory=os.path.dirname(nodes[0].path)),
+            delete=True, session=ds)
+        if not tx.run(standalone=False, validate=ds.validation):
+            raise pkgbuilder.exceptions.PBException(
+                _('Failed to install AUR dependencies: {0}').format(
+                    ', '.join(sorted(pkgnames))), 'install_deps', exit=False)
+        ds._pycreload()
+
+
+def build_plan(graph, pkginstall=True, jobs=1, session=None):
+    """Build a plan made by :func:`plan_build`.
+
+    Package bases are built in topological order, exactly once each, even
+    if many of their split packages are needed.  Built dependencies are
+    installed right before the first package base that needs them.  Only
+    the package files of the packages that were asked for are returned or
+    installed.
+
+    With ``DS.prefetch``, sources are retrieved and verified ahead of the
+    builds.  With one job, a :class:`pkgbuilder.fetch.Prefetcher` works up
+    to ``DS.lookahead`` package bases ahead of the current build.  With more
+    jobs, the sources of all package bases are retrieved first (see
+    :func:`fetch_sources`).
+
+    With more than one job, independent package bases are built concurrently
+    by :class:`pkgbuilder.scheduler.ParallelBuilder`.  Failures do not raise
+    :exc:`MakepkgError` then; failed packages are reported and left out of
+    the returned lists.
+
+    :return: ``[status, (pkgpaths, sigpaths)]``, where the paths are the
+             package files for the targets of the plan
+    :raises MakepkgError: if makepkg fails
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    if jobs > 1:
+        if ds.prefetch:
+            fetch_sources(graph, session=ds)
+        install_repo_deps(graph, session=ds)
+        return pkgbuilder.scheduler.ParallelBuilder(
+            graph, jobs, pkginstall, session=ds).run()
+
+    status = 0
+    toinstall = []
+    sigs = []
+    pending = []
+    order = graph.toposort()
+    env = makepkg_env(pkginstall, session=ds)
+    # Sources are retrieved in the background, a few package bases ahead of
+    # the one being built.
+    prefetcher = pkgbuilder.fetch.Prefetcher(
+        order if ds.prefetch else [],
+        functools.partial(_fetch_node_sources,
+                          params=_sources_params(session=ds), env=env,
+                          session=ds), session=ds)
+    with prefetcher:
+        for position, node in enumerate(order):
+            if ds.prefetch and prefetcher.wait(position) is not None:
+                ds.fancy_warning(_('Sources of {0} could not be retrieved '
+                                   'in advance.').format(node.pkgbase))
+            if any(dep.pkgbase in node.depends for dep in pending):
+                install_deps(pending, session=ds)
+                pending = []
+
+            status, (pkgpaths, sigpaths) = build_node(
+                node, pkginstall, env=env, session=ds)
+            if status == 0:
+                ds.fancy_msg(_('The build succeeded.'))
+            elif status != 72336:
+                raise pkgbuilder.exceptions.MakepkgError(status)
+
+            if node.required:
+                pending.append(node)
+            if node.targets:
+                selected = select_packagefiles((pkgpaths, sigpaths),
+                                               node.targets)
+                toinstall += selected[0]
+                sigs += selected[1]
+
+    return [status, (toinstall, sigs)]
+
+
+_SNAPSHOT_MARKER = '.pkgbuilder-snapshot'
+
+
+def _lastmodified(pkg):
+    """Return the AUR modification time of a package as an integer."""
+    if pkg is None or pkg.is_abs or pkg.modified is None:
+        return None
+    return int(pkg.modified.timestamp())
+
+
+def _record_checkout(path, pkg):
+    """Record the AUR modification time of `pkg` in its checkout."""
+    lastmodified = _lastmodified(pkg)
+    if lastmodified is not None:
+        subprocess.call(['git', 'config', 'pkgbuilder.lastmodified',
+                         str(lastmodified)], cwd=path)
+
+
+def checkout_state(path, pkg, session=None):
+    """Check if a checkout is at the AUR’s current version of `pkg`.
+
+    Only local data is used: the version in the checkout’s .SRCINFO, the AUR
+    modification time recorded when the checkout was last updated, and the
+    time of its HEAD commit.
+
+    :return: True (current), False (out of date) or None (unknown)
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    lastmodified = _lastmodified(pkg)
+    srcinfo_path = os.path.join(path, '.SRCINFO')
+    if lastmodified is None or not os.path.exists(srcinfo_path):
+        return None
+
+    try:
+        data = parse_srcinfo(srcinfo_path, 'checkout_state', session=ds)
+    except pkgbuilder.exceptions.PackageError:
+        return None
+    version = '{0}-{1}'.format(data['pkgver'], data['pkgrel'])
+    if data.get('epoch', '0') != '0':
+        version = data['epoch'] + ':' + version
+    if version != pkg.version:
+        return False
+
+    out = subprocess.run(
+        ['git', 'config', '--get', 'pkgbuilder.lastmodified'], cwd=path,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.strip()
+    if out == str(lastmodified).encode('ascii'):
+        return True
+    out = subprocess.run(
+        ['git', 'log', '-1', '--format=%ct'], cwd=path,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.strip()
+    if out.isdigit() and int(out) >= lastmodified:
+        return True
+    return None
+
+
+def check_checkouts(checkouts, workers=None, session=None):
+    """Find checkouts that are at the AUR’s current version.
+
+    :func:`checkout_state` is tried first.  Checkouts it cannot decide on are
+    compared against the AUR with :func:`pkgbuilder.fetch.ls_remote`, in one
+    batch, and the result is recorded for the next run.
+
+    :param dict checkouts: AUR packages, by checkout path
+    :return: paths of current checkouts
+    :rtype: set
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    current = set()
+    unknown = []
+    for path, pkg in checkouts.items():
+        if not os.path.exists(os.path.join(path, '.git')):
+            continue
+        state = checkout_state(path, pkg, session=ds)
+        if state:
+            current.add(path)
+        elif state is None and _lastmodified(pkg) is not None:
+            unknown.append(path)
+
+    if unknown:
+        remote = pkgbuilder.fetch.ls_remote(unknown, workers, session=ds)
+        for path in unknown:
+            if path in remote and (remote[path] ==
+                                   pkgbuilder.fetch.head_commit(path)):
+                _record_checkout(path, checkouts[path])
+                current.add(path)
+
+    ds.log.debug('{0} of {1} checkouts are current'.format(
+        len(current), len(checkouts)))
+    return current
+
+
+def clone(pkgbase, destdir=None, quiet=False, pkg=None, session=None):
+    """Clone or update a git repo in `destdir` (default: current directory).
+
+    If `pkg` (the AUR package) is given, an existing checkout is not pulled
+    when :func:`checkout_state` says it is current.
+
+    New checkouts are cloned from :attr:`pkgbuilder.pbds.PBDS.mirrors`, if
+    enabled, after updating the mirror (shallow, unless ``DS.deepclone``).
 
     .. versionadded:: 4.0.0
+
+    .. versionchanged:: 4.3.0
+       Does not change the working directory, so it can run in threads.
+       Added `destdir`, `quiet` and `pkg`.  Uses mirrors.
     """
-    if os.path.exists('./{0}/'.format(pkgbase)):
-        if os.path.exists('./{0}/.git'.format(pkgbase)):
+    ds = session or DS
+    path = os.path.join(os.path.abspath(destdir or os.curdir), pkgbase)
+    quietargs = ['--quiet'] if quiet else []
+    if os.path.exists(path):
+        if os.path.exists(os.path.join(path, '.git')):
+            if checkout_state(path, pkg, session=ds):
+                ds.log.info('{0} is current, not pulling'.format(pkgbase))
+                return
             # git repo, pull
             try:
-                os.chdir(pkgbase)
-                subprocess.check_call(['git', 'pull'])
+                subprocess.check_call(['git', 'pull'] + quietargs, cwd=path)
             except subprocess.CalledProcessError as e:
                 raise pkgbuilder.exceptions.CloneError(e.returncode)
-            finally:
-                os.chdir('..')
         else:
             raise pkgbuilder.exceptions.ClonePathExists(pkgbase)
     else:
         repo_url = pkgbuilder.aur.AUR.base + '/' + pkgbase + '.git'
-        if DS.deepclone:
+        if ds.deepclone:
             cloneargs = []
         else:
             cloneargs = ['--depth', '1']
+        mirrors = ds.mirrors
         try:
-            subprocess.check_call(['git', 'clone'] + cloneargs +
-                                  [repo_url, pkgbase])
+            if mirrors is not None:
+                mirrors.update(pkgbase, repo_url, _lastmodified(pkg), quiet)
+                mirrors.checkout(pkgbase, path, repo_url, quiet,
+                                 None if ds.deepclone else 1)
+            else:
+                subprocess.check_call(['git', 'clone'] + quietargs +
+                                      cloneargs + [repo_url, path])
         except subprocess.CalledProcessError as e:
             raise pkgbuilder.exceptions.CloneError(e.returncode)
+    _record_checkout(path, pkg)
+
+
+def snapshot(pkg, destdir=None, session=None):
+    """Download and extract the snapshot tarball of an AUR package base.
+
+    The snapshot is extracted in a temporary directory and renamed into
+    place.  A directory created from an older snapshot is replaced, one that
+    matches the AUR’s modification time is kept.
+
+    :return: path to the package base directory
+    :raises pkgbuilder.exceptions.ClonePathExists: if the directory exists,
+                                                   but is not a snapshot
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    destdir = os.path.abspath(destdir or os.curdir)
+    path = os.path.join(destdir, pkg.packagebase)
+    marker = os.path.join(path, _SNAPSHOT_MARKER)
+    lastmodified = str(_lastmodified(pkg))
+    if os.path.exists(path):
+        if not os.path.exists(marker):
+            raise pkgbuilder.exceptions.ClonePathExists(pkg.packagebase)
+        with open(marker) as fh:
+            if fh.read().strip() == lastmodified:
+                return path
+
+    data = ds.aur.download(pkg.urlpath)
+    tmp = tempfile.mkdtemp(prefix='.{0}.'.format(pkg.packagebase),
+                           dir=destdir)
+    try:
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            members = tar.getmembers()
+            for member in members:
+                top = os.path.normpath(member.name).split(os.sep)[0]
+                if top != pkg.packagebase or not (member.isfile() or
+                                                  member.isdir()):
+                    raise pkgbuilder.exceptions.PackageError(
+                        'unexpected file in snapshot: {0}'.format(
+                            member.name), 'snapshot')
+            tar.extractall(tmp, members)
+        with open(os.path.join(tmp, pkg.packagebase, _SNAPSHOT_MARKER),
+                  'w') as fh:
+            fh.write(lastmodified)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(os.path.join(tmp, pkg.packagebase), path)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return path
+
+
+def fetch_aur(pkg, destdir=None, quiet=False, session=None):
+    """Fetch an AUR package base to `destdir` (default: current directory).
+
+    With ``DS.snapshot`` on, the snapshot tarball is used, unless there is a
+    git checkout already.  If the snapshot fails, the repository is cloned.
+
+    :return: path to the package base directory
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    path = os.path.join(os.path.abspath(destdir or os.curdir),
+                        pkg.packagebase)
+    if ds.snapshot and not os.path.exists(os.path.join(path, '.git')):
+        try:
+            return snapshot(pkg, destdir, session=ds)
+        except (pkgbuilder.exceptions.PBException, OSError,
+                tarfile.TarError) as e:
+            ds.log.warning('Snapshot of {0} failed, cloning: {1}'.format(
+                pkg.packagebase, e))
+    clone(pkg.packagebase, destdir, quiet, pkg, session=ds)
+    return path
 
 
 def rsync(pkg, quiet=False):
@@ -166,12 +1431,88 @@ def rsync(pkg, quiet=False):
     asp_export(pkg)
 
 
-def asp_export(pkg):
-    """Export a package from ASP to the current working directory.
+def asp_export(pkg, destdir=None, update=True):
+    """Export a package from ASP to `destdir` (default: current directory).
 
-    .. versionadded: 4.2.12"""
-    subprocess.check_call(['asp', 'update', pkg.name])
-    return subprocess.call(['asp', 'export', pkg.name])
+    .. versionadded: 4.2.12
+
+    .. versionchanged:: 4.3.0
+       Added `destdir` and `update` (set to False if :func:`asp_update` was
+       already run for the package).
+    """
+    if update:
+        asp_update([pkg.name])
+    return subprocess.call(['asp', 'export', pkg.name],
+                           cwd=os.path.abspath(destdir or os.curdir))
+
+
+def asp_update(pkgnames):
+    """Update the ASP repository for all `pkgnames` with one ``asp update``.
+
+    :raises NetworkError: if ``asp update`` fails
+
+    .. versionadded:: 4.3.0
+    """
+    pkgnames = list(pkgnames)
+    try:
+        subprocess.check_call(['asp', 'update'] + pkgnames)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise pkgbuilder.exceptions.NetworkError(
+            _('Failed to update ASP for {0}.').format(', '.join(pkgnames)),
+            source='asp', retcode=getattr(e, 'returncode', None))
+
+
+def _export_asp(pkg, destdir, srcinfo=True, update=True, session=None):
+    """Export a package from ASP and check the result.
+
+    :param bool srcinfo: whether to create a .SRCINFO file
+    :return: path to the package directory
+    """
+    ds = session or DS
+    path = os.path.join(destdir, pkg.name)
+    rc = asp_export(pkg, destdir, update)
+    if rc > 0:
+        raise pkgbuilder.exceptions.NetworkError(
+            _('Failed to retieve {0} (from ASP).').format(
+                pkg.name), source='asp', pkg=pkg, retcode=rc)
+    if not os.path.isdir(path):
+        raise pkgbuilder.exceptions.PBException(
+            'The package download failed.\n    This package might '
+            'be generated from a split PKGBUILD.  Please find out the '
+            'name of the “main” package (eg. python- instead of python2-) '
+            'and try again.', pkg.name, exit=False)
+    if srcinfo and not os.path.exists(os.path.join(path, '.SRCINFO')):
+        # Create a .SRCINFO file for ASP/repo packages.
+        # Slightly hacky, but saves us work on parsing bash.
+        ds.log.debug("Creating .SRCINFO for repository package")
+        ds.srcinfo_cache.generate(path)
+    return path
+
+
+def fetch_asp(pkgs, destdir=None, srcinfo=True, workers=None, session=None):
+    """Export many repository packages from ASP.
+
+    The ASP repository is updated once for all packages.  Then, the exports
+    (and the generation of .SRCINFO files) run in a
+    :class:`pkgbuilder.fetch.FetchPool`.
+
+    :param bool srcinfo: whether to create .SRCINFO files
+    :param int workers: maximum number of concurrent exports (default:
+                        ``fetchjobs`` of the session)
+    :return: exceptions of packages that could not be exported, by name
+    :rtype: dict
+    :raises NetworkError: if the ASP repository cannot be updated
+
+    .. versionadded:: 4.3.0
+    """
+    ds = session or DS
+    destdir = os.path.abspath(destdir or os.curdir)
+    asp_update(pkg.name for pkg in pkgs)
+    pool = pkgbuilder.fetch.FetchPool(workers, session=ds)
+    pool.run([(pkg.name, functools.partial(
+        _export_asp, pkg, destdir, srcinfo, False, session=ds))
+        for pkg in pkgs])
+    return pool.errors
 
 
 def _check_and_append(data, field, out):
@@ -180,144 +1521,150 @@ def _check_and_append(data, field, out):
         out += data[field]
 
 
-def find_subpackages(srcinfo_path, pkgname=None):
-    """Find subpackages (split packages) in a package.
+def parse_srcinfo(srcinfo_path, source='parse_srcinfo', session=None):
+    """Parse a .SRCINFO file, using the cache in ``DS.srcinfo_cache``.
 
-    .. versionadded: 4.2.6
+    .. versionadded:: 4.3.0
     """
-    with open(srcinfo_path, encoding='utf-8') as fh:
-        raw = fh.read()
-
-    data, errors = srcinfo.parse.parse_srcinfo(raw)
+    ds = session or DS
+    data, errors = ds.srcinfo_cache.parse(srcinfo_path)
     if errors:
         raise pkgbuilder.exceptions.PackageError(
-            'malformed .SRCINFO: {0}'.format(errors), 'prepare_deps')
+            'malformed .SRCINFO: {0}'.format(errors), source)
+    return data
+
+
+def find_subpackages(srcinfo_path, pkgname=None, session=None):
+    """Find subpackages (split packages) in a package.
+
+    .. versionadded: 4.2.6
+    """
+    ds = session or DS
+    data = parse_srcinfo(srcinfo_path, 'find_subpackages', session=ds)
     return [data['pkgbase']] + list(data['packages'].keys())
 
 
-def prepare_deps(srcinfo_path, pkgname=None):
-    """Get (make)depends from a .SRCINFO file and returns them.
+def prepare_deps(srcinfo_path, pkgname=None, session=None):
+    """Get (make/check)depends from a .SRCINFO file and returns them.
 
     (pkgname is now discarded, because it messes up one-build split packages.)
 
     .. versionchanged:: 4.0.1
 
     In the past, this function used to get data via `bash -c`.
+
+    .. versionchanged:: 4.3.0
+
+    checkdepends are included, as makepkg installs them too.
     """
+    ds = session or DS
     arch = platform.machine()
 
-    with open(srcinfo_path, encoding='utf-8') as fh:
-        raw = fh.read()
-
-    data, errors = srcinfo.parse.parse_srcinfo(raw)
-    if errors:
-        raise pkgbuilder.exceptions.PackageError(
-            'malformed .SRCINFO: {0}'.format(errors), 'prepare_deps')
+    data = parse_srcinfo(srcinfo_path, 'prepare_deps', session=ds)
     all_depends = []
     _check_and_append(data, 'depends', all_depends)
     _check_and_append(data, 'makedepends', all_depends)
+    _check_and_append(data, 'checkdepends', all_depends)
     _check_and_append(data, 'depends_' + arch, all_depends)
     _check_and_append(data, 'makedepends_' + arch, all_depends)
+    _check_and_append(data, 'checkdepends_' + arch, all_depends)
     for pdata in data['packages'].values():
         _check_and_append(pdata, 'depends', all_depends)
         _check_and_append(pdata, 'makedepends', all_depends)
+        _check_and_append(pdata, 'checkdepends', all_depends)
         _check_and_append(pdata, 'depends_' + arch, all_depends)
         _check_and_append(pdata, 'makedepends_' + arch, all_depends)
+        _check_and_append(pdata, 'checkdepends_' + arch, all_depends)
 
+    # Deduplicate, keeping the original order.
+    seen = set()
     depends = []
     for d in all_depends:
-        if d not in depends:
+        if d not in seen:
+            seen.add(d)
             depends.append(d)
     return depends
 
 
-def _test_dependency(available, difference, wanted):
-    """Test a dependency requirement."""
-    if '-' in available:
-        # Stripping the pkgver.
-        available = available.split('-')[0]
+def depcheck(depends, pkgobj=None, aurcache=None, session=None):
+    """Perform a dependency check.
 
-    vercmp = pyalpm.vercmp(available, wanted)
+    :param dict aurcache: AUR packages that are already known, by name (they
+                          are not looked up again)
 
-    return (('<' in difference and vercmp == -1) or
-            ('=' in difference and vercmp == 0) or
-            ('>' in difference and vercmp == 1))
-
-
-def depcheck(depends, pkgobj=None):
-    """Perform a dependency check."""
+    .. versionchanged:: 4.3.0
+       Uses :attr:`pkgbuilder.pbds.PBDS.dbindex` instead of scanning the
+       package databases for every dependency, and
+       :func:`pkgbuilder.deps.parse_depspec` to parse versioned dependencies.
+    """
+    ds = session or DS
     if depends == []:
         # THANK YOU, MAINTAINER, FOR HAVING NO DEPS AND DESTROYING ME!
         return {}
     else:
         parseddeps = {}
-        localpkgs = DS.pyc.get_localdb().pkgcache
-        syncpkgs = []
-        for j in [i.pkgcache for i in DS.pyc.get_syncdbs()]:
-            syncpkgs.append(j)
-        syncpkgs = functools.reduce(lambda x, y: x + y, syncpkgs)
+        index = ds.dbindex
         for dep in depends:
             if dep == '':
                 continue
 
-            if re.search('[<=>]', dep):
-                vpat = ('>=<|><=|=><|=<>|<>=|<=>|>=|=>|><|<>|=<|'
-                        '<=|>|=|<')
-                ver_base = re.split(vpat, dep)
-                fdep = dep
-                dep = ver_base[0]
-                try:
-                    ver = ver_base[1]
-                    diff = re.match('{0}(.*){1}'.format(
-                        re.escape(dep), re.escape(ver)),
-                                    fdep).groups()[0]
-                except IndexError:
-                    # No version requirement, no need to bother.  We do the
-                    # actual checks later not to waste time.
-                    pass
+            spec = pkgbuilder.deps.parse_depspec(dep)
+            if spec.version is None:
+                # No version requirement, no need to bother.
+                test = None
+            else:
+                test = spec.satisfied_by
+
+            if index.find_satisfier(spec.name, 'local', test):
+                parseddeps[spec.name] = 0
+            elif index.find_satisfier(spec.name, 'sync', test):
+                parseddeps[spec.name] = 1
+            else:
+                if aurcache and spec.name in aurcache:
+                    asat = [aurcache[spec.name]]
                 else:
-                    depmatch = False
-                    lsat = pyalpm.find_satisfier(localpkgs, dep)
-                    if lsat:
-                        depmatch = _test_dependency(lsat.version, diff, ver)
-                        parseddeps[dep] = 0
-
-                    if not depmatch:
-                        ssat = pyalpm.find_satisfier(syncpkgs, dep)
-                        if ssat:
-                            depmatch = _test_dependency(ssat.version, diff,
-                                                        ver)
-                            parseddeps[dep] = 1
-
-                        if not depmatch:
-                            asat = pkgbuilder.utils.info([dep])
-                            if asat:
-                                depmatch = _test_dependency(asat[0].version,
-                                                            diff, ver)
-                                parseddeps[dep] = 2
-
-                            if not depmatch:
-                                raise pkgbuilder.exceptions.PackageError(
-                                    _('Failed to fulfill package dependency '
-                                      'requirement: {0}').format(fdep),
-                                    req=fdep, source=pkgobj)
-
-            if dep not in parseddeps:
-                if pyalpm.find_satisfier(localpkgs, dep):
-                    parseddeps[dep] = 0
-                elif pyalpm.find_satisfier(syncpkgs, dep):
-                    parseddeps[dep] = 1
-                elif pkgbuilder.utils.info([dep]):
-                    parseddeps[dep] = 2
+                    asat = pkgbuilder.utils.info([spec.name], session=ds)
+                if asat and (test is None or test(asat[0].version)):
+                    parseddeps[spec.name] = 2
+                elif test is not None:
+                    raise pkgbuilder.exceptions.PackageError(
+                        _('Failed to fulfill package dependency '
+                          'requirement: {0}').format(dep),
+                        req=dep, source=pkgobj)
                 else:
                     raise pkgbuilder.exceptions.PackageNotFoundError(
-                        dep, 'depcheck')
+                        spec.name, 'depcheck')
 
         return parseddeps
 
 
-def find_packagefile(pdir):
-    """Find a package file (*.pkg.tar.xz) and signatures, if any."""
+def find_packagefile(pdir, pkginstall=True, session=None):
+    """Find the package files built in `pdir`, and their signatures.
+
+    :param bool pkginstall: whether the packages were built to be installed
+                            (they may be compressed differently then)
+
+    .. versionchanged:: 4.3.0
+       The exact file names for the current version are taken from
+       ``makepkg --packagelist`` (cached by
+       :meth:`pkgbuilder.cache.SrcinfoCache.packagelist`), so packages in
+       ``PKGDEST`` are found, and stale ones are not.  Directories without
+       a PKGBUILD, or where makepkg fails, are still searched with a glob.
+    """
+    ds = session or DS
+    if os.path.exists(os.path.join(pdir, 'PKGBUILD')):
+        try:
+            paths = ds.srcinfo_cache.packagelist(pdir,
+                                                 _pkgext(pkginstall,
+                                                         session=ds))
+        except (OSError, subprocess.CalledProcessError) as e:
+            ds.log.warning('makepkg --packagelist failed in {0}: {1}'.format(
+                pdir, e))
+        else:
+            pkgs = [path for path in paths if os.path.exists(path)]
+            return pkgs, [path + '.sig' for path in pkgs
+                          if os.path.exists(path + '.sig')]
+
     # .pkg.tar.xz FTW, but some people change that.
     # (note that PKGBUILDs can do it, too!)
     # Moreover, dumb PKGBUILDs can remove that `.pkg.tar` part.  `makepkg`s
@@ -347,8 +1694,54 @@ def find_packagefile(pdir):
     return list(pkgs - sigs), list(sigs)
 
 
-def fetch_runner(pkgnames, preprocessed=False):
-    """Run the fetch procedure."""
+def split_pkgfile(path):
+    """Split a package file name into ``(pkgname, version, arch)``.
+
+    Names that do not look like package files are returned as
+    ``(name, None, None)``.
+
+    .. versionadded:: 4.3.0
+    """
+    name = os.path.basename(path)
+    if name.endswith('.sig'):
+        name = name[:-4]
+    if '.pkg.tar' in name:
+        name = name[:name.index('.pkg.tar')]
+    parts = name.rsplit('-', 3)
+    if len(parts) != 4:
+        return name, None, None
+    return parts[0], parts[1] + '-' + parts[2], parts[3]
+
+
+def select_packagefiles(files, names, version=None):
+    """Select package files for packages called `names`.
+
+    :param tuple files: ``(pkgpaths, sigpaths)``, like
+                        :func:`find_packagefile` returns them
+    :param names: package names to select
+    :param str version: version to select (None: any version)
+    :return: ``(pkgpaths, sigpaths)`` for the selected packages
+
+    .. versionadded:: 4.3.0
+    """
+    pkgpaths = []
+    for path in files[0]:
+        pkgname, pkgversion, _arch = split_pkgfile(path)
+        if pkgname in names and version in (None, pkgversion):
+            pkgpaths.append(path)
+    sigpaths = [path for path in files[1] if path[:-4] in pkgpaths]
+    return pkgpaths, sigpaths
+
+
+def fetch_runner(pkgnames, preprocessed=False, destdir=None, session=None):
+    """Run the fetch procedure.
+
+    .. versionchanged:: 4.3.0
+       Added `destdir` (default: current directory).  AUR repositories are
+       cloned in parallel (see :class:`pkgbuilder.fetch.FetchPool`); all of
+       them are tried before failures are reported.
+    """
+    ds = session or DS
     abspkgs = []
     aurpkgs = []
     allpkgs = []
@@ -358,28 +1751,14 @@ def fetch_runner(pkgnames, preprocessed=False):
             pkgnames = [p.name for p in allpkgs]
         else:
             print(':: ' + _('Fetching package information...'))
+            found = {p.name: p for p in
+                     pkgbuilder.utils.info(pkgnames, session=ds)}
             for pkgname in pkgnames:
-                pkg = None
-                try:
-                    pkg = pkgbuilder.utils.info([pkgname])[0]
-                except IndexError:
-                    try:
-                        DS.log.info('{0} not found in the AUR, checking in '
-                                    'repositories'.format(pkgname))
-                        syncpkgs = []
-                        for j in [i.pkgcache for i in DS.pyc.get_syncdbs()]:
-                            syncpkgs.append(j)
-                        syncpkgs = functools.reduce(lambda x, y: x + y,
-                                                    syncpkgs)
-                        abspkg = pyalpm.find_satisfier(syncpkgs, pkgname)
-                        pkg = pkgbuilder.package.ABSPackage.from_pyalpm(abspkg)
-
-                    except AttributeError:
-                        pass
-                allpkgs.append(pkg)
-                if not pkg:
-                    raise pkgbuilder.exceptions.PackageNotFoundError(
-                        pkgname, 'fetch')
+                if pkgname in found:
+                    allpkgs.append(found[pkgname])
+                else:
+                    allpkgs.append(find_package(pkgname, 'fetch',
+                                                session=ds))
 
         for pkg in allpkgs:
             if pkg.is_abs:
@@ -387,161 +1766,115 @@ def fetch_runner(pkgnames, preprocessed=False):
             else:
                 aurpkgs.append(pkg)
 
+        failed = []
         if abspkgs:
             print(_(':: Retrieving packages from asp...'))
-            pm = pkgbuilder.ui.Progress(len(abspkgs))
-            for pkg in abspkgs:
-                pm.msg(_('retrieving {0}').format(pkg.name), True)
-                rc = asp_export(pkg)
-                if rc > 0:
-                    raise pkgbuilder.exceptions.NetworkError(
-                        _('Failed to retieve {0} (from ASP).').format(
-                            pkg.name), source='asp', pkg=pkg, retcode=rc)
+            failed += list(fetch_asp(abspkgs, destdir, False, session=ds))
 
         if aurpkgs:
             print(_(':: Retrieving packages from aur...'))
-            pm = pkgbuilder.ui.Progress(len(aurpkgs))
-            for pkg in aurpkgs:
-                pm.msg(_('cloning {0}').format(pkg.packagebase), True)
-                clone(pkg.packagebase)
-
-        print(_('Successfully fetched: ') + ' '.join(pkgnames))
+            # Split packages share a repository, clone it only once.
+            pkgbases = collections.OrderedDict(
+                (pkg.packagebase, pkg) for pkg in aurpkgs)
+            basedir = os.path.abspath(destdir or os.curdir)
+            check_checkouts({os.path.join(basedir, pkgbase): pkg
+                             for pkgbase, pkg in pkgbases.items()},
+                            session=ds)
+            pool = pkgbuilder.fetch.FetchPool(session=ds)
+            pool.run([(pkgbase, functools.partial(
+                fetch_aur, pkg, destdir, quiet=True, session=ds))
+                for pkgbase, pkg in pkgbases.items()])
+            failed += [pkg.name for pkg in aurpkgs
+                       if pkg.packagebase in pool.errors]
+
+        fetched = [name for name in pkgnames if name not in failed]
+        if fetched:
+            print(_('Successfully fetched: ') + ' '.join(fetched))
+        if failed:
+            print(':: ERROR: ' + _('Failed to fetch: ') + ' '.join(failed))
+            exit(1)
     except pkgbuilder.exceptions.PBException as e:
         print(':: ERROR: ' + str(e.msg))
         exit(1)
 
 
 def build_runner(pkgname, performdepcheck=True,
-                 pkginstall=True):
+                 pkginstall=True, destdir=None, session=None):
     """A build function, which actually links to others.
 
     DO NOT use it unless you re-implement auto_build!
 
+    .. versionchanged:: 4.3.0
+       Packages are fetched into and built in `destdir` (default: current
+       directory) without changing the working directory.
     """
-    pkg = None
-    try:
-        pkg = pkgbuilder.utils.info([pkgname])[0]
-    except IndexError:
-        DS.log.info('{0} not found in the AUR, checking in repositories'.format(
-            pkgname))
-        syncpkgs = []
-        for j in [i.pkgcache for i in DS.pyc.get_syncdbs()]:
-            syncpkgs.append(j)
-        syncpkgs = functools.reduce(lambda x, y: x + y, syncpkgs)
-        abspkg = pyalpm.find_satisfier(syncpkgs, pkgname)
-        if abspkg:  # abspkg can be None or a pyalpm.Package object.
-            pkg = pkgbuilder.package.ABSPackage.from_pyalpm(abspkg)
-            subpackages = [pkg.name]  # no way to get it
-    if not pkg:
-        raise pkgbuilder.exceptions.PackageNotFoundError(pkgname, 'build')
-
-    DS.fancy_msg(_('Building {0}...').format(pkg.name))
+    ds = session or DS
+    destdir = os.path.abspath(destdir or os.curdir)
+    pkg = find_package(pkgname, session=ds)
+
+    ds.fancy_msg(_('Building {0}...').format(pkg.name))
     pkgbuilder.utils.print_package_search(pkg,
-                                          prefix=DS.colors['blue'] +
-                                          '  ->' + DS.colors['all_off'] +
-                                          DS.colors['bold'] + ' ',
-                                          prefixp='  -> ')
-    sys.stdout.write(DS.colors['all_off'])
+                                          prefix=ds.colors['blue'] +
+                                          '  ->' + ds.colors['all_off'] +
+                                          ds.colors['bold'] + ' ',
+                                          prefixp='  -> ', session=ds)
+    print(ds.colors['all_off'], end='', file=ds.stream)
     if pkg.is_abs:
-        DS.fancy_msg(_('Retrieving from ASP...'))
-        rc = asp_export(pkg)
-        if rc > 0:
-            raise pkgbuilder.exceptions.NetworkError(
-                _('Failed to retieve {0} (from ASP).').format(
-                    pkg.name), source='asp', pkg=pkg, retcode=rc)
-
-        existing = find_packagefile(pkg.name)
-        if any(pkg.name in i for i in existing[0]):
-            DS.fancy_msg(_('Found an existing package for '
+        ds.fancy_msg(_('Retrieving from ASP...'))
+        path = _export_asp(pkg, destdir, False, session=ds)
+
+        existing = select_packagefiles(
+            find_packagefile(path, pkginstall, session=ds), [pkg.name],
+            pkg.version)
+        if existing[0]:
+            ds.fancy_msg(_('Found an existing package for '
                            '{0}').format(pkgname))
             if not pkginstall:
                 existing = ([], [])
             return [72336, existing]
-        try:
-            os.chdir('./{0}'.format(pkg.name))
-        except FileNotFoundError:
-            raise pkgbuilder.exceptions.PBException(
-                'The package download failed.\n    This package might '
-                'be generated from a split PKGBUILD.  Please find out the '
-                'name of the “main” package (eg. python- instead of python2-) '
-                'and try again.', pkg.name, exit=False)
 
-        if not os.path.exists('.SRCINFO'):
+        if not os.path.exists(os.path.join(path, '.SRCINFO')):
             # Create a .SRCINFO file for ASP/repo packages.
             # Slightly hacky, but saves us work on parsing bash.
-            DS.log.debug("Creating .SRCINFO for repository package")
-            srcinfo = subprocess.check_output(["makepkg", "--printsrcinfo"])
-            with open(".SRCINFO", "wb") as fh:
-                fh.write(srcinfo)
+            ds.log.debug("Creating .SRCINFO for repository package")
+            ds.srcinfo_cache.generate(path)
     else:
-        existing = find_packagefile(pkg.packagebase)
-        if any(pkg.name in i for i in existing[0]):
-            DS.fancy_msg(_('Found an existing package for '
+        path = os.path.join(destdir, pkg.packagebase)
+        existing = select_packagefiles(
+            find_packagefile(path, pkginstall, session=ds), [pkg.name],
+            pkg.version)
+        if existing[0]:
+            ds.fancy_msg(_('Found an existing package for '
                            '{0}').format(pkgname))
             if not pkginstall:
                 existing = ([], [])
             return [72336, existing]
-        DS.fancy_msg(_('Cloning the git repository...'))
-        clone(pkg.packagebase)
-        os.chdir('./{0}/'.format(pkg.packagebase))
-        if not os.path.exists('.SRCINFO'):
+        ds.fancy_msg(_('Cloning the git repository...'))
+        fetch_aur(pkg, destdir, session=ds)
+        if not os.path.exists(os.path.join(path, '.SRCINFO')):
             raise pkgbuilder.exceptions.EmptyRepoError(pkg.packagebase)
-    subpackages = find_subpackages(os.path.abspath('./.SRCINFO'))
+    srcinfo_path = os.path.join(path, '.SRCINFO')
+    subpackages = find_subpackages(srcinfo_path, session=ds)
 
     if performdepcheck:
-        DS.fancy_msg(_('Checking dependencies...'))
-        depends = prepare_deps(os.path.abspath('./.SRCINFO'))
-        deps = depcheck(depends, pkg)
-        pkgtypes = [_('found in system'), _('found in repos'),
-                    _('found in the AUR')]
-        aurbuild = []
-        if not deps:
-            DS.fancy_msg2(_('none found'))
-
-        for dpkg, pkgtype in deps.items():
-            if pkgtype == 2 and dpkg not in subpackages:
-                # If we didn’t check for subpackages, we would get an infinite
-                # loop if subpackages depended on each other
-                aurbuild.append(dpkg)
-            elif dpkg in subpackages:
-                DS.log.debug("Package depends on itself, ignoring")
-
-            DS.fancy_msg2(': '.join((dpkg, pkgtypes[pkgtype])))
+        ds.fancy_msg(_('Checking dependencies...'))
+        depends = prepare_deps(srcinfo_path, session=ds)
+        aurbuild = check_deps(depends, pkg, subpackages, session=ds)[0]
         if aurbuild != []:
-            os.chdir('../')
             return [72337, aurbuild]
 
-    mpparams = ['makepkg', '-sf']
-
-    if DS.clean:
-        mpparams.append('-c')
-
-    if not DS.pgpcheck:
-        mpparams.append('--skippgpcheck')
-
-    if not DS.confirm:
-        mpparams.append('--noconfirm')
-
-    if not DS.depcheck:
-        mpparams.append('--nodeps')
-
-    if not DS.colors_status:
-        mpparams.append('--nocolor')
-
-    DS.log.info("Running makepkg: {0}".format(mpparams))
-    mpstatus = subprocess.call(mpparams, shell=False)
-    DS.log.info("makepkg status: {0}".format(mpstatus))
+    mpparams = makepkg_params(session=ds)
+    node = pkgbuilder.plan.BuildNode(pkg)
+    node.path = path
+    mpstatus = _run_makepkg(node, mpparams, env=makepkg_env(pkginstall, session=ds),
+                            session=ds)
 
     if pkginstall:
-        toinstall = find_packagefile(os.getcwd())
+        toinstall = select_packagefiles(
+            find_packagefile(path, pkginstall, session=ds), [pkg.name])
     else:
         toinstall = ([], [])
 
-    if pkg.is_abs:
-        os.chdir('../../')
-    else:
-        os.chdir('../')
-
-    DS.log.info("Found package files: {0}".format(toinstall))
+    ds.log.info("Found package files: {0}".format(toinstall))
 
     return [mpstatus, toinstall]
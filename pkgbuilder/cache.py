@@ -0,0 +1,564 @@
+# -*- encoding: utf-8 -*-
+# PKGBUILDer v4.2.18
+# An AUR helper (and library) in Python 3.
+# Copyright © 2011-2018, Chris Warrick.
+# See /LICENSE for licensing information.
+
+"""
+Caches for data derived from package files, for git repositories, and for
+built packages.
+
+.. versionadded:: 4.3.0
+
+:Copyright: © 2011-2018, Chris Warrick.
+:License: BSD (see /LICENSE).
+"""
+
+import collections
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import srcinfo.parse
+
+__all__ = ('file_digest', 'SrcinfoCache', 'MirrorStore', 'BuildCache',
+           'PacmanCacheIndex')
+
+
+def file_digest(path):
+    """Return the SHA-256 hex digest of a file."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _tmpname(path):
+    """Return a temporary name for writing `path`.
+
+    The name is unique to the host, process and thread, so that writers on
+    a shared filesystem never use the same temporary file.
+    """
+    return '{0}.{1}.{2}.{3}.tmp'.format(path, socket.gethostname(),
+                                        os.getpid(), threading.get_ident())
+
+
+class _CacheLock(object):
+    """A shared/exclusive lock on a cache directory.
+
+    ``lockf`` locks belong to the process: they do not exclude the threads
+    of one process from each other, and unlocking from any thread drops the
+    lock of the whole process.  Threads are therefore coordinated here, and
+    the ``lockf`` lock is taken by the first thread that enters and released
+    by the last one that leaves.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._fh = None
+
+    @contextlib.contextmanager
+    def hold(self, exclusive=False):
+        """Hold the lock (shared, unless `exclusive`)."""
+        with self._cond:
+            if exclusive:
+                self._cond.wait_for(lambda: not (self._writer or
+                                                 self._readers))
+                self._writer = True
+            else:
+                self._cond.wait_for(lambda: not self._writer)
+                self._readers += 1
+            if self._fh is None:
+                # Other threads wait for the lock of other processes, too.
+                try:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    self._fh = open(self.path, 'a+')
+                    fcntl.lockf(self._fh, fcntl.LOCK_EX if exclusive
+                                else fcntl.LOCK_SH)
+                except BaseException:
+                    self._release(exclusive)
+                    raise
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._release(exclusive)
+
+    def _release(self, exclusive):
+        """Leave the lock (with the condition held)."""
+        if exclusive:
+            self._writer = False
+        else:
+            self._readers -= 1
+        if not (self._writer or self._readers) and self._fh is not None:
+            try:
+                fcntl.lockf(self._fh, fcntl.LOCK_UN)
+            finally:
+                self._fh.close()
+                self._fh = None
+        self._cond.notify_all()
+
+
+_cache_locks = {}
+_cache_locks_lock = threading.Lock()
+
+
+def _cache_lock(path):
+    """Return the lock of the cache in `path`, shared by the process."""
+    path = os.path.abspath(path)
+    with _cache_locks_lock:
+        if path not in _cache_locks:
+            _cache_locks[path] = _CacheLock(os.path.join(path, 'lock'))
+        return _cache_locks[path]
+
+
+class SrcinfoCache(object):
+    """Parsed .SRCINFO files, keyed by the hash of their contents.
+
+    A file whose mtime and size did not change since the last lookup is not
+    read again.  Otherwise, it is hashed, and only parsed if no file with the
+    same contents was parsed before.
+
+    Generated .SRCINFO files (for repository packages, which don’t ship one)
+    are stored in `cachedir`, keyed by the hash of the PKGBUILD they were
+    generated from.
+
+    The cache is thread-safe, so sessions may share it (see
+    :class:`pkgbuilder.pbds.Session`).
+
+    .. note:: The parsed data is shared between callers.  Do not modify it.
+    """
+
+    def __init__(self, cachedir=None):
+        """Initialize a cache.
+
+        :param str cachedir: directory for generated .SRCINFO files (None:
+                             do not store them)
+        """
+        self.cachedir = cachedir
+        self._stat = {}
+        self._parsed = {}
+        self._packagelists = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Return the representation of a cache."""
+        return '<SrcinfoCache ({0} parsed)>'.format(len(self._parsed))
+
+    def digest(self, path):
+        """Return the content hash of a file, using mtime as a fast check."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._stat.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        digest = file_digest(path)
+        with self._lock:
+            self._stat[path] = (key, digest)
+        return digest
+
+    def parse(self, path):
+        """Parse a .SRCINFO file.
+
+        :return: ``(data, errors)``, like ``srcinfo.parse.parse_srcinfo``
+        """
+        digest = self.digest(path)
+        with self._lock:
+            if digest in self._parsed:
+                return self._parsed[digest], []
+
+        with open(path, encoding='utf-8') as fh:
+            raw = fh.read()
+
+        data, errors = srcinfo.parse.parse_srcinfo(raw)
+        if not errors:
+            with self._lock:
+                self._parsed[digest] = data
+        return data, errors
+
+    def packagelist(self, pkgdir, pkgext=None):
+        """Return the paths of the package files makepkg builds in `pkgdir`.
+
+        The output of ``makepkg --packagelist`` is cached by the hashes of
+        the PKGBUILD and .SRCINFO files.
+
+        :param str pkgext: ``PKGEXT`` for makepkg (None: from makepkg.conf)
+        :raises subprocess.CalledProcessError: if makepkg fails
+        """
+        pkgdir = os.path.abspath(pkgdir)
+        key = [pkgdir, pkgext, self.digest(os.path.join(pkgdir, 'PKGBUILD'))]
+        srcinfo_path = os.path.join(pkgdir, '.SRCINFO')
+        if os.path.exists(srcinfo_path):
+            key.append(self.digest(srcinfo_path))
+        key = tuple(key)
+        with self._lock:
+            if key in self._packagelists:
+                return self._packagelists[key]
+
+        env = None
+        if pkgext is not None:
+            env = os.environ.copy()
+            env['PKGEXT'] = pkgext
+        out = subprocess.check_output(['makepkg', '--packagelist'],
+                                      cwd=pkgdir, env=env,
+                                      stderr=subprocess.DEVNULL)
+        # makepkg prints absolute paths (in PKGDEST); join() keeps them.
+        paths = [os.path.join(pkgdir, line) for line in
+                 out.decode('utf-8').splitlines() if line.strip()]
+        with self._lock:
+            self._packagelists[key] = paths
+        return paths
+
+    def generate(self, pkgdir):
+        """Create a .SRCINFO file for the PKGBUILD in `pkgdir`.
+
+        ``makepkg --printsrcinfo`` is only run if there is no .SRCINFO for an
+        identical PKGBUILD in the cache.
+
+        :return: path to the new .SRCINFO file
+        """
+        srcinfo_path = os.path.join(pkgdir, '.SRCINFO')
+        if self.cachedir is None:
+            cached = None
+        else:
+            digest = self.digest(os.path.join(pkgdir, 'PKGBUILD'))
+            cached = os.path.join(self.cachedir, 'srcinfo', digest)
+
+        if cached is not None and os.path.exists(cached):
+            shutil.copyfile(cached, srcinfo_path)
+            return srcinfo_path
+
+        data = subprocess.check_output(['makepkg', '--printsrcinfo'],
+                                       cwd=pkgdir)
+        with open(srcinfo_path, 'wb') as fh:
+            fh.write(data)
+
+        if cached is not None:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            # Write and rename, so concurrent readers never see half a file.
+            tmp = _tmpname(cached)
+            with open(tmp, 'wb') as fh:
+                fh.write(data)
+            os.replace(tmp, cached)
+        return srcinfo_path
+
+
+class MirrorStore(object):
+    """Bare mirrors of git repositories, one per package base.
+
+    Mirrors are fetched incrementally.  Checkouts are cloned from them
+    locally, either shallow, or with ``--reference --dissociate``, so that
+    they never depend on the mirror once cloned.
+
+    The store may be shared by several processes or machines (eg. on NFS):
+    every mirror is locked while it is updated, and new mirrors appear
+    atomically.
+    """
+
+    def __init__(self, path):
+        """Initialize a store.
+
+        :param str path: directory for the mirrors
+        """
+        self.path = path
+
+    def __repr__(self):
+        """Return the representation of a store."""
+        return '<MirrorStore {0}>'.format(self.path)
+
+    def mirror_path(self, pkgbase):
+        """Return the path of the mirror for `pkgbase`."""
+        return os.path.join(self.path, pkgbase + '.git')
+
+    @contextlib.contextmanager
+    def _locked(self, pkgbase):
+        """Hold an exclusive lock on the mirror for `pkgbase`."""
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.mirror_path(pkgbase) + '.lock', 'a') as fh:
+            fcntl.lockf(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(fh, fcntl.LOCK_UN)
+
+    def update(self, pkgbase, url, lastmodified=None, quiet=False):
+        """Create or update the mirror for `pkgbase`.
+
+        :param str url: URL of the upstream repository
+        :param int lastmodified: upstream modification time; if it matches
+                                 the one recorded in the mirror, the mirror
+                                 is not fetched
+        :param bool quiet: whether to silence git
+        :return: path to the mirror
+        :raises subprocess.CalledProcessError: if git fails
+        """
+        mirror = self.mirror_path(pkgbase)
+        quietargs = ['--quiet'] if quiet else []
+        with self._locked(pkgbase):
+            if os.path.exists(mirror):
+                recorded = subprocess.run(
+                    ['git', 'config', '--get', 'pkgbuilder.lastmodified'],
+                    cwd=mirror, stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL).stdout.strip()
+                if (lastmodified is not None and
+                        recorded == str(lastmodified).encode('ascii')):
+                    return mirror
+                subprocess.check_call(['git', 'fetch', '--prune'] +
+                                      quietargs, cwd=mirror)
+            else:
+                # Clone and rename, so a failed clone leaves nothing behind.
+                tmp = '{0}.{1}'.format(mirror, os.getpid())
+                shutil.rmtree(tmp, ignore_errors=True)
+                subprocess.check_call(['git', 'clone', '--mirror'] +
+                                      quietargs + [url, tmp])
+                os.rename(tmp, mirror)
+            if lastmodified is not None:
+                subprocess.check_call(['git', 'config',
+                                       'pkgbuilder.lastmodified',
+                                       str(lastmodified)], cwd=mirror)
+        return mirror
+
+    def checkout(self, pkgbase, path, url, quiet=False, depth=None):
+        """Clone the mirror for `pkgbase` to `path`.
+
+        The checkout is self-contained (objects are copied or hard linked,
+        never borrowed through alternates), so removing the mirror does not
+        break it.  The ``origin`` remote of the checkout is set to `url`.
+
+        :param int depth: history depth of the checkout (None: full)
+        :raises subprocess.CalledProcessError: if git fails
+        """
+        quietargs = ['--quiet'] if quiet else []
+        mirror = self.mirror_path(pkgbase)
+        if depth:
+            # Shallow clones of local repositories need a file:// URL.
+            cloneargs = ['--depth', str(depth), 'file://' + mirror]
+        else:
+            cloneargs = ['--reference', mirror, '--dissociate', mirror]
+        subprocess.check_call(['git', 'clone'] + quietargs + cloneargs +
+                              [path])
+        subprocess.check_call(['git', 'remote', 'set-url', 'origin', url],
+                              cwd=path)
+
+
+class BuildCache(object):
+    """Built package files, keyed by a hash of the inputs of the build.
+
+    Package files are stored once, by the hash of their contents, in
+    ``objects/``.  Every key has an entry in ``keys/``, which maps file
+    names to content hashes.  Entries are used in LRU order (their mtime is
+    updated on every hit); when the stored files take more than `maxsize`
+    bytes, the least recently used entries, and files no longer referenced,
+    are removed.
+
+    Files and entries are written to temporary files and renamed into
+    place, so readers never see partial files, and the cache may be shared
+    by several processes or machines (e.g. on NFS).  Writers and readers
+    hold a shared lock, and eviction an exclusive one, so that files are
+    not removed while they are being stored or restored, by other processes
+    or by other threads of this one.
+    """
+
+    def __init__(self, path, maxsize=None):
+        """Initialize a cache.
+
+        :param str path: directory for the cache
+        :param int maxsize: maximum size of stored files, in bytes (None:
+                            unlimited)
+        """
+        self.path = path
+        self.maxsize = maxsize
+
+    def __repr__(self):
+        """Return the representation of a cache."""
+        return '<BuildCache {0}>'.format(self.path)
+
+    def _object(self, digest):
+        """Return the path of the stored file with hash `digest`."""
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def _entry(self, key):
+        """Return the path of the entry for `key`."""
+        return os.path.join(self.path, 'keys', key + '.json')
+
+    def _locked(self, exclusive=False):
+        """Hold a lock on the cache (shared, unless `exclusive`)."""
+        return _cache_lock(self.path).hold(exclusive)
+
+    @staticmethod
+    def _place(src, dest):
+        """Hard link (or copy) `src` to `dest`, atomically."""
+        tmp = _tmpname(dest)
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+        # rename() does nothing if both names are links to the same file
+        # (another writer linked the same source first).
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+
+    def lookup(self, key, destdir):
+        """Restore the files stored for `key` into `destdir`.
+
+        :return: paths of the restored files, or None if there are none
+        :rtype: list
+        """
+        entry = self._entry(key)
+        try:
+            with open(entry, encoding='utf-8') as fh:
+                files = json.load(fh)['files']
+        except (OSError, ValueError, KeyError):
+            return None
+
+        paths = []
+        with self._locked():
+            if not all(os.path.exists(self._object(d))
+                       for d in files.values()):
+                return None
+            os.makedirs(destdir, exist_ok=True)
+            for name, digest in sorted(files.items()):
+                dest = os.path.join(destdir, name)
+                if not os.path.exists(dest):
+                    self._place(self._object(digest), dest)
+                paths.append(dest)
+            try:
+                os.utime(entry)
+            except OSError:
+                pass
+        return paths
+
+    def store(self, key, paths):
+        """Store `paths` (package and signature files) for `key`."""
+        files = {}
+        with self._locked():
+            for path in paths:
+                digest = file_digest(path)
+                obj = self._object(digest)
+                if not os.path.exists(obj):
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    self._place(path, obj)
+                files[os.path.basename(path)] = digest
+
+            # The entry is published last, by rename: concurrent writers of
+            # the same key store the same files, and the last one wins.
+            entry = self._entry(key)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            tmp = _tmpname(entry)
+            with open(tmp, 'w', encoding='utf-8') as fh:
+                json.dump({'files': files}, fh)
+            os.replace(tmp, entry)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits.
+
+        :return: number of removed entries
+        """
+        if self.maxsize is None:
+            return 0
+        with self._locked(exclusive=True):
+            return self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries (with the lock held)."""
+        keydir = os.path.join(self.path, 'keys')
+        entries = []
+        for name in os.listdir(keydir) if os.path.isdir(keydir) else []:
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(keydir, name)
+            try:
+                with open(path, encoding='utf-8') as fh:
+                    digests = set(json.load(fh)['files'].values())
+                entries.append((os.stat(path).st_mtime, path, digests))
+            except (OSError, ValueError, KeyError):
+                continue
+        entries.sort()
+
+        sizes = {}
+        for _mtime, _path, digests in entries:
+            for digest in digests:
+                if digest not in sizes:
+                    try:
+                        sizes[digest] = os.stat(self._object(digest)).st_size
+                    except OSError:
+                        sizes[digest] = 0
+
+        refs = collections.Counter()
+        for _mtime, _path, digests in entries:
+            refs.update(digests)
+        total = sum(sizes.values())
+        removed = 0
+        for _mtime, path, digests in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # Evicted by someone else.
+                pass
+            removed += 1
+            for digest in digests:
+                refs[digest] -= 1
+                if refs[digest] == 0:
+                    total -= sizes[digest]
+                    try:
+                        os.unlink(self._object(digest))
+                    except OSError:
+                        pass
+        return removed
+
+
+class PacmanCacheIndex(object):
+    """An index of the file names in the pacman package cache.
+
+    A directory is listed again only if its mtime changed (which happens
+    whenever a file is added to it or removed from it), so lookups are set
+    lookups most of the time.
+    """
+
+    def __init__(self, cachedirs=('/var/cache/pacman/pkg/',)):
+        """Initialize an index.
+
+        :param list cachedirs: pacman cache directories, in order of
+                               preference
+        """
+        self.cachedirs = list(cachedirs)
+        self._listings = {}
+
+    def __repr__(self):
+        """Return the representation of an index."""
+        return '<PacmanCacheIndex {0}>'.format(', '.join(self.cachedirs))
+
+    def names(self, cachedir):
+        """Return the file names in `cachedir` (a set)."""
+        try:
+            mtime = os.stat(cachedir).st_mtime_ns
+        except OSError:
+            return set()
+        cached = self._listings.get(cachedir)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, set(os.listdir(cachedir)))
+            self._listings[cachedir] = cached
+        return cached[1]
+
+    def find(self, filename):
+        """Return the path of `filename` in the cache, or None."""
+        for cachedir in self.cachedirs:
+            if filename in self.names(cachedir):
+                return os.path.join(cachedir, filename)
+        return None
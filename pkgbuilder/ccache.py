@@ -0,0 +1,170 @@
+# -*- encoding: utf-8 -*-
+# PKGBUILDer v4.2.18
+# An AUR helper (and library) in Python 3.
+# Copyright © 2011-2018, Chris Warrick.
+# See /LICENSE for licensing information.
+
+"""
+Compiler caches (ccache and sccache) for builds.
+
+.. versionadded:: 4.3.0
+
+:Copyright: © 2011-2018, Chris Warrick.
+:License: BSD (see /LICENSE).
+"""
+
+from . import DS, _
+import collections
+import contextlib
+import json
+import os
+import subprocess
+import tempfile
+import threading
+
+__all__ = ('CompilerCache', 'TOOLS')
+
+#: supported compiler caches
+TOOLS = ('ccache', 'sccache')
+#: directory with ccache compiler wrappers (from the ccache package)
+CCACHE_WRAPPERS = '/usr/lib/ccache/bin'
+
+
+class CompilerCache(object):
+    """A compiler cache shared by all builds of a user.
+
+    With ccache, the compiler wrappers are put first in ``PATH``, as makepkg
+    does with ``BUILDENV=(ccache)``.  With sccache, it is used as
+    ``RUSTC_WRAPPER``.  The cache is kept in `path`, up to `maxsize`.
+
+    Hits and misses are counted for every build: ccache writes them to a
+    statistics log of the build; for sccache, the server statistics before
+    and after the build are compared (so the numbers are shared between
+    builds that run at the same time).
+
+    Package bases opt out with ``!ccache`` (or ``!sccache``) in their
+    ``options``, or by being listed in `optout`.
+    """
+
+    def __init__(self, tool, path, maxsize=None, optout=(), session=None):
+        """Initialize a compiler cache.
+
+        :param str tool: ``ccache`` or ``sccache``
+        :param str path: directory for the cache
+        :param int maxsize: maximum size of the cache, in MiB (None: the
+                            tool’s default)
+        :param optout: package bases to build without the cache
+        :param PBDS session: session to use (default: ``DS``)
+        """
+        if tool not in TOOLS:
+            raise ValueError('Unknown compiler cache: {0}'.format(tool))
+        self.tool = tool
+        self.path = path
+        self.maxsize = maxsize
+        self.optout = set(optout)
+        self.ds = session or DS
+        #: ``(hits, misses)`` of every build, by package base
+        self.stats = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Return the representation of a compiler cache."""
+        return '<CompilerCache {0} in {1}>'.format(self.tool, self.path)
+
+    def enabled_for(self, pkgbase, options=()):
+        """Check if `pkgbase` (with PKGBUILD `options`) uses the cache."""
+        return (pkgbase not in self.optout and '!ccache' not in options and
+                '!' + self.tool not in options)
+
+    def environment(self, env=None, statslog=None):
+        """Return `env` (default: ``os.environ``) set up for the cache."""
+        env = dict(os.environ if env is None else env)
+        if self.tool == 'ccache':
+            env['PATH'] = CCACHE_WRAPPERS + os.pathsep + env.get('PATH', '')
+            env['CCACHE_DIR'] = self.path
+            if self.maxsize:
+                env['CCACHE_MAXSIZE'] = '{0}M'.format(self.maxsize)
+            if statslog is not None:
+                env['CCACHE_STATSLOG'] = statslog
+        else:
+            env['RUSTC_WRAPPER'] = 'sccache'
+            env['SCCACHE_DIR'] = self.path
+            if self.maxsize:
+                env['SCCACHE_CACHE_SIZE'] = '{0}M'.format(self.maxsize)
+        return env
+
+    @staticmethod
+    def read_statslog(path):
+        """Count hits and misses in a ccache statistics log.
+
+        :return: ``(hits, misses)``
+        """
+        hits = misses = 0
+        try:
+            with open(path, encoding='utf-8', errors='replace') as fh:
+                for line in fh:
+                    line = line.strip()
+                    if line.endswith('cache_hit'):
+                        hits += 1
+                    elif line == 'cache_miss':
+                        misses += 1
+        except OSError:
+            pass
+        return hits, misses
+
+    def _sccache_counts(self, env):
+        """Return the hits and misses counted by the sccache server."""
+        try:
+            out = subprocess.check_output(
+                ['sccache', '--show-stats', '--stats-format=json'], env=env,
+                stderr=subprocess.DEVNULL)
+            stats = json.loads(out.decode('utf-8'))['stats']
+            return (sum(stats['cache_hits']['counts'].values()),
+                    sum(stats['cache_misses']['counts'].values()))
+        except (OSError, subprocess.CalledProcessError, ValueError,
+                KeyError, TypeError, AttributeError) as e:
+            self.ds.log.warning('Cannot read sccache stats: {0}'.format(e))
+            return None
+
+    @contextlib.contextmanager
+    def build(self, pkgbase, env=None):
+        """Use the cache for a build of `pkgbase`.
+
+        :return: a context manager that gives the environment for makepkg;
+                 hits and misses are stored in :attr:`stats` on exit
+        """
+        os.makedirs(self.path, exist_ok=True)
+        if self.tool == 'ccache':
+            fd, statslog = tempfile.mkstemp(prefix='pkgbuilder-ccache-',
+                                            suffix='.log')
+            os.close(fd)
+            try:
+                yield self.environment(env, statslog)
+                counts = self.read_statslog(statslog)
+            finally:
+                os.unlink(statslog)
+        else:
+            env = self.environment(env)
+            before = self._sccache_counts(env)
+            yield env
+            after = self._sccache_counts(env)
+            if before is None or after is None:
+                return
+            counts = (after[0] - before[0], after[1] - before[1])
+
+        with self._lock:
+            self.stats[pkgbase] = counts
+        self.ds.log.info('{0} for {1}: {2} hits, {3} misses'.format(
+            self.tool, pkgbase, *counts))
+
+    def report(self):
+        """Display hits and misses of the builds so far."""
+        if not self.stats:
+            return
+        hits = sum(h for h, m in self.stats.values())
+        misses = sum(m for h, m in self.stats.values())
+        self.ds.fancy_msg(_('Compiler cache ({0}): {1} hits, {2} '
+                            'misses').format(self.tool, hits, misses))
+        for pkgbase, (hits, misses) in self.stats.items():
+            self.ds.fancy_msg2(_('{0}: {1} hits, {2} misses').format(
+                pkgbase, hits, misses))
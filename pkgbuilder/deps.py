@@ -0,0 +1,177 @@
+# -*- encoding: utf-8 -*-
+# PKGBUILDer v4.2.18
+# An AUR helper (and library) in Python 3.
+# Copyright © 2011-2018, Chris Warrick.
+# See /LICENSE for licensing information.
+
+"""
+Dependency satisfaction helpers.
+
+.. versionadded:: 4.3.0
+
+:Copyright: © 2011-2018, Chris Warrick.
+:License: BSD (see /LICENSE).
+"""
+
+import collections
+import functools
+import re
+import pyalpm
+
+__all__ = ('DBIndex', 'DepSpec', 'IndexedPackage', 'parse_depspec',
+           'parse_version', 'vercmp')
+
+# name, then an optional operator and version.  Operators are matched
+# loosely (any run of <, =, >), just like makepkg does it.  The version is
+# split into [epoch:]pkgver[-pkgrel] in the same pass.
+_DEPSPEC_RE = re.compile(
+    r'^(?P<name>[^<>=]+)'
+    r'(?:(?P<op>[<>=]+)'
+    r'(?P<version>(?:(?P<epoch>\d+):)?(?P<pkgver>.+?)'
+    r'(?:-(?P<pkgrel>[^-]+))?)?)?$')
+_VERSION_RE = re.compile(
+    r'^(?:(?P<epoch>\d+):)?(?P<pkgver>.+?)(?:-(?P<pkgrel>[^-]+))?$')
+
+
+@functools.lru_cache(maxsize=16384)
+def vercmp(a, b):
+    """Compare two versions with ``pyalpm.vercmp``, memoising the result.
+
+    :return: -1 if `a` is older, 0 if they are equal, 1 if `a` is newer
+    :rtype: int
+    """
+    return pyalpm.vercmp(a, b)
+
+
+def parse_version(version):
+    """Split a version into its ``(epoch, pkgver, pkgrel)`` components.
+
+    Missing components are returned as None.
+    """
+    m = _VERSION_RE.match(version)
+    if m is None:
+        return (None, version, None)
+    return m.group('epoch', 'pkgver', 'pkgrel')
+
+
+class DepSpec(collections.namedtuple(
+        'DepSpec', 'name op version epoch pkgver pkgrel')):
+    """A parsed dependency specification, eg. ``foo>=1:2.0-3``.
+
+    Use :func:`parse_depspec` to create instances.  For unversioned
+    dependencies, all fields except `name` are None.
+    """
+
+    __slots__ = ()
+
+    def __str__(self):
+        """Return the specification as a string."""
+        if self.version is None:
+            return self.name
+        return self.name + self.op + self.version
+
+    def satisfied_by(self, available):
+        """Check if version `available` satisfies this specification.
+
+        If the specification does not have a pkgrel, the pkgrel of
+        `available` is ignored (like pacman does it).
+        """
+        if self.version is None:
+            return True
+        if self.pkgrel is None and '-' in available:
+            available = available.rsplit('-', 1)[0]
+
+        result = vercmp(available, self.version)
+        return (('<' in self.op and result < 0) or
+                ('=' in self.op and result == 0) or
+                ('>' in self.op and result > 0))
+
+
+@functools.lru_cache(maxsize=8192)
+def parse_depspec(spec):
+    """Parse a dependency specification string into a :class:`DepSpec`.
+
+    Results are cached by string.
+    """
+    m = _DEPSPEC_RE.match(spec)
+    if m is None or m.group('version') is None:
+        # No (usable) version requirement.
+        name = re.split('[<>=]', spec, maxsplit=1)[0]
+        return DepSpec(name, None, None, None, None, None)
+    return DepSpec(*m.group('name', 'op', 'version', 'epoch', 'pkgver',
+                            'pkgrel'))
+
+
+#: A package in a :class:`DBIndex`: plain data, not tied to a pyalpm
+#: handle.  `db` is the name of its database.
+IndexedPackage = collections.namedtuple('IndexedPackage',
+                                        'name version provides db')
+
+
+class DBIndex(object):
+    """An index of the local and sync databases.
+
+    Maps package names and ``provides`` entries to the packages that can
+    satisfy them, together with the version they satisfy them with.  The
+    candidates for a name are kept in database order, so lookups prefer the
+    same package ``pyalpm.find_satisfier`` would.
+
+    Building the index costs one pass over every package; afterwards, every
+    lookup is a dict access instead of a linear scan.  An instance is cached
+    on ``DS`` (see :attr:`pkgbuilder.pbds.PBDS.dbindex`) and thrown away
+    whenever pycman is reloaded.
+
+    The index keeps :class:`IndexedPackage` tuples, not pyalpm packages, and
+    is never modified once built, so it may be shared between threads and
+    sessions with different pyalpm handles.
+    """
+
+    def __init__(self, localdb, syncdbs):
+        """Index the packages of `localdb` and `syncdbs`."""
+        self.local = self._index([localdb])
+        self.sync = self._index(syncdbs)
+
+    def __repr__(self):
+        """Return the representation of an index."""
+        return '<DBIndex ({0} local, {1} sync names)>'.format(
+            len(self.local), len(self.sync))
+
+    @staticmethod
+    def _index(dbs):
+        """Build a name → [(package, version)] mapping for `dbs`."""
+        index = {}
+        for db in dbs:
+            for pkg in db.pkgcache:
+                pkg = IndexedPackage(pkg.name, pkg.version,
+                                     tuple(pkg.provides), db.name)
+                index.setdefault(pkg.name, []).append((pkg, pkg.version))
+                for provide in pkg.provides:
+                    # An unversioned provide cannot satisfy a versioned
+                    # dependency, hence the None.
+                    name, _sep, version = provide.partition('=')
+                    index.setdefault(name, []).append((pkg, version or None))
+        return index
+
+    def candidates(self, name, where='local'):
+        """Return all ``(package, version)`` pairs providing `name`.
+
+        :param str name: package or provision name (without version)
+        :param str where: ``'local'`` or ``'sync'``
+        """
+        return getattr(self, where).get(name, [])
+
+    def find_satisfier(self, name, where='local', test=None):
+        """Find the first package that provides `name`.
+
+        :param str name: package or provision name (without version)
+        :param str where: ``'local'`` or ``'sync'``
+        :param test: a callable that takes the provided version and returns
+                     whether it is acceptable (None: any version is fine)
+        :return: an :class:`IndexedPackage`, or None
+        """
+        for pkg, version in self.candidates(name, where):
+            if test is None:
+                return pkg
+            elif version is not None and test(version):
+                return pkg
+        return None
@@ -14,7 +14,8 @@ Defines PKGBUILDer exceptions.
 from . import DS, _
 __all__ = ('PBException', 'AURError', 'MakepkgError', 'NetworkError',
            'ConnectionError', 'HTTPError', 'PackageError',
-           'PackageNotFoundError', 'SanityError', 'CloneError')
+           'PackageNotFoundError', 'SanityError', 'CloneError',
+           'FetchError')
 
 
 class PBException(Exception):
@@ -246,3 +247,26 @@ class EmptyRepoError(CloneError):
         self.exit = exit
         self.args = args
         self.kwargs = kwargs
+
+
+class FetchError(CloneError):
+    """Some package bases could not be fetched.
+
+    .. versionadded:: 4.3.0
+    """
+
+    qualname = 'FetchError'
+
+    def __init__(self, errors, exit=True, *args, **kwargs):
+        """Initialize and log the error.
+
+        :param dict errors: exceptions, by package base
+        """
+        self.errors = errors
+        self.msg = _('Failed to fetch {0}: {1}').format(
+            ', '.join(errors), '; '.join(
+                '{0}: {1}'.format(name, e) for name, e in errors.items()))
+        DS.log.error('({0:<20}) {1}'.format(self.qualname, self.msg))
+        self.exit = exit
+        self.args = args
+        self.kwargs = kwargs
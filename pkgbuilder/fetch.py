@@ -0,0 +1,201 @@
+# -*- encoding: utf-8 -*-
+# PKGBUILDer v4.2.18
+# An AUR helper (and library) in Python 3.
+# Copyright © 2011-2018, Chris Warrick.
+# See /LICENSE for licensing information.
+
+"""
+Fetching many package repositories at once.
+
+.. versionadded:: 4.3.0
+
+:Copyright: © 2011-2018, Chris Warrick.
+:License: BSD (see /LICENSE).
+"""
+
+from . import DS, _
+import pkgbuilder.exceptions
+import pkgbuilder.ui
+import collections
+import concurrent.futures
+import functools
+import subprocess
+
+__all__ = ('FetchPool', 'Prefetcher', 'head_commit', 'ls_remote')
+
+
+def head_commit(path):
+    """Return the commit of HEAD in a git repository (None if unknown)."""
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--verify', '-q',
+                                       'HEAD'], cwd=path,
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('ascii').strip() or None
+
+
+def _remote_head(path, results):
+    """Store the remote HEAD of the repository in `path` in `results`."""
+    try:
+        out = subprocess.check_output(['git', 'ls-remote', 'origin', 'HEAD'],
+                                      cwd=path, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return
+    if out.strip():
+        results[path] = out.split()[0].decode('ascii')
+
+
+def ls_remote(paths, workers=None, session=None):
+    """Find the remote HEAD commits of many git repositories at once.
+
+    The queries run in a :class:`FetchPool`.  They are much cheaper than
+    fetching, and only tell whether a checkout is out of date.
+
+    :param list paths: paths to git repositories (with an ``origin`` remote)
+    :return: remote HEAD commits, by path; repositories that could not be
+             queried are left out
+    :rtype: dict
+    """
+    results = {}
+    pool = FetchPool(workers, progress=False, session=session)
+    pool.run([(path, functools.partial(_remote_head, path, results))
+              for path in paths])
+    return results
+
+
+class FetchPool(object):
+    """Run fetch tasks (clones, pulls, exports) in a pool of worker threads.
+
+    A task that fails does not abort the batch: its exception is stored in
+    :attr:`errors`, and all other tasks still run.  Progress is displayed on
+    a single line of the session’s message stream, updated as tasks finish.
+    """
+
+    def __init__(self, workers=None, progress=True, session=None):
+        """Initialize a pool.
+
+        :param int workers: maximum number of concurrent tasks (default:
+                            ``fetchjobs`` of the session)
+        :param bool progress: whether to display progress
+        :param PBDS session: session to use (default: ``DS``)
+        """
+        self.ds = session or DS
+        self.workers = max(1, workers or self.ds.fetchjobs)
+        self.progress = progress
+        #: exceptions of failed tasks, by task name
+        self.errors = collections.OrderedDict()
+
+    def __repr__(self):
+        """Return the representation of a pool."""
+        return '<FetchPool ({0} workers)>'.format(self.workers)
+
+    def run(self, tasks):
+        """Run `tasks` and wait for all of them to finish.
+
+        :param list tasks: ``(name, callable)`` pairs
+        :return: names of the tasks that succeeded, in order of completion
+        :rtype: list
+        """
+        done = []
+        if not tasks:
+            return done
+
+        pm = (pkgbuilder.ui.Progress(len(tasks), self.ds) if self.progress
+              else None)
+        workers = min(self.workers, len(tasks))
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = {pool.submit(func): name for name, func in tasks}
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    future.result()
+                except (pkgbuilder.exceptions.PBException, OSError,
+                        subprocess.CalledProcessError) as e:
+                    self.errors[name] = e
+                    self.ds.log.error('Fetching {0} failed: {1}'.format(
+                        name, e))
+                    status = _('failed')
+                else:
+                    done.append(name)
+                    status = _('done')
+                if pm is not None:
+                    pm.msg('{0}: {1}'.format(name, status))
+
+        if pm is not None:
+            self.ds.write('\n')
+        for name, e in self.errors.items():
+            self.ds.fancy_error2('{0}: {1}'.format(name, e))
+        return done
+
+
+class Prefetcher(object):
+    """Fetch items in the background, a limited number ahead of their use.
+
+    Items are fetched in order, by a pool of worker threads.  The consumer
+    calls :meth:`wait` for every item, in order, before using it.  Only
+    items up to `lookahead` places after the one being waited for are
+    started, so the consumer applies back-pressure: at most
+    ``lookahead + 1`` fetched items are waiting to be used at any time.
+
+    Use it as a context manager: fetching starts on entering, and items
+    that were not started yet are cancelled on exit.
+    """
+
+    def __init__(self, items, func, lookahead=None, workers=None,
+                 session=None):
+        """Initialize a prefetcher.
+
+        :param list items: items to fetch, in order of use
+        :param func: function called with an item to fetch it (in a worker
+                     thread)
+        :param int lookahead: number of items fetched ahead of the current
+                              one (default: ``lookahead`` of the session)
+        :param int workers: maximum number of concurrent fetches (default:
+                            ``fetchjobs`` of the session)
+        :param PBDS session: session to use (default: ``DS``)
+        """
+        self.ds = session or DS
+        self.items = list(items)
+        self.func = func
+        if lookahead is None:
+            lookahead = self.ds.lookahead
+        self.lookahead = max(0, lookahead)
+        self.workers = max(1, min(workers or self.ds.fetchjobs,
+                                  self.lookahead + 1))
+        self._futures = []
+        self._pool = None
+
+    def __repr__(self):
+        """Return the representation of a prefetcher."""
+        return '<Prefetcher ({0}/{1} started, {2} ahead)>'.format(
+            len(self._futures), len(self.items), self.lookahead)
+
+    def __enter__(self):
+        """Start fetching."""
+        self._pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self._fill(0)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Cancel items that were not started and wait for the others."""
+        for future in self._futures:
+            future.cancel()
+        self._pool.shutdown(wait=True)
+
+    def _fill(self, position):
+        """Start all items up to `lookahead` places after `position`."""
+        end = min(len(self.items), position + 1 + self.lookahead)
+        while len(self._futures) < end:
+            item = self.items[len(self._futures)]
+            self._futures.append(self._pool.submit(self.func, item))
+
+    def wait(self, index):
+        """Wait for the item at `index` to be fetched.
+
+        Items further ahead are started.
+
+        :return: the exception raised while fetching the item, or None
+        """
+        self._fill(index)
+        return self._futures[index].exception()
@@ -13,16 +13,20 @@ PKGBUILDer Data Storage.
 
 from . import _, __version__
 import pkgbuilder
+import pkgbuilder.cache
+import pkgbuilder.deps
 import pkgbuilder.ui
 import sys
 import os
 import logging
+import shutil
 import subprocess
+import threading
 import pycman
 import pkg_resources
 import configparser
 
-__all__ = ('PBDS',)
+__all__ = ('PBDS', 'Session')
 
 
 class PBDS(object):
@@ -50,6 +54,27 @@ class PBDS(object):
     depcheck = True
     vcsupgrade = False
     colors_status = True
+    jobs = 1
+    cores = 0
+    jobserver = True
+    compression = 'default'
+    fetchjobs = 8
+    mirror = False
+    snapshot = False
+    prefetch = True
+    lookahead = 2
+    buildcachesize = 0
+    pacmancache = True
+    buildcachedir = None
+    artifactstore = None
+    tmpfs = False
+    tmpfsdir = None
+    compilercache = None
+    compilercachesize = 5120
+    compilercachedir = None
+    nocompilercache = ()
+    srcdest = None
+    mirrordir = None
     # TRANSLATORS: see makepkg.
     inttext = _('Aborted by user! Exiting...')
     # TRANSLATORS: see pacman.
@@ -61,6 +86,17 @@ class PBDS(object):
     debug = False
     console = None
     _pyc = None
+    _aur = None
+    _mirrors = None
+    _build_cache = None
+    _artifact_store = None
+    _tmpfs_builds = None
+    _compiler_cache = None
+    _pacman_cache = None
+    _dbindex = None
+    _srcinfo_cache = None
+    #: stream for messages (None: ``sys.stderr``)
+    stream = None
 
     hassudo = os.path.exists('/usr/bin/sudo')
 
@@ -75,6 +111,13 @@ class PBDS(object):
     confdir = os.path.join(kwdir, 'pkgbuilder')
     confpath = os.path.join(confdir, 'pkgbuilder.ini')
 
+    # Caches are created on demand.
+    cachehome = os.getenv('XDG_CACHE_HOME')
+    if cachehome is None:
+        cachehome = os.path.expanduser('~/.cache/')
+
+    cachedir = os.path.join(cachehome, 'kwpolska', 'pkgbuilder')
+
     if not os.path.exists(confhome):
         os.mkdir(confhome)
 
@@ -115,6 +158,13 @@ class PBDS(object):
     log = logging.getLogger('pkgbuilder')
     log.info('*** PKGBUILDer v' + __version__)
 
+    def __init__(self):
+        """Initialize the data storage.
+
+        .. versionadded:: 4.3.0
+        """
+        self._lock = threading.RLock()
+
     def get_setting(self, name, config_section, config_option,
                     positive, negative):
         """Get the value of a setting, based on config file and arguments.
@@ -142,12 +192,14 @@ class PBDS(object):
     def _pycreload(self):
         """Reload pycman, without UI fanciness."""
         self._pyc = pycman.config.init_with_config('/etc/pacman.conf')
+        self._dbindex = None
 
     def pycreload(self):
         """Reload pycman."""
         msg = _('Initializing pacman access...')
         with pkgbuilder.ui.Throbber(msg, printback=False):
             self._pyc = pycman.config.init_with_config('/etc/pacman.conf')
+        self._dbindex = None
 
         sys.stdout.write('\r' + ((len(msg) + 4) * ' ') + '\r')
 
@@ -155,10 +207,184 @@ class PBDS(object):
     def pyc(self):
         """Return a pycman handle, initializing one if necessary."""
         if not self._pyc:
-            self.pycreload()
+            with self._lock:
+                if not self._pyc:
+                    self.pycreload()
 
         return self._pyc
 
+    @property
+    def aur(self):
+        """Return an AUR RPC client, creating one if necessary.
+
+        .. versionadded:: 4.3.0
+        """
+        if self._aur is None:
+            # Imported here, as pkgbuilder.aur needs DS to exist.
+            import pkgbuilder.aur
+            with self._lock:
+                if self._aur is None:
+                    self._aur = pkgbuilder.aur.AUR()
+
+        return self._aur
+
+    @property
+    def dbindex(self):
+        """Return an index of the pacman databases, building one if necessary.
+
+        The index is discarded every time pycman is reloaded.
+
+        .. versionadded:: 4.3.0
+        """
+        if self._dbindex is None:
+            with self._lock:
+                if self._dbindex is None:
+                    self._dbindex = pkgbuilder.deps.DBIndex(
+                        self.pyc.get_localdb(), self.pyc.get_syncdbs())
+
+        return self._dbindex
+
+    @property
+    def srcinfo_cache(self):
+        """Return the .SRCINFO cache.
+
+        .. versionadded:: 4.3.0
+        """
+        if self._srcinfo_cache is None:
+            with self._lock:
+                if self._srcinfo_cache is None:
+                    self._srcinfo_cache = pkgbuilder.cache.SrcinfoCache(
+                        self.cachedir)
+
+        return self._srcinfo_cache
+
+    @property
+    def mirrors(self):
+        """Return the git mirror store (None if :attr:`mirror` is off).
+
+        Mirrors are kept in :attr:`mirrordir` (default: ``git`` in the cache
+        directory).
+
+        .. versionadded:: 4.3.0
+        """
+        if not self.mirror:
+            return None
+        if self._mirrors is None:
+            with self._lock:
+                if self._mirrors is None:
+                    self._mirrors = pkgbuilder.cache.MirrorStore(
+                        self.mirrordir or os.path.join(self.cachedir, 'git'))
+
+        return self._mirrors
+
+    @property
+    def build_cache(self):
+        """Return the build cache (None if :attr:`buildcachesize` is 0).
+
+        The cache is kept in :attr:`buildcachedir` (default: ``builds`` in
+        the cache directory) and holds up to :attr:`buildcachesize` MiB.
+
+        .. versionadded:: 4.3.0
+        """
+        if not self.buildcachesize:
+            return None
+        if self._build_cache is None:
+            with self._lock:
+                if self._build_cache is None:
+                    self._build_cache = pkgbuilder.cache.BuildCache(
+                        self.buildcachedir or os.path.join(self.cachedir,
+                                                           'builds'),
+                        self.buildcachesize * 1024 * 1024)
+
+        return self._build_cache
+
+    @property
+    def artifact_store(self):
+        """Return the shared artifact store (None if not configured).
+
+        The store is a :class:`pkgbuilder.cache.BuildCache` in
+        :attr:`artifactstore`, meant to be shared by many build hosts
+        (e.g. on NFS).  It is never pruned automatically.
+
+        .. versionadded:: 4.3.0
+        """
+        if not self.artifactstore:
+            return None
+        if self._artifact_store is None:
+            with self._lock:
+                if self._artifact_store is None:
+                    self._artifact_store = pkgbuilder.cache.BuildCache(
+                        self.artifactstore)
+
+        return self._artifact_store
+
+    @property
+    def tmpfs_builds(self):
+        """Return tmpfs build directories (None if :attr:`tmpfs` is off).
+
+        Builds are done in :attr:`tmpfsdir` (default: ``/dev/shm``), in a
+        ``pkgbuilder-UID`` directory.
+
+        .. versionadded:: 4.3.0
+        """
+        if not self.tmpfs:
+            return None
+        if self._tmpfs_builds is None:
+            with self._lock:
+                if self._tmpfs_builds is None:
+                    import pkgbuilder.tmpfs
+                    self._tmpfs_builds = pkgbuilder.tmpfs.TmpfsBuilds(
+                        os.path.join(self.tmpfsdir or '/dev/shm',
+                                     'pkgbuilder-{0}'.format(self.uid)),
+                        os.path.join(self.cachedir, 'tmpfs.json'),
+                        session=self)
+
+        return self._tmpfs_builds
+
+    @property
+    def compiler_cache(self):
+        """Return the compiler cache (None if :attr:`compilercache` is off).
+
+        :attr:`compilercache` is ``ccache`` or ``sccache``.  The cache is
+        kept in :attr:`compilercachedir` (default: the tool’s name in the
+        cache directory) and holds up to :attr:`compilercachesize` MiB.
+        Package bases in :attr:`nocompilercache` are built without it.
+
+        .. versionadded:: 4.3.0
+        """
+        if not self.compilercache:
+            return None
+        if self._compiler_cache is None:
+            with self._lock:
+                if self._compiler_cache is None:
+                    import pkgbuilder.ccache
+                    tool = self.compilercache
+                    if shutil.which(tool) is None:
+                        self.fancy_warning(_('{0} is not installed, building '
+                                             'without it').format(tool))
+                        self.compilercache = None
+                        return None
+                    self._compiler_cache = pkgbuilder.ccache.CompilerCache(
+                        tool, self.compilercachedir or
+                        os.path.join(self.cachedir, tool),
+                        self.compilercachesize, self.nocompilercache,
+                        session=self)
+
+        return self._compiler_cache
+
+    @property
+    def pacman_cache(self):
+        """Return an index of the pacman package cache.
+
+        .. versionadded:: 4.3.0
+        """
+        if self._pacman_cache is None:
+            with self._lock:
+                if self._pacman_cache is None:
+                    self._pacman_cache = pkgbuilder.cache.PacmanCacheIndex()
+
+        return self._pacman_cache
+
     def run_command(self, args, prepend=None, asonearg=False):
         """
         Run a command.
@@ -243,47 +469,116 @@ class PBDS(object):
             'yellow':     ''
         }
 
+    def write(self, text):
+        """Write `text` to the message stream, in one piece.
+
+        .. versionadded:: 4.3.0
+        """
+        with self._lock:
+            (self.stream or sys.stderr).write(text)
+
+    def flush(self):
+        """Flush the message stream.
+
+        .. versionadded:: 4.3.0
+        """
+        with self._lock:
+            (self.stream or sys.stderr).flush()
+
     def fancy_msg(self, text):
         """Display main messages."""
-        sys.stderr.write(self.colors['green'] + self.mp1 + '>' +
-                         self.colors['all_off'] +
-                         self.colors['bold'] + ' ' + text +
-                         self.colors['all_off'] + '\n')
+        self.write(self.colors['green'] + self.mp1 + '>' +
+                   self.colors['all_off'] +
+                   self.colors['bold'] + ' ' + text +
+                   self.colors['all_off'] + '\n')
         self.log.info('({0:<20}) {1}'.format('fancy_msg', text))
 
     def fancy_msg2(self, text):
         """Display sub-messages."""
-        sys.stderr.write(self.colors['blue'] + self.mp2 + '->' +
-                         self.colors['all_off'] +
-                         self.colors['bold'] + ' ' + text +
-                         self.colors['all_off'] + '\n')
+        self.write(self.colors['blue'] + self.mp2 + '->' +
+                   self.colors['all_off'] +
+                   self.colors['bold'] + ' ' + text +
+                   self.colors['all_off'] + '\n')
         self.log.info('({0:<20}) {1}'.format('fancy_msg2', text))
 
     def fancy_warning(self, text):
         """Display warning messages."""
-        sys.stderr.write(self.colors['yellow'] + self.mp1 + '> ' +
-                         _('WARNING:') + self.colors['all_off'] +
-                         self.colors['bold'] + ' ' + text +
-                         self.colors['all_off'] + '\n')
+        self.write(self.colors['yellow'] + self.mp1 + '> ' +
+                   _('WARNING:') + self.colors['all_off'] +
+                   self.colors['bold'] + ' ' + text +
+                   self.colors['all_off'] + '\n')
         self.log.warning('({0:<20}) {1}'.format('fancy_warning', text))
 
     def fancy_warning2(self, text):
         """Display warning sub-messages."""
-        sys.stderr.write(self.colors['yellow'] + self.mp2 + '->' +
-                         self.colors['all_off'] + self.colors['bold'] + ' ' +
-                         text + self.colors['all_off'] + '\n')
+        self.write(self.colors['yellow'] + self.mp2 + '->' +
+                   self.colors['all_off'] + self.colors['bold'] + ' ' +
+                   text + self.colors['all_off'] + '\n')
         self.log.warning('({0:<20}) {1}'.format('fancy_warning2', text))
 
     def fancy_error(self, text):
         """Display error messages."""
-        sys.stderr.write(self.colors['red'] + self.mp1 + '> ' + _('ERROR:') +
-                         self.colors['all_off'] + self.colors['bold'] + ' ' +
-                         text + self.colors['all_off'] + '\n')
+        self.write(self.colors['red'] + self.mp1 + '> ' + _('ERROR:') +
+                   self.colors['all_off'] + self.colors['bold'] + ' ' +
+                   text + self.colors['all_off'] + '\n')
         self.log.error('({0:<20}) {1}'.format('fancy_error', text))
 
     def fancy_error2(self, text):
         """Display error sub-messages."""
-        sys.stderr.write(self.colors['red'] + self.mp2 + '->' +
-                         self.colors['all_off'] + self.colors['bold'] + ' ' +
-                         text + self.colors['all_off'] + '\n')
+        self.write(self.colors['red'] + self.mp2 + '->' +
+                   self.colors['all_off'] + self.colors['bold'] + ' ' +
+                   text + self.colors['all_off'] + '\n')
         self.log.error('({0:<20}) {1}'.format('fancy_error2', text))
+
+
+class Session(PBDS):
+    """An independent PKGBUILDer session.
+
+    ``pkgbuilder.DS`` is the default session, used by every function that
+    is not given a session explicitly.  Other sessions have their own copy
+    of the configuration, their own settings (``clean``, ``confirm``,
+    ``pgpcheck``…), pycman handle, AUR client, caches and message stream,
+    so that differently configured operations can run in one process at the
+    same time (eg. in a daemon serving many users).
+
+    Sessions are thread-safe: shared resources are created only once, and
+    messages are never interleaved.  Sessions created with `share` may run
+    in other threads than the session they share caches with: the database
+    index holds plain data and the .SRCINFO cache is locked, while every
+    session keeps its own pycman handle.
+
+    .. versionadded:: 4.3.0
+    """
+
+    def __init__(self, stream=None, config=None, share=None, **settings):
+        """Create a session.
+
+        :param stream: stream for messages (None: ``sys.stderr``)
+        :param config: configuration (a ``ConfigParser`` or a dict of
+                       sections; default: a copy of the user configuration)
+        :param PBDS share: a session to share warm caches with (the
+                           database index and .SRCINFO cache)
+        :param settings: settings to change, eg. ``confirm=False``
+        :raises TypeError: on unknown settings
+        """
+        super().__init__()
+        self.stream = stream
+        self.config = configparser.ConfigParser()
+        self.config.read_dict(PBDS.config if config is None else config)
+        if os.getenv('PACMAN') is None:
+            self.paccommand = self.config.get('extras', 'paccommand',
+                                              fallback='pacman')
+        self.colors = dict(self.colors)
+
+        for name, value in settings.items():
+            if name.startswith('_') or not hasattr(PBDS, name):
+                raise TypeError('unknown setting: {0}'.format(name))
+            setattr(self, name, value)
+
+        if share is not None:
+            self._dbindex = share.dbindex
+            self._srcinfo_cache = share.srcinfo_cache
+
+    def __repr__(self):
+        """Return the representation of a session."""
+        return '<Session {0}>'.format(hex(id(self)))
@@ -0,0 +1,251 @@
+# -*- encoding: utf-8 -*-
+# PKGBUILDer v4.2.18
+# An AUR helper (and library) in Python 3.
+# Copyright © 2011-2018, Chris Warrick.
+# See /LICENSE for licensing information.
+
+"""
+Build plans (dependency graphs of package bases).
+
+.. versionadded:: 4.3.0
+
+:Copyright: © 2011-2018, Chris Warrick.
+:License: BSD (see /LICENSE).
+"""
+
+from . import _
+import pkgbuilder.exceptions
+import collections
+import os
+
+__all__ = ('BuildNode', 'BuildGraph')
+
+
+class BuildNode(object):
+    """A package base in a build plan.
+
+    Split packages share a single node, as makepkg builds all of them at
+    once.
+    """
+
+    def __init__(self, pkg):
+        """Create a node for `pkg` (an AURPackage or ABSPackage)."""
+        self.pkg = pkg
+        self.pkgbase = self.pkgbase_of(pkg)
+        #: names requested by the user
+        self.targets = set()
+        #: names required by other nodes
+        self.required = set()
+        #: all packages built from this package base
+        self.subpackages = [pkg.name]
+        #: package bases that have to be built (and installed) first
+        self.depends = set()
+        #: dependencies that have to be installed from the repos
+        self.repodeps = []
+        #: absolute path to the checkout (set by :meth:`BuildGraph.add`)
+        self.path = None
+        #: package and signature files found before building, if any
+        self.existing = None
+        #: build cache key (see :func:`pkgbuilder.build.build_key`)
+        self.cachekey = None
+        #: ``[status, (pkgpaths, sigpaths)]``, once built
+        self.result = None
+
+    def __repr__(self):
+        """Return the representation of a node."""
+        return '<BuildNode {0}>'.format(self.pkgbase)
+
+    @staticmethod
+    def pkgbase_of(pkg):
+        """Return the package base of `pkg`.
+
+        Repository packages are exported from ASP by name.
+        """
+        if pkg.is_abs:
+            return pkg.name
+        else:
+            return pkg.packagebase
+
+    @property
+    def is_abs(self):
+        """Check if this is a repository package."""
+        return self.pkg.is_abs
+
+
+class BuildGraph(object):
+    """A dependency graph of package bases.
+
+    Nodes are keyed by package base; every package name (including split
+    packages) that is known to come from a node maps to it.  Package bases
+    are checked out in `destdir`.
+    """
+
+    def __init__(self, destdir=None):
+        """Create an empty graph.
+
+        :param str destdir: directory for checkouts (default: the current
+                            directory)
+        """
+        self.destdir = os.path.abspath(destdir or os.curdir)
+        self.nodes = collections.OrderedDict()
+        self.names = {}
+        #: AUR and repository packages the nodes were created from, by name
+        self.packages = {}
+
+    def __repr__(self):
+        """Return the representation of a graph."""
+        return '<BuildGraph ({0} package bases)>'.format(len(self.nodes))
+
+    def __len__(self):
+        """Return the number of package bases."""
+        return len(self.nodes)
+
+    def __iter__(self):
+        """Iterate over nodes, in insertion order."""
+        return iter(self.nodes.values())
+
+    def __contains__(self, name):
+        """Check if a package name is provided by any node."""
+        return name in self.names
+
+    def get(self, name):
+        """Return the node that builds package `name`, or None."""
+        try:
+            return self.nodes[self.names[name]]
+        except KeyError:
+            return None
+
+    def add(self, pkg):
+        """Add `pkg` to the graph, reusing the node of its package base.
+
+        :return: the node for `pkg`
+        """
+        pkgbase = BuildNode.pkgbase_of(pkg)
+        node = self.nodes.get(pkgbase)
+        if node is None:
+            node = BuildNode(pkg)
+            node.path = os.path.join(self.destdir, pkgbase)
+            self.nodes[pkgbase] = node
+        self.names[pkg.name] = pkgbase
+        self.packages[pkg.name] = pkg
+        return node
+
+    def register(self, node, names):
+        """Register `names` (eg. split packages) as built by `node`."""
+        for name in names:
+            self.names.setdefault(name, node.pkgbase)
+        for name in names:
+            if name not in node.subpackages:
+                node.subpackages.append(name)
+
+    def add_dependency(self, node, dependency):
+        """Make `node` depend on `dependency`."""
+        if node is not dependency:
+            node.depends.add(dependency.pkgbase)
+
+    def dependents(self, node):
+        """Return the nodes that depend on `node`."""
+        return [n for n in self if node.pkgbase in n.depends]
+
+    def groups(self):
+        """Return package names grouped by package base.
+
+        Only names known to the graph are included: split packages show up
+        once they are registered from .SRCINFO (or requested by name).
+
+        :return: an ordered mapping of package base → package names
+        :rtype: collections.OrderedDict
+        """
+        groups = collections.OrderedDict((pkgbase, []) for pkgbase in
+                                         self.nodes)
+        for name, pkgbase in sorted(self.names.items()):
+            groups[pkgbase].append(name)
+        return groups
+
+    def cycles(self):
+        """Find dependency cycles.
+
+        :return: lists of nodes that depend on each other (strongly
+                 connected components with more than one node)
+        :rtype: list
+        """
+        # Tarjan’s algorithm, with an explicit stack.
+        index = {}
+        lowlink = {}
+        stack = []
+        onstack = set()
+        cycles = []
+        counter = 0
+
+        for root in self.nodes:
+            if root in index:
+                continue
+            work = [(root, iter(sorted(self.nodes[root].depends)))]
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            onstack.add(root)
+            while work:
+                pkgbase, deps = work[-1]
+                for dep in deps:
+                    if dep not in self.nodes:
+                        continue
+                    if dep not in index:
+                        index[dep] = lowlink[dep] = counter
+                        counter += 1
+                        stack.append(dep)
+                        onstack.add(dep)
+                        work.append((dep, iter(sorted(
+                            self.nodes[dep].depends))))
+                        break
+                    elif dep in onstack:
+                        lowlink[pkgbase] = min(lowlink[pkgbase], index[dep])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent],
+                                              lowlink[pkgbase])
+                    if lowlink[pkgbase] == index[pkgbase]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            onstack.discard(member)
+                            component.append(self.nodes[member])
+                            if member == pkgbase:
+                                break
+                        if len(component) > 1:
+                            cycles.append(component[::-1])
+        return cycles
+
+    def toposort(self):
+        """Return all nodes, with dependencies before their dependents.
+
+        Independent nodes keep their insertion order.
+
+        :raises PackageError: if the graph has a dependency cycle
+        """
+        order = []
+        done = set()
+        stack = []
+
+        def visit(node):
+            if node.pkgbase in done:
+                return
+            if node in stack:
+                cycle = stack[stack.index(node):] + [node]
+                raise pkgbuilder.exceptions.PackageError(
+                    _('Dependency cycle detected: {0}').format(
+                        ' -> '.join(n.pkgbase for n in cycle)),
+                    'BuildGraph.toposort')
+            stack.append(node)
+            for dep in self.nodes:
+                if dep in node.depends:
+                    visit(self.nodes[dep])
+            stack.pop()
+            done.add(node.pkgbase)
+            order.append(node)
+
+        for node in self:
+            visit(node)
+        return order
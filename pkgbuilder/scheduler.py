@@ -0,0 +1,299 @@
+# -*- encoding: utf-8 -*-
+# PKGBUILDer v4.2.18
+# An AUR helper (and library) in Python 3.
+# Copyright © 2011-2018, Chris Warrick.
+# See /LICENSE for licensing information.
+
+"""
+Parallel building of independent package bases.
+
+.. versionadded:: 4.3.0
+
+:Copyright: © 2011-2018, Chris Warrick.
+:License: BSD (see /LICENSE).
+"""
+
+from . import DS, _
+import pkgbuilder.build
+import pkgbuilder.exceptions
+import concurrent.futures
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+__all__ = ('CPUBudget', 'ParallelBuilder', 'make_version')
+
+
+def make_version():
+    """Return the version of GNU make as a tuple (None if unknown)."""
+    try:
+        out = subprocess.check_output(['make', '--version'],
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.match(br'GNU Make (\d+)\.(\d+)', out)
+    if match is None:
+        return None
+    return tuple(int(i) for i in match.groups())
+
+
+class CPUBudget(object):
+    """Share a budget of CPU cores between concurrent makepkg processes.
+
+    Every build gets ``MAKEFLAGS=-jN``, where N is its share of the budget.
+    With a jobserver, all builds also share one pool of job slots: a GNU
+    make jobserver on a named pipe (GNU make 4.4 and newer; also understood
+    by cargo and ninja), filled with one token per core, less one for every
+    build (each client holds one implicit slot).  Busy builds can then use
+    the cores idle builds leave free, but never more than the budget in
+    total.
+
+    Use it as a context manager: the jobserver exists only inside it.
+    """
+
+    def __init__(self, cores=None, jobs=1, jobserver=True, session=None):
+        """Initialize a budget.
+
+        :param int cores: number of cores (default: ``cores`` of the session,
+                          or all cores)
+        :param int jobs: maximum number of concurrent builds
+        :param bool jobserver: whether to run a jobserver (if make supports
+                               it)
+        :param PBDS session: session to use (default: ``DS``)
+        """
+        self.ds = session or DS
+        self.cores = max(1, cores or self.ds.cores or os.cpu_count() or 1)
+        self.jobs = max(1, jobs)
+        self.jobserver = jobserver
+        self.fifo = None
+        self._fd = None
+
+    def __repr__(self):
+        """Return the representation of a budget."""
+        return '<CPUBudget ({0} cores, {1} jobs)>'.format(self.cores,
+                                                          self.jobs)
+
+    def __enter__(self):
+        """Start the jobserver."""
+        version = make_version() if self.jobserver else None
+        if version is not None and version >= (4, 4):
+            tmpdir = tempfile.mkdtemp(prefix='pkgbuilder-jobserver-')
+            self.fifo = os.path.join(tmpdir, 'fifo')
+            os.mkfifo(self.fifo, 0o600)
+            # Kept open for reading and writing, so that the pipe never
+            # reaches end-of-file while builds come and go.
+            self._fd = os.open(self.fifo, os.O_RDWR | os.O_NONBLOCK)
+            os.write(self._fd, b'+' * max(0, self.cores - self.jobs))
+            self.ds.log.info('Jobserver at {0} with {1} tokens'.format(
+                self.fifo, max(0, self.cores - self.jobs)))
+        elif self.jobserver and self.jobs > 1:
+            self.ds.log.info('make {0} has no FIFO jobserver, using '
+                             '-j only'.format(version))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop the jobserver."""
+        if self._fd is not None:
+            os.close(self._fd)
+            shutil.rmtree(os.path.dirname(self.fifo), ignore_errors=True)
+            self._fd = None
+            self.fifo = None
+
+    @property
+    def share(self):
+        """Return the number of cores for a single build."""
+        return max(1, self.cores // self.jobs)
+
+    @property
+    def makeflags(self):
+        """Return MAKEFLAGS for a single build."""
+        if self.fifo is None:
+            return '-j{0}'.format(self.share)
+        return '-j{0} --jobserver-auth=fifo:{1}'.format(self.share,
+                                                        self.fifo)
+
+    def environment(self, env=None):
+        """Return `env` (default: ``os.environ``) with MAKEFLAGS set."""
+        env = dict(os.environ if env is None else env)
+        env['MAKEFLAGS'] = self.makeflags
+        return env
+
+
+class ParallelBuilder(object):
+    """Build a plan, running independent package bases concurrently.
+
+    A package base is started as soon as all of its AUR dependencies are
+    built and installed.  Every makepkg process runs in the checkout of its
+    package base, writes its output to a log file in `logdir`, and gets an
+    equal share of the core budget through ``MAKEFLAGS``, and a jobserver
+    shared by all builds (see :class:`CPUBudget`).  Built dependencies are
+    installed as soon as they are ready; targets are left to the caller.
+
+    Repository dependencies must be installed beforehand (see
+    :func:`pkgbuilder.build.install_repo_deps`).
+    """
+
+    def __init__(self, graph, jobs, pkginstall=True, logdir=None,
+                 cores=None, session=None):
+        """Initialize a builder.
+
+        :param BuildGraph graph: the plan to build
+        :param int jobs: maximum number of concurrent makepkg processes
+        :param bool pkginstall: whether targets will be installed
+        :param str logdir: directory for log files (default:
+                           ``pkgbuilder-logs`` next to the checkouts)
+        :param int cores: core budget (default: ``cores`` of the session, or
+                          all cores)
+        :param PBDS session: session to use (default: ``DS``)
+        """
+        self.graph = graph
+        self.jobs = jobs
+        self.pkginstall = pkginstall
+        if logdir is None:
+            logdir = os.path.join(graph.destdir, 'pkgbuilder-logs')
+        self.logdir = logdir
+        self.installed = set()
+        self.failed = {}
+        self.durations = {}
+        self.ds = session or DS
+        self.budget = CPUBudget(cores, jobs, self.ds.jobserver,
+                                session=self.ds)
+        self.cores = self.budget.cores
+
+    def __repr__(self):
+        """Return the representation of a builder."""
+        return '<ParallelBuilder ({0} jobs, {1} cores)>'.format(self.jobs,
+                                                                self.cores)
+
+    @property
+    def makeflags(self):
+        """Return MAKEFLAGS for a single build."""
+        return self.budget.makeflags
+
+    def logfile(self, node):
+        """Return the log file path for `node`."""
+        return os.path.join(self.logdir, node.pkgbase + '.log')
+
+    def _build(self, node):
+        """Build `node` (in a worker thread)."""
+        env = self.budget.environment(
+            pkgbuilder.build.makepkg_env(self.pkginstall, session=self.ds))
+        start = time.time()
+        result = pkgbuilder.build.build_node(
+            node, self.pkginstall, logfile=self.logfile(node), env=env,
+            session=self.ds)
+        self.durations[node.pkgbase] = time.time() - start
+        return result
+
+    def _finish(self, node, position, total):
+        """Report a finished build.
+
+        :return: whether the build succeeded
+        """
+        ds = self.ds
+        status = node.result[0]
+        prefix = '({0}/{1}) '.format(position, total)
+        if status == 0:
+            msg = _('{0}: built in {1:.0f} s (log: {2})').format(
+                node.pkgbase, self.durations[node.pkgbase],
+                self.logfile(node))
+            ds.fancy_msg2(prefix + msg)
+            return True
+        elif status == 72336:
+            msg = _('{0}: found an existing package').format(node.pkgbase)
+            ds.fancy_msg2(prefix + msg)
+            return True
+        else:
+            msg = _('{0}: makepkg failed and returned {1} (log: {2})').format(
+                node.pkgbase, status, self.logfile(node))
+            ds.fancy_error2(prefix + msg)
+            self.failed[node.pkgbase] = status
+            return False
+
+    def _install(self, nodes):
+        """Install built dependencies."""
+        ds = self.ds
+        try:
+            pkgbuilder.build.install_deps(nodes, session=self.ds)
+        except pkgbuilder.exceptions.PBException as e:
+            ds.fancy_error(str(e))
+            for node in nodes:
+                self.failed[node.pkgbase] = None
+        else:
+            self.installed.update(node.pkgbase for node in nodes)
+
+    def run(self):
+        """Build everything.
+
+        :return: ``[status, (pkgpaths, sigpaths)]`` for the targets that were
+                 built successfully; status is 0 if nothing failed
+        """
+        ds = self.ds
+        pending = self.graph.toposort()
+        total = len(pending)
+        finished = 0
+        running = {}
+        os.makedirs(self.logdir, exist_ok=True)
+        ds.fancy_msg(_('Building {0} package bases ({1} at a time)...').format(
+            total, self.jobs))
+
+        with self.budget, concurrent.futures.ThreadPoolExecutor(
+                self.jobs) as pool:
+            while pending or running:
+                for node in list(pending):
+                    if any(dep in self.failed for dep in node.depends):
+                        pending.remove(node)
+                        finished += 1
+                        self.failed[node.pkgbase] = None
+                        ds.fancy_error2('({0}/{1}) '.format(finished, total) +
+                                        _('{0}: skipped, dependencies '
+                                          'failed').format(node.pkgbase))
+                    elif (len(running) < self.jobs and
+                          node.depends <= self.installed):
+                        pending.remove(node)
+                        running[pool.submit(self._build, node)] = node
+
+                if not running:
+                    break
+
+                done, not_done = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                toinstall = []
+                for future in done:
+                    node = running.pop(future)
+                    finished += 1
+                    try:
+                        future.result()
+                    except Exception:
+                        ds.log.exception('Building {0} crashed'.format(
+                            node.pkgbase))
+                        node.result = [-1, ([], [])]
+                    if self._finish(node, finished, total) and node.required:
+                        toinstall.append(node)
+
+                if toinstall:
+                    self._install(toinstall)
+
+        toinstall = []
+        sigs = []
+        status = 0
+        for node in self.graph:
+            if node.pkgbase in self.failed:
+                status = self.failed[node.pkgbase] or 1
+            elif node.targets and node.result:
+                selected = pkgbuilder.build.select_packagefiles(
+                    node.result[1], node.targets)
+                toinstall += selected[0]
+                sigs += selected[1]
+
+        if self.failed:
+            ds.fancy_error(_('{0} of {1} package bases failed to build: '
+                             '{2}').format(len(self.failed), total,
+                                           ', '.join(sorted(self.failed))))
+        else:
+            ds.fancy_msg(_('All {0} package bases built.').format(total))
+
+        return [status, (toinstall, sigs)]
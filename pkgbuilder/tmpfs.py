@@ -0,0 +1,255 @@
+# -*- encoding: utf-8 -*-
+# PKGBUILDer v4.2.18
+# An AUR helper (and library) in Python 3.
+# Copyright © 2011-2018, Chris Warrick.
+# See /LICENSE for licensing information.
+
+"""
+Building in a RAM-backed directory.
+
+.. versionadded:: 4.3.0
+
+:Copyright: © 2011-2018, Chris Warrick.
+:License: BSD (see /LICENSE).
+"""
+
+from . import DS, _
+import contextlib
+import json
+import os
+import shutil
+import threading
+
+__all__ = ('TmpfsBuilds', 'dir_size', 'format_size', 'memory_available')
+
+#: ratio of the space a build takes to the size of its sources, used when a
+#: package base was never built in tmpfs before
+EXPANSION = 5
+#: smallest estimate of the space a build takes
+MIN_ESTIMATE = 64 * 1024 * 1024
+#: free space below which a build is considered to have filled the tmpfs
+FULL_MARGIN = 16 * 1024 * 1024
+
+
+def memory_available():
+    """Return the available memory (``MemAvailable``) in bytes, or None."""
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def dir_size(path):
+    """Return the space taken by a directory tree, in bytes."""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def format_size(size):
+    """Format a size in bytes as MiB."""
+    return '{0:.1f} MiB'.format(size / 1024 / 1024)
+
+
+class _Monitor(threading.Thread):
+    """Sample the size of a build directory until stopped."""
+
+    def __init__(self, path, root, interval):
+        super().__init__(daemon=True)
+        self.path = path
+        self.root = root
+        self.interval = interval
+        self.peak = 0
+        self.minfree = None
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        """Measure the directory and the free space once."""
+        self.peak = max(self.peak, dir_size(self.path))
+        try:
+            st = os.statvfs(self.root)
+        except OSError:
+            return
+        free = st.f_bavail * st.f_frsize
+        if self.minfree is None or free < self.minfree:
+            self.minfree = free
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        """Stop sampling and take a final sample."""
+        self._stop_event.set()
+        self.join()
+        self.sample()
+
+
+class TmpfsBuilds(object):
+    """Build directories in a RAM-backed filesystem (tmpfs).
+
+    Every build reserves an estimate of the space it needs: its peak usage
+    in an earlier build (remembered in `historyfile`), or a multiple of the
+    size of its sources.  Builds that do not fit in what is left of the
+    budget are done on disk.  The budget is the free space of the tmpfs,
+    but at most half of the available memory, so that compilers have the
+    rest.
+
+    makepkg gets the directory as ``BUILDDIR``, so only ``src/`` and
+    ``pkg/`` are kept there; package files are still written next to the
+    PKGBUILD.  The directory is removed after the build, and its peak usage
+    is reported.
+
+    A build that failed (see :meth:`failed`) while the tmpfs was full is
+    considered to have filled it only if its own usage explains that: its
+    peak came close to the space left by the reservations of other builds.
+    Builds that just happened to run next to a bigger one are not blamed.
+    """
+
+    def __init__(self, path, historyfile=None, interval=2, session=None):
+        """Initialize tmpfs builds.
+
+        :param str path: directory in a tmpfs for build directories
+        :param str historyfile: file to remember peak usage in
+        :param float interval: seconds between measurements
+        :param PBDS session: session to use (default: ``DS``)
+        """
+        self.path = path
+        self.historyfile = historyfile
+        self.interval = interval
+        self.ds = session or DS
+        #: peak usage of builds in this session, by package base
+        self.peaks = {}
+        #: package bases whose builds filled the tmpfs
+        self.full = set()
+        self._failed = set()
+        self._capacity = None
+        self._reserved = 0
+        self._history = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Return the representation of tmpfs builds."""
+        return '<TmpfsBuilds {0}>'.format(self.path)
+
+    def capacity(self):
+        """Return the space available for builds, in bytes."""
+        os.makedirs(self.path, exist_ok=True)
+        st = os.statvfs(self.path)
+        capacity = st.f_bavail * st.f_frsize
+        memory = memory_available()
+        if memory is not None:
+            capacity = min(capacity, memory // 2)
+        return capacity
+
+    def history(self):
+        """Return the peak usage of earlier builds, by package base."""
+        if self._history is None:
+            try:
+                with open(self.historyfile, encoding='utf-8') as fh:
+                    self._history = json.load(fh)
+            except (TypeError, OSError, ValueError):
+                self._history = {}
+        return self._history
+
+    def _remember(self, pkgbase, peak):
+        """Remember the peak usage of `pkgbase`."""
+        with self._lock:
+            self.history()[pkgbase] = peak
+            if not self.historyfile:
+                return
+            tmp = '{0}.{1}.tmp'.format(self.historyfile, os.getpid())
+            try:
+                os.makedirs(os.path.dirname(self.historyfile), exist_ok=True)
+                with open(tmp, 'w', encoding='utf-8') as fh:
+                    json.dump(self._history, fh)
+                os.replace(tmp, self.historyfile)
+            except OSError as e:
+                self.ds.log.warning('Cannot save tmpfs usage: {0}'.format(e))
+
+    def estimate(self, node):
+        """Estimate the space needed to build `node`, in bytes."""
+        peak = self.history().get(node.pkgbase)
+        if peak is not None:
+            return max(MIN_ESTIMATE, peak + peak // 10)
+        sources = 0
+        with os.scandir(node.path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or entry.name in ('src', 'pkg'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    sources += dir_size(entry.path)
+                else:
+                    sources += entry.stat().st_size
+        return max(MIN_ESTIMATE, sources * EXPANSION)
+
+    def failed(self, node):
+        """Tell that the build of `node` failed (inside :meth:`builddir`)."""
+        with self._lock:
+            self._failed.add(node.pkgbase)
+
+    @contextlib.contextmanager
+    def builddir(self, node):
+        """Reserve a build directory for `node`.
+
+        :return: a context manager that gives the directory to use as
+                 ``BUILDDIR``, or None if the build does not fit (and should
+                 be done on disk)
+        """
+        ds = self.ds
+        try:
+            estimate = self.estimate(node)
+        except OSError:
+            estimate = MIN_ESTIMATE
+        with self._lock:
+            if self._capacity is None:
+                try:
+                    self._capacity = self.capacity()
+                except OSError as e:
+                    ds.log.warning('Cannot use {0}: {1}'.format(self.path, e))
+                    self._capacity = 0
+            # the space this build can use, at most
+            share = self._capacity - self._reserved
+            fits = estimate <= share
+            if fits:
+                self._reserved += estimate
+        if not fits:
+            ds.fancy_msg2(_('{0} needs about {1}, building on disk').format(
+                node.pkgbase, format_size(estimate)))
+            yield None
+            return
+
+        ds.log.info('Building {0} in tmpfs, reserved {1}'.format(
+            node.pkgbase, estimate))
+        monitor = _Monitor(os.path.join(self.path, node.pkgbase), self.path,
+                           self.interval)
+        monitor.start()
+        try:
+            yield self.path
+        finally:
+            monitor.stop()
+            shutil.rmtree(monitor.path, ignore_errors=True)
+            with self._lock:
+                self._reserved -= estimate
+                failed = node.pkgbase in self._failed
+                self._failed.discard(node.pkgbase)
+            peak = monitor.peak
+            if (failed and monitor.minfree is not None and
+                    monitor.minfree < FULL_MARGIN and
+                    peak + FULL_MARGIN >= share):
+                self.full.add(node.pkgbase)
+                # Too big: go straight to disk the next time.
+                peak = max(peak, self._capacity)
+            self.peaks[node.pkgbase] = monitor.peak
+            self._remember(node.pkgbase, peak)
+            ds.fancy_msg2(_('{0}: peak tmpfs usage {1}').format(
+                node.pkgbase, format_size(monitor.peak)))
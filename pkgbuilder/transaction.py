@@ -18,16 +18,22 @@ import os.path
 import time
 import json
 import enum
+import pkgbuilder.deps
 import pkgbuilder.utils
-import pyalpm
 from . import DS, _, __version__
 
 __all__ = ('generate_filename', 'Transaction', 'TransactionStatus')
 
 
-def generate_filename(absolute=True):
-    """Generate a filename for the transaction."""
+def generate_filename(absolute=True, directory=None):
+    """Generate a filename for the transaction.
+
+    .. versionchanged:: 4.3.0
+       Added `directory` (default: current directory).
+    """
     fn = "pkgbuilder-{0}.tx".format(int(time.time()))
+    if directory is not None:
+        fn = os.path.join(directory, fn)
     if absolute:
         return os.path.abspath(fn)
     else:
@@ -52,7 +58,7 @@ class Transaction(object):
 
     def __init__(self, pkgnames, pkgpaths, sigpaths, asdeps=True, uopt='',
                  filename=None, delete=False, status=None, pacmanreturn=-1,
-                 invalid=-1):
+                 invalid=-1, session=None):
         """Initialize a transaction.
 
         :param list pkgnames: package names to install
@@ -65,6 +71,10 @@ class Transaction(object):
         :param TransactionStatus status: transaction status
         :param int pacmanreturn: Return code from ``pacman -U``
         :param int invalid: number of invalid packages
+        :param PBDS session: session to use (default: ``DS``; not saved)
+
+        .. versionchanged:: 4.3.0
+           Added `session`.
         """
         # all lists are deduplicated
         self.pkgnames = list(set(pkgnames))
@@ -80,6 +90,7 @@ class Transaction(object):
             self.status = TransactionStatus.undefined
         self.pacmanreturn = pacmanreturn
         self.invalid = invalid
+        self.ds = session or DS
 
         if self.filename:
             self.save()
@@ -93,26 +104,27 @@ class Transaction(object):
             return s.format(hex(id(self)), self.status)
 
     @classmethod
-    def load(cls, filename):
+    def load(cls, filename, session=None):
         """Load a transaction file."""
         with open(filename, 'r') as fh:
             jsondata = fh.read()
-        tx = cls.fromjson(jsondata)
+        tx = cls.fromjson(jsondata, session)
         tx.filename = filename
-        DS.log.info("Transaction loaded: {0}".format(tx.filename))
+        tx.ds.log.info("Transaction loaded: {0}".format(tx.filename))
         return tx
 
     def save(self, filename=None):
         """Save a transaction file."""
+        ds = self.ds
         if filename is not None:
             self.filename = filename
         if self.filename:
             with open(self.filename, 'w+') as fh:
                 fh.write(self.tojson())
-            DS.log.info("Transaction saved: {0}".format(self.filename))
+            ds.log.info("Transaction saved: {0}".format(self.filename))
 
     @classmethod
-    def fromjson(cls, jsondata):
+    def fromjson(cls, jsondata, session=None):
         """Create a transaction from JSON data.
 
         The following fields exist:
@@ -136,7 +148,8 @@ class Transaction(object):
             uopt=txdata['uopt'],
             status=TransactionStatus(txdata['status']),
             pacmanreturn=txdata['pacmanreturn'],
-            invalid=txdata['invalid']
+            invalid=txdata['invalid'],
+            session=session
         )
 
     def tojson(self):
@@ -165,16 +178,17 @@ class Transaction(object):
 
     def run(self, standalone=True, quiet=False, validate=True):
         """Run a transaction."""
+        ds = self.ds
         if not quiet:
             if not standalone:
-                DS.fancy_msg(_('Installing built packages...'))
+                ds.fancy_msg(_('Installing built packages...'))
             if self.filename:
-                DS.fancy_msg(_('Running transaction from file {0}...').format(
+                ds.fancy_msg(_('Running transaction from file {0}...').format(
                     self.filename))
             else:
-                DS.fancy_msg(_('Running transaction...'))
+                ds.fancy_msg(_('Running transaction...'))
 
-        DS.log.info("Running transaction {0!r}".format(self))
+        ds.log.info("Running transaction {0!r}".format(self))
 
         self._test_sudo()
 
@@ -191,40 +205,42 @@ class Transaction(object):
             if ret != 0:
                 self._print_txfail('validate', quiet)
                 return False
-        DS.log.info("Transaction {0!r} succeeded".format(self))
+        ds.log.info("Transaction {0!r} succeeded".format(self))
         if not quiet:
-            DS.fancy_msg(_("Transaction succeeded."))
+            ds.fancy_msg(_("Transaction succeeded."))
         if self.delete and self.filename:
             os.remove(self.filename)
             if not quiet:
-                DS.fancy_msg2(_("Deleted transaction file {0}").format(
+                ds.fancy_msg2(_("Deleted transaction file {0}").format(
                     self.filename))
             self.filename = None
         return True
 
     def _print_txfail(self, stage, quiet):
         """Print transaction failure message."""
+        ds = self.ds
         if not quiet:
-            DS.log.error("Transaction {0!r} failed (stage {1})".format(
+            ds.log.error("Transaction {0!r} failed (stage {1})".format(
                 self, stage))
             if self.pacmanreturn == 0 and self.invalid > 0:
                 # special case: retrying the transaction is not helpful, as it
                 # won't help fix the validation status.  The user should
                 # investigate by reading the build logs and acting accordingly.
-                DS.fancy_error(_("Some packages failed to build."))
+                ds.fancy_error(_("Some packages failed to build."))
             else:
-                DS.fancy_error(_("Transaction failed!"))
+                ds.fancy_error(_("Transaction failed!"))
                 if self.filename:
                     c = 'c' if self.delete else ''
-                    DS.fancy_error2(_("To retry, run:"))
-                    DS.fancy_error2("pkgbuilder -X{c} {fn}".format(
+                    ds.fancy_error2(_("To retry, run:"))
+                    ds.fancy_error2("pkgbuilder -X{c} {fn}".format(
                         c=c, fn=self.filename))
 
     def _test_sudo(self):
         """Test if sudo works."""
+        ds = self.ds
         trueexit = 256
         while trueexit != 0:
-            trueexit = DS.sudo(['true'])
+            trueexit = ds.sudo(['true'])
 
     def _set_status_from_return(self, returncode, success, failure):
         """Set status from return code."""
@@ -252,10 +268,11 @@ class Transaction(object):
         :return: 0 on success, +mv return, -failed files
         :rtype: int
         """
+        ds = self.ds
         if not sudo_tested:
             self._test_sudo()
         if not quiet:
-            DS.fancy_msg2(_('Moving to /var/cache/pacman/pkg/...'))
+            ds.fancy_msg2(_('Moving to /var/cache/pacman/pkg/...'))
 
         pkgpaths = []
         sigpaths = []
@@ -263,44 +280,44 @@ class Transaction(object):
         for p in self.pkgpaths:
             pacp = self._pacman_pkgpath(p)
             if p == pacp:
-                DS.log.warning("Not moving package file {0} -- "
+                ds.log.warning("Not moving package file {0} -- "
                                "already in pacman cache".format(p))
             elif os.path.exists(p):
                 pkgpaths.append(p)
             elif os.path.exists(pacp):
-                DS.log.warning("Not moving package file {0} -- "
+                ds.log.warning("Not moving package file {0} -- "
                                "found in pacman cache".format(p))
             else:
-                DS.log.error("Not moving package file {0} -- "
+                ds.log.error("Not moving package file {0} -- "
                              "not found".format(p))
                 if not quiet:
-                    DS.fancy_warning2(_("Package file {0} not found").format(
+                    ds.fancy_warning2(_("Package file {0} not found").format(
                         p))
                 failed_files += 1
 
         for s in self.sigpaths:
-            pacs = self._pacman_pkgpath(p)
+            pacs = self._pacman_pkgpath(s)
             if s == pacs:
-                DS.log.warning("Not moving signature file {0} -- "
+                ds.log.warning("Not moving signature file {0} -- "
                                "already in pacman cache".format(s))
             elif os.path.exists(s):
                 sigpaths.append(s)
             elif os.path.exists(pacs):
-                DS.log.warning("Not moving signature file {0} -- "
+                ds.log.warning("Not moving signature file {0} -- "
                                "found in pacman cache".format(s))
             else:
-                DS.log.error("Not moving signature file {0} -- "
+                ds.log.error("Not moving signature file {0} -- "
                              "not found".format(s))
                 if not quiet:
-                    DS.fancy_warning2(_("Signature file {0} not found").format(
+                    ds.fancy_warning2(_("Signature file {0} not found").format(
                         s))
                 failed_files += 1
 
-        DS.log.debug('mv {0} {1} /var/cache/pacman/pkg/'.format(
+        ds.log.debug('mv {0} {1} /var/cache/pacman/pkg/'.format(
             pkgpaths, sigpaths))
         ret = -failed_files
         if pkgpaths or sigpaths:
-            ret = DS.sudo(['mv'] + pkgpaths + sigpaths +
+            ret = ds.sudo(['mv'] + pkgpaths + sigpaths +
                           ['/var/cache/pacman/pkg/'])
         self._set_status_from_return(ret, TransactionStatus.moved,
                                      TransactionStatus.move_failed)
@@ -314,10 +331,11 @@ class Transaction(object):
         :return: pacman return code
         :rtype: int
         """
+        ds = self.ds
         if not sudo_tested:
             self._test_sudo()
         if not quiet:
-            DS.fancy_msg2(_('Installing with pacman -U...'))
+            ds.fancy_msg2(_('Installing with pacman -U...'))
 
         npkgpaths = self.pacman_pkgpaths
         uopt = self.uopt.strip()
@@ -325,17 +343,17 @@ class Transaction(object):
         if self.asdeps:
             uopt = uopt + ' --asdeps'
 
-        if not DS.confirm:
+        if not ds.confirm:
             uopt = uopt + ' --noconfirm'
 
         uopt = uopt.strip()
 
         if uopt:
-            DS.log.debug('$PACMAN -U {0} {1}'.format(uopt, npkgpaths))
-            ret = DS.sudo([DS.paccommand, '-U'] + uopt.split(' ') + npkgpaths)
+            ds.log.debug('$PACMAN -U {0} {1}'.format(uopt, npkgpaths))
+            ret = ds.sudo([ds.paccommand, '-U'] + uopt.split(' ') + npkgpaths)
         else:
-            DS.log.debug('$PACMAN -U {0}'.format(npkgpaths))
-            ret = DS.sudo([DS.paccommand, '-U'] + npkgpaths)
+            ds.log.debug('$PACMAN -U {0}'.format(npkgpaths))
+            ret = ds.sudo([ds.paccommand, '-U'] + npkgpaths)
 
         self.pacmanreturn = ret
         self._set_status_from_return(ret, TransactionStatus.installed,
@@ -349,15 +367,16 @@ class Transaction(object):
         :return: number of packages that were not installed
         :rtype: int
         """
+        ds = self.ds
         if self.pkgnames:
             if not quiet:
-                DS.fancy_msg(_('Validating installation status...'))
-            DS.log.info('Validating: ' + '; '.join(self.pkgnames))
-            DS.pycreload()
-            localdb = DS.pyc.get_localdb()
+                ds.fancy_msg(_('Validating installation status...'))
+            ds.log.info('Validating: ' + '; '.join(self.pkgnames))
+            ds.pycreload()
+            localdb = ds.pyc.get_localdb()
 
             aurpkgs = {aurpkg.name: aurpkg.version for aurpkg in
-                       pkgbuilder.utils.info(self.pkgnames)}
+                       pkgbuilder.utils.info(self.pkgnames, session=ds)}
 
             wrong = len(self.pkgnames)
         else:
@@ -370,27 +389,27 @@ class Transaction(object):
             except KeyError:
                 if not lpkg:
                     if not quiet:
-                        DS.fancy_error2(_('{0}: not an AUR package').format(
+                        ds.fancy_error2(_('{0}: not an AUR package').format(
                                         pkgname))
                 else:
                     wrong -= 1
                     if not quiet:
-                        DS.fancy_msg2(_('{0}: installed {1}').format(
+                        ds.fancy_msg2(_('{0}: installed {1}').format(
                                       pkgname, lpkg.version))
             else:
                 if not lpkg:
                     if not quiet:
-                        DS.fancy_error2(_('{0}: NOT installed').format(
+                        ds.fancy_error2(_('{0}: NOT installed').format(
                             pkgname))
                 else:
-                    if pyalpm.vercmp(aurversion, lpkg.version) > 0:
+                    if pkgbuilder.deps.vercmp(aurversion, lpkg.version) > 0:
                         if not quiet:
-                            DS.fancy_error2(_('{0}: outdated {1}').format(
+                            ds.fancy_error2(_('{0}: outdated {1}').format(
                                 pkgname, lpkg.version))
                     else:
                         wrong -= 1
                         if not quiet:
-                            DS.fancy_msg2(_('{0}: installed {1}').format(
+                            ds.fancy_msg2(_('{0}: installed {1}').format(
                                 pkgname, lpkg.version))
 
         self.invalid = wrong
@@ -99,27 +99,37 @@ class Progress(object):
 
     current = 0
     total = 1
+    stream = None
     _pml = 0
 
-    def __init__(self, total=1):
-        """Initialize a Progress message."""
+    def __init__(self, total=1, stream=None):
+        """Initialize a Progress message.
+
+        :param stream: stream to write to (None: ``sys.stdout``), or a
+                       session (:class:`pkgbuilder.pbds.PBDS`)
+
+        .. versionchanged:: 4.3.0
+           Added `stream`.
+        """
         self.total = total
+        self.stream = stream
 
     def msg(self, msg, single=False):
         """Print a progress message."""
         self.current += 1
         ln = len(str(self.total))
-        sys.stdout.write('\r' + ((ln * 2 + 4 + self._pml) * ' '))
+        # Written in one piece, so that sessions never interleave it with
+        # other messages.
+        text = '\r' + ((ln * 2 + 4 + self._pml) * ' ') + '\r'
         self._pml = len(msg)
-        sys.stdout.write('\r')
-        sys.stdout.flush()
-        sys.stdout.write(('({0:>' + str(ln) + '}/{1}) ').format(self.current,
-                                                                self.total))
-        sys.stdout.write(msg)
-        sys.stdout.write('\r')
-        sys.stdout.flush()
+        text += ('({0:>' + str(ln) + '}/{1}) ').format(self.current,
+                                                       self.total)
+        text += msg + '\r'
         if single:
-            print()
+            text += '\n'
+        stream = self.stream or sys.stdout
+        stream.write(text)
+        stream.flush()
         if self.current == self.total:
             self.total = 0
             self.current = 0
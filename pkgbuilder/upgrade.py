@@ -7,28 +7,31 @@
 """
 Tools for performing upgrades of AUR packages.
 
+Functions that take a `session` use it instead of ``DS``.
+
 :Copyright: © 2011-2018, Chris Warrick.
 :License: BSD (see /LICENSE).
 """
 
 from . import DS, _
 import pkgbuilder.build
+import pkgbuilder.deps
 import pkgbuilder.ui
 import pkgbuilder.utils
-import pyalpm
 import datetime
 
 __all__ = ('gather_foreign_pkgs', 'list_upgradable', 'auto_upgrade')
 
 
-def gather_foreign_pkgs():
+def gather_foreign_pkgs(session=None):
     """Gather a list of all foreign packages."""
-    localdb = DS.pyc.get_localdb()
+    ds = session or DS
+    localdb = ds.pyc.get_localdb()
     # Based on paconky.py.
     installed = [p for p in localdb.pkgcache]
     repo = []
     aur = []
-    syncdbs = DS.pyc.get_syncdbs()
+    syncdbs = ds.pyc.get_syncdbs()
     for sdb in syncdbs:
         for ipkg in installed:
             if sdb.get_pkg(ipkg.name):
@@ -39,18 +42,24 @@ def gather_foreign_pkgs():
     return dict([(p.name, p) for p in aur])
 
 
-def list_upgradable(pkglist, vcsup=False, aurcache=None, ignorelist=None):
+def list_upgradable(pkglist, vcsup=False, aurcache=None, ignorelist=None,
+                    session=None):
     """Compare package versions and returns upgradable ones.
 
     .. versionchanged:: 4.2.9
+
+    .. versionchanged:: 4.3.0
+       Versions are compared with the memoised
+       :func:`pkgbuilder.deps.vercmp`.  Added `session`.
     """
-    localdb = DS.pyc.get_localdb()
+    ds = session or DS
+    localdb = ds.pyc.get_localdb()
     if ignorelist is None:
         ignorelist = []
     if aurcache:
         aurlist = aurcache
     else:
-        aurlist = pkgbuilder.utils.info(pkglist)
+        aurlist = pkgbuilder.utils.info(pkglist, session=ds)
         # It’s THAT easy.  Oh, and by the way: it is much, MUCH faster than
         # others.  It makes only a handful of multiinfo requests (1-2 on most
         # systems) rather than len(installed_packages) info requests.
@@ -62,11 +71,11 @@ def list_upgradable(pkglist, vcsup=False, aurcache=None, ignorelist=None):
     for rpkg in aurlist:
         lpkg = localdb.get_pkg(rpkg.name)
         if lpkg is not None:
-            vc = pyalpm.vercmp(rpkg.version, lpkg.version)
+            vc = pkgbuilder.deps.vercmp(rpkg.version, lpkg.version)
             if vc > 0 and rpkg.name not in ignorelist:
                 upgradable.append([rpkg.name, lpkg.version, rpkg.version])
             elif vc > 0 and rpkg.name in ignorelist:
-                DS.log.warning("{0} ignored for upgrade.".format(rpkg.name))
+                ds.log.warning("{0} ignored for upgrade.".format(rpkg.name))
                 ignored.append([rpkg.name, lpkg.version, rpkg.version])
             elif vc < 0:
                 # If the package version is a date or the name ends in
@@ -75,14 +84,10 @@ def list_upgradable(pkglist, vcsup=False, aurcache=None, ignorelist=None):
                 # you added big a gap between git and hg and then HUGE gaps
                 # between everything else.
 
-                try:
-                    # For epoch packages.  Also, cheating here.
-                    v = rpkg.version.split(':')[1]
-                except IndexError:
-                    v = rpkg.version
+                pkgver = pkgbuilder.deps.parse_version(rpkg.version)[1]
 
                 try:
-                    datetime.datetime.strptime(v.split('-')[0], '%Y%m%d')
+                    datetime.datetime.strptime(pkgver, '%Y%m%d')
                     datever = True
                 except:
                     datever = False
@@ -94,13 +99,13 @@ def list_upgradable(pkglist, vcsup=False, aurcache=None, ignorelist=None):
                     if vcsup:
                         upgradable.append([rpkg.name, lpkg.version, dt])
                     else:
-                        DS.log.warning('{0} is -[vcs], ignored for '
+                        ds.log.warning('{0} is -[vcs], ignored for '
                                        'downgrade.'.format(rpkg.name))
                 elif datever:
                     if vcsup:
                         upgradable.append([rpkg.name, lpkg.version, dt])
                     else:
-                        DS.log.warning('{0} version is a date, ignored '
+                        ds.log.warning('{0} version is a date, ignored '
                                        'for downgrade.'.format(rpkg.name))
                 else:
                     downgradable.append([rpkg.name, lpkg.version,
@@ -109,18 +114,19 @@ def list_upgradable(pkglist, vcsup=False, aurcache=None, ignorelist=None):
 
 
 def auto_upgrade(downgrade=False, vcsup=False, fetchonly=False,
-                 ignorelist=None):
+                 ignorelist=None, session=None):
     """
     Human friendly upgrade question and output.
 
     Returns packages — should be passed over to builder functions.
     """
-    DS.log.info('Ran auto_upgrade.')
+    ds = session or DS
+    ds.log.info('Ran auto_upgrade.')
     print(':: ' + _('Synchronizing package databases...'))
 
-    foreign = gather_foreign_pkgs()
+    foreign = gather_foreign_pkgs(session=ds)
     upgradable, downgradable, ignored = list_upgradable(
-        foreign.keys(), vcsup, ignorelist=ignorelist)
+        foreign.keys(), vcsup, ignorelist=ignorelist, session=ds)
 
     print(':: ' + _('Starting full system upgrade...'))
 
@@ -149,7 +155,7 @@ def auto_upgrade(downgrade=False, vcsup=False, fetchonly=False,
     upgnames = [i[0] for i in upgradable]
     upgstrings = [i[0] + '-' + i[2] for i in upgradable]
 
-    verbosepkglists = DS.config.getboolean('options', 'verbosepkglists')
+    verbosepkglists = ds.config.getboolean('options', 'verbosepkglists')
 
     if upgradable:
         targetstring = _('Targets ({0}):').format(len(upgradable)) + ' '
@@ -160,7 +166,7 @@ def auto_upgrade(downgrade=False, vcsup=False, fetchonly=False,
             # Pacman doesn’t allow tables if the terminal is too small.
             # And since we don’t know the size, better safe than sorry.
             verbosepkglists = False
-            DS.log.warning('VerbosePkgLists disabled, cannot '
+            ds.log.warning('VerbosePkgLists disabled, cannot '
                            'determine terminal width')
 
         termwidth = termwidth or 9001
@@ -186,7 +192,7 @@ def auto_upgrade(downgrade=False, vcsup=False, fetchonly=False,
 
             if len(fstring.format(i=4 * ['n'])) > termwidth:
                 verbosepkglists = False
-                DS.log.warning('VerbosePkgLists disabled, terminal is '
+                ds.log.warning('VerbosePkgLists disabled, terminal is '
                                'not wide enough')
                 # string stolen from pacman
                 print(_('warning: insufficient columns available for '
@@ -211,7 +217,7 @@ def auto_upgrade(downgrade=False, vcsup=False, fetchonly=False,
         else:
             query = ':: ' + _('Proceed with installation? [Y/n] ')
 
-        if DS.confirm:
+        if ds.confirm:
             yesno = input(query)
 
             if yesno.lower().strip().startswith('y') or yesno.strip() == '':
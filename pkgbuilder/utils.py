@@ -7,25 +7,32 @@
 """
 Common global utilities, used mainly for AUR data access.
 
+Functions that take a `session` use it instead of ``DS``.
+
 :Copyright: © 2011-2018, Chris Warrick.
 :License: BSD (see /LICENSE).
 """
 
 import os
 from . import DS, _
-from .aur import AUR
+from .deps import vercmp
 from .package import AURPackage
 from .ui import get_termwidth, hanging_indent, mlist
 from pkgbuilder.exceptions import SanityError, AURError
-import pyalpm
 import textwrap
 
 __all__ = ('info', 'search', 'msearch', 'print_package_search',
            'print_package_info',)
-RPC = AUR()
+#: AUR client of the default session (``DS.aur``)
+RPC = DS.aur
+
+
+def _rpc(session):
+    """Return the AUR client of `session` (default: ``DS``)."""
+    return (session or DS).aur
 
 
-def info(pkgnames):
+def info(pkgnames, session=None):
     """Return info about AUR packages.
 
     .. versionchanged:: 3.0.0
@@ -34,40 +41,41 @@ def info(pkgnames):
     if isinstance(pkgnames, str):
         pkgnames = [pkgnames]
 
-    aur_pkgs = RPC.multiinfo(pkgnames)
+    aur_pkgs = _rpc(session).multiinfo(pkgnames)
     if aur_pkgs['type'] == 'error':
         raise AURError(aur_pkgs['error'])
     else:
         return [AURPackage.from_aurdict(d) for d in aur_pkgs['results']]
 
 
-def search(pkgname, search_by='name-desc'):
+def search(pkgname, search_by='name-desc', session=None):
     """Search for AUR packages.
 
     .. versionchanged:: 3.0.0
 
     """
-    aur_pkgs = RPC.search(search_by, pkgname)
+    aur_pkgs = _rpc(session).search(search_by, pkgname)
     if aur_pkgs['type'] == 'error':
         raise AURError(aur_pkgs['error'])
     else:
         return [AURPackage.from_aurdict(d) for d in aur_pkgs['results']]
 
 
-def msearch(maintainer):
+def msearch(maintainer, session=None):
     """Search for AUR packages maintained by a specified user.
 
     .. versionadded:: 3.0.0
 
     """
-    aur_pkgs = RPC.search('maintainer', maintainer)
+    aur_pkgs = _rpc(session).search('maintainer', maintainer)
     if aur_pkgs['type'] == 'error':
         raise AURError(aur_pkgs['error'])
     else:
         return [AURPackage.from_aurdict(d) for d in aur_pkgs['results']]
 
 
-def print_package_search(pkg, cachemode=False, prefix='', prefixp=''):
+def print_package_search(pkg, cachemode=False, prefix='', prefixp='',
+                         session=None):
     """Output/return a package representation.
 
     Based on `pacman -Ss`.
@@ -75,23 +83,24 @@ def print_package_search(pkg, cachemode=False, prefix='', prefixp=''):
     .. versionchanged:: 4.0.0
 
     """
+    ds = session or DS
     termwidth = get_termwidth(9001)
 
-    localdb = DS.pyc.get_localdb()
+    localdb = ds.pyc.get_localdb()
     lpkg = localdb.get_pkg(pkg.name)
     category = ''
     installed = ''
     prefix2 = prefix + '    '
     prefixp2 = prefixp + '    '
     if lpkg is not None:
-        if pyalpm.vercmp(pkg.version, lpkg.version) != 0:
+        if vercmp(pkg.version, lpkg.version) != 0:
             installed = _(' [installed: {0}]').format(lpkg.version)
         else:
             installed = _(' [installed]')
     try:
         if pkg.is_outdated:
-            installed = (installed + ' ' + DS.colors['red'] +
-                         _('[out of date]') + DS.colors['all_off'])
+            installed = (installed + ' ' + ds.colors['red'] +
+                         _('[out of date]') + ds.colors['all_off'])
     except AttributeError:
         pass  # for repository packages
 
@@ -114,10 +123,10 @@ def print_package_search(pkg, cachemode=False, prefix='', prefixp=''):
     if cachemode:
         return entry
     else:
-        print(entry)
+        print(entry, file=ds.stream)
 
 
-def print_package_info(pkgs, cachemode=False):
+def print_package_info(pkgs, cachemode=False, session=None):
     """Output/return a package representation.
 
     Based on `pacman -Ss`.
@@ -125,6 +134,7 @@ def print_package_info(pkgs, cachemode=False):
     .. versionchanged:: 3.3.0
 
     """
+    ds = session or DS
     if pkgs == []:
         raise SanityError(_('Didn’t pass any packages.'),
                           source='utils.print_package_info')
@@ -181,7 +191,7 @@ Keywords       : {key}
             fsb = pkg.added.strftime(fmt)
 
             if pkg.is_outdated:
-                ood = DS.colors['red'] + _('yes') + DS.colors['all_off']
+                ood = ds.colors['red'] + _('yes') + ds.colors['all_off']
             else:
                 ood = _('no')
             termwidth = get_termwidth()
@@ -219,4 +229,4 @@ Keywords       : {key}
     if cachemode:
         return '\n'.join(to)
     else:
-        print('\n'.join(to))
+        print('\n'.join(to), file=ds.stream)
@@ -124,6 +124,8 @@ def wrapper(source='AUTO'):
                   'nocolors', 'depcheck', 'nodepcheck', 'validation',
                   'novalidation', 'install', 'buildonly', 'pgpcheck',
                   'skippgpcheck', 'deep', 'shallow', 'noclean', 'nodebug']
+        pbshorta = ['j']
+        pblonga = ['jobs']
 
         commonshort = ['S', 'd', 'i', 's', 'v', 'w']
         commonlong = ['debug', 'info', 'search', 'sync', 'confirm',
@@ -136,7 +138,7 @@ def wrapper(source='AUTO'):
         ignoredlong = ['unlock']
 
         allpacman = pacmanshort + pacmanlong + pacmanshorta + pacmanlonga
-        allpb = pbshort + pblong  # + pbshorta + pblonga
+        allpb = pbshort + pblong + pbshorta + pblonga
         allcommon = (commonshort + commonlong + commonlongl + commonshortc +
                      commonlongc)
 
@@ -177,6 +179,14 @@ def wrapper(source='AUTO'):
             parser.add_argument('--' + i, action='store', nargs=1,
                                 default='NIL', dest=i)
 
+        for i in pbshorta:
+            parser.add_argument('-' + i, action='store', nargs=1,
+                                default='NIL', dest=i)
+
+        for i in pblonga:
+            parser.add_argument('--' + i, action='store', nargs=1,
+                                default='NIL', dest=i)
+
         for i in commonlongl:
             parser.add_argument('--' + i, action='append', dest=i)
 
@@ -244,6 +254,12 @@ def wrapper(source='AUTO'):
                 elif k in pacmanlonga:
                     pacargs.append('--' + k)
                     pacargs.extend(v)
+                elif k in pbshorta:
+                    pbargs.append('-' + k)
+                    pbargs.extend(v)
+                elif k in pblonga:
+                    pbargs.append('--' + k)
+                    pbargs.extend(v)
                 elif k in commonlongl:
                     for vi in v:
                         pacargs.append('--' + k)
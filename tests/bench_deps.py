@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+# PKGBUILDer micro-benchmarks
+# Copyright © 2011-2018, Chris Warrick.
+# See /LICENSE for licensing information.
+
+"""Compare dependency specification parsing and version comparisons.
+
+The "legacy" functions below reproduce what ``pkgbuilder.build.depcheck``
+did before version 4.3.0.  Run with ``python3 tests/bench_deps.py``.
+"""
+
+import re
+import timeit
+import pyalpm
+import pkgbuilder.deps
+
+# A typical mix, about a third of them versioned.
+SPECS = (['python', 'pyalpm>=0.5.1-1', 'python-requests', 'asp', 'glibc',
+          'qt5-base>=5.11', 'gcc-libs', 'zlib', 'boost-libs=1.67.0',
+          'libfoo.so=1-64', 'lib32-gcc-libs', 'java-runtime<=1:10.0.2-1'] *
+         50)
+ROUNDS = 20
+
+
+def legacy_parse(dep):
+    """Parse a dependency the way depcheck used to."""
+    if re.search('[<=>]', dep):
+        vpat = ('>=<|><=|=><|=<>|<>=|<=>|>=|=>|><|<>|=<|'
+                '<=|>|=|<')
+        ver_base = re.split(vpat, dep)
+        fdep = dep
+        dep = ver_base[0]
+        ver = ver_base[1]
+        diff = re.match('{0}(.*){1}'.format(
+            re.escape(dep), re.escape(ver)), fdep).groups()[0]
+        return dep, diff, ver
+    return dep, None, None
+
+
+def legacy_test(available, difference, wanted):
+    """Test a dependency requirement the way depcheck used to."""
+    if '-' in available:
+        available = available.split('-')[0]
+
+    vercmp = pyalpm.vercmp(available, wanted)
+
+    return (('<' in difference and vercmp == -1) or
+            ('=' in difference and vercmp == 0) or
+            ('>' in difference and vercmp == 1))
+
+
+def run_legacy():
+    for spec in SPECS:
+        name, diff, ver = legacy_parse(spec)
+        if diff is not None:
+            legacy_test('1:2.0-1', diff, ver)
+
+
+def run_depspec():
+    for spec in SPECS:
+        dep = pkgbuilder.deps.parse_depspec(spec)
+        dep.satisfied_by('1:2.0-1')
+
+
+def main():
+    for name, func in (('legacy', run_legacy), ('DepSpec', run_depspec)):
+        best = min(timeit.repeat(func, number=ROUNDS, repeat=5))
+        print('{0:<8} {1:8.2f} µs/spec'.format(
+            name, best / ROUNDS / len(SPECS) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
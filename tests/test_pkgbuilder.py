@@ -32,12 +32,29 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import io
+import os
+import subprocess
+import tarfile
+import tempfile
+import threading
 import unittest
+import types
+from unittest import mock
 import pkgbuilder
 import pkgbuilder.__main__
 import pkgbuilder.aur
 import pkgbuilder.build
+import pkgbuilder.ccache
+import pkgbuilder.cache
+import pkgbuilder.deps
+import pkgbuilder.exceptions
+import pkgbuilder.fetch
 import pkgbuilder.pbds
+import pkgbuilder.plan
+import pkgbuilder.scheduler
+import pkgbuilder.tmpfs
+import pkgbuilder.transaction
 import pkgbuilder.upgrade
 import pkgbuilder.utils
 import pkgbuilder.wrapper
@@ -73,6 +90,1026 @@ class TestPB(unittest.TestCase):
     def test_pbds(self):
         pkgbuilder.pbds.PBDS()
 
+    def test_deps_dbindex(self):
+        def fakepkg(name, version, provides=()):
+            return types.SimpleNamespace(name=name, version=version,
+                                         provides=list(provides))
+
+        local = types.SimpleNamespace(name='local', pkgcache=[
+            fakepkg('foo', '1.0-1', ['libfoo.so=1-64', 'foo-virtual'])])
+        sync = [types.SimpleNamespace(name='core',
+                                      pkgcache=[fakepkg('bar', '2.0-1')]),
+                types.SimpleNamespace(name='extra',
+                                      pkgcache=[fakepkg('bar', '3.0-1'),
+                                                fakepkg('baz', '1.0-1',
+                                                        ['bar=4.0'])])]
+        index = pkgbuilder.deps.DBIndex(local, sync)
+
+        self.assertEqual(index.find_satisfier('foo').version, '1.0-1')
+        self.assertEqual(index.find_satisfier('libfoo.so').name, 'foo')
+        self.assertIsNone(index.find_satisfier('foo', 'sync'))
+        self.assertIsNone(index.find_satisfier(
+            'foo-virtual', test=lambda v: True))
+        # the first repository wins, like in pacman
+        self.assertEqual(index.find_satisfier('bar', 'sync').version, '2.0-1')
+        self.assertEqual(index.find_satisfier(
+            'bar', 'sync', lambda v: v.startswith('4')),
+            ('baz', '1.0-1', ('bar=4.0',), 'extra'))
+
+    def test_deps_depspec(self):
+        spec = pkgbuilder.deps.parse_depspec('java-runtime>=1:10.0.2-1')
+        self.assertEqual(spec, ('java-runtime', '>=', '1:10.0.2-1', '1',
+                                '10.0.2', '1'))
+        self.assertEqual(str(spec), 'java-runtime>=1:10.0.2-1')
+        self.assertTrue(spec.satisfied_by('1:10.0.2-1'))
+        self.assertFalse(spec.satisfied_by('10.0.3-1'))
+
+        spec = pkgbuilder.deps.parse_depspec('qt5-base<5.11')
+        self.assertEqual(spec.name, 'qt5-base')
+        self.assertIsNone(spec.pkgrel)
+        # pkgrel is ignored if the dependency does not have one
+        self.assertFalse(spec.satisfied_by('5.11-2'))
+        self.assertTrue(spec.satisfied_by('5.10.1-2'))
+
+        spec = pkgbuilder.deps.parse_depspec('python')
+        self.assertEqual(spec.name, 'python')
+        self.assertIsNone(spec.version)
+        self.assertTrue(spec.satisfied_by('3.7.0-3'))
+
+        self.assertEqual(pkgbuilder.deps.parse_version('1:2.0-3'),
+                         ('1', '2.0', '3'))
+        self.assertEqual(pkgbuilder.deps.parse_version('20180801'),
+                         (None, '20180801', None))
+
+    def test_cache_srcinfo(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, '.SRCINFO')
+            with open(path, 'w') as fh:
+                fh.write('pkgbase = foo\n\tpkgver = 1\n\tpkgrel = 1\n'
+                         '\tarch = any\n\tdepends = bar\n'
+                         '\tcheckdepends = baz\n\n'
+                         'pkgname = foo\n\npkgname = foo-doc\n')
+
+            cache = pkgbuilder.cache.SrcinfoCache()
+            data, errors = cache.parse(path)
+            self.assertEqual(errors, [])
+            self.assertEqual(sorted(data['packages']), ['foo', 'foo-doc'])
+            # unchanged files are served from the cache
+            self.assertIs(cache.parse(path)[0], data)
+            self.assertEqual(pkgbuilder.build.prepare_deps(path),
+                             ['bar', 'baz'])
+
+            # sessions in other threads may share the cache
+            cache = pkgbuilder.cache.SrcinfoCache()
+            results = []
+            threads = [threading.Thread(
+                target=lambda: results.append(cache.parse(path)))
+                for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual([r[1] for r in results], [[]] * 8)
+            self.assertEqual([r[0] for r in results],
+                             [cache.parse(path)[0]] * 8)
+
+    def test_cache_srcinfo_generate(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            bindir = os.path.join(tmp, 'bin')
+            os.mkdir(bindir)
+            self._fake_commands(
+                bindir, makepkg='sleep 0.1\necho "pkgbase = foo"\n')
+            pkgdirs = []
+            for i in range(8):
+                pkgdirs.append(os.path.join(tmp, 'foo{0}'.format(i)))
+                os.mkdir(pkgdirs[-1])
+                with open(os.path.join(pkgdirs[-1], 'PKGBUILD'), 'w') as fh:
+                    fh.write('pkgname=foo\n')
+
+            # identical PKGBUILDs, generated from several threads at once
+            cache = pkgbuilder.cache.SrcinfoCache(os.path.join(tmp, 'cache'))
+            errors = []
+
+            def generate(pkgdir):
+                try:
+                    cache.generate(pkgdir)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=generate, args=(pkgdir,))
+                       for pkgdir in pkgdirs]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(errors, [])
+            for pkgdir in pkgdirs:
+                with open(os.path.join(pkgdir, '.SRCINFO')) as fh:
+                    self.assertEqual(fh.read(), 'pkgbase = foo\n')
+            self.assertEqual(
+                len(os.listdir(os.path.join(tmp, 'cache', 'srcinfo'))), 1)
+
+    def test_plan_toposort(self):
+        def fakepkg(name, packagebase=None):
+            return pkgbuilder.package.AURPackage(
+                name=name, packagebase=packagebase or name)
+
+        graph = pkgbuilder.plan.BuildGraph()
+        app = graph.add(fakepkg('app'))
+        lib = graph.add(fakepkg('lib-python', 'lib'))
+        graph.register(lib, ['lib', 'lib-python', 'lib-docs'])
+        tool = graph.add(fakepkg('tool'))
+        graph.add_dependency(app, lib)
+        graph.add_dependency(app, tool)
+        graph.add_dependency(lib, tool)
+
+        self.assertIs(graph.get('lib-docs'), lib)
+        self.assertIs(graph.add(fakepkg('lib-docs', 'lib')), lib)
+        self.assertEqual(len(graph), 3)
+        self.assertEqual([n.pkgbase for n in graph.toposort()],
+                         ['tool', 'lib', 'app'])
+
+        self.assertEqual(graph.cycles(), [])
+        self.assertEqual(graph.groups()['lib'],
+                         ['lib', 'lib-docs', 'lib-python'])
+
+        graph.add_dependency(tool, app)
+        self.assertRaises(pkgbuilder.exceptions.PackageError,
+                          graph.toposort)
+        self.assertEqual([sorted(n.pkgbase for n in c)
+                          for c in graph.cycles()],
+                         [['app', 'lib', 'tool']])
+
+    def _fake_commands(self, bindir, **scripts):
+        """Put fake commands (shell scripts) in `bindir`, first in ``PATH``.
+
+        ``os.environ`` is restored when the test ends, even if it fails.
+        """
+        for name, script in scripts.items():
+            path = os.path.join(bindir, name)
+            with open(path, 'w') as fh:
+                fh.write('#!/bin/sh\n' + script)
+            os.chmod(path, 0o755)
+        environ = mock.patch.dict(
+            os.environ, PATH=bindir + os.pathsep + os.environ['PATH'])
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def _rpc_session(self, aurdicts):
+        """Return a session with fake databases, and a fake RPC."""
+        def fakepkg(name, version):
+            return types.SimpleNamespace(name=name, version=version,
+                                         provides=[])
+
+        session = pkgbuilder.pbds.Session()
+        session._dbindex = pkgbuilder.deps.DBIndex(
+            types.SimpleNamespace(name='local',
+                                  pkgcache=[fakepkg('python', '3.7.0-3')]),
+            [types.SimpleNamespace(name='extra',
+                                   pkgcache=[fakepkg('cmake', '3.12.0-1')])])
+        requests = []
+
+        def info(names, session=None):
+            requests.append(list(names))
+            return [pkgbuilder.package.AURPackage.from_aurdict(dict(
+                aurdicts[n], OutOfDate=None, FirstSubmitted=1316529993,
+                LastModified=1395757472)) for n in names if n in aurdicts]
+
+        return session, info, requests
+
+    def test_build_resolve_closure(self):
+        aurdicts = {
+            'app': {'Name': 'app', 'PackageBase': 'app', 'Version': '1.0-1',
+                    'Depends': ['python', 'lib-python>=2'],
+                    'MakeDepends': ['cmake'], 'CheckDepends': ['testlib']},
+            'lib-python': {'Name': 'lib-python', 'PackageBase': 'lib',
+                           'Version': '2.0-1', 'Depends': ['testlib']},
+            'testlib': {'Name': 'testlib', 'PackageBase': 'testlib',
+                        'Version': '1.0-1'},
+        }
+        session, info, requests = self._rpc_session(aurdicts)
+        with mock.patch('pkgbuilder.utils.info', info):
+            graph = pkgbuilder.build.resolve_closure(['app'], session=session)
+
+            # one request per level of the tree
+            self.assertEqual(requests, [['app'], ['lib-python', 'testlib']])
+            app = graph.get('app')
+            self.assertEqual(app.repodeps, ['cmake'])
+            self.assertEqual(app.depends, {'lib', 'testlib'})
+            self.assertEqual(graph.get('lib-python').pkgbase, 'lib')
+            self.assertEqual(graph.get('lib-python').required, {'lib-python'})
+            self.assertEqual([n.pkgbase for n in graph.toposort()],
+                             ['testlib', 'lib', 'app'])
+
+            aurdicts['lib-python']['Version'] = '1.0-1'
+            self.assertRaises(pkgbuilder.exceptions.PackageError,
+                              pkgbuilder.build.resolve_closure, ['app'],
+                              session=session)
+            aurdicts['lib-python']['Version'] = '2.0-1'
+            del aurdicts['testlib']
+            self.assertRaises(pkgbuilder.exceptions.PackageNotFoundError,
+                              pkgbuilder.build.resolve_closure, ['app'],
+                              session=session)
+
+    def test_build_plan_rpc(self):
+        aurdicts = {
+            'app': {'Name': 'app', 'PackageBase': 'app', 'Version': '1.0-1',
+                    'Depends': ['lib']},
+            'lib': {'Name': 'lib', 'PackageBase': 'lib', 'Version': '1.0-1'},
+            'extra': {'Name': 'extra', 'PackageBase': 'extra',
+                      'Version': '1.0-1'},
+        }
+        # .SRCINFO is authoritative: app needs extra on this architecture
+        srcinfos = {
+            'app': 'depends = lib\n\tdepends_{0} = extra\n\tdepends = cmake',
+            'lib': 'depends = python',
+            'extra': 'arch = any',
+        }
+        session, info, requests = self._rpc_session(aurdicts)
+        fetched = []
+
+        def fetch_nodes(nodes, workers=None, pkginstall=True, session=None):
+            for node in nodes:
+                fetched.append(node.pkgbase)
+                os.mkdir(node.path)
+                with open(os.path.join(node.path, '.SRCINFO'), 'w') as fh:
+                    fh.write('pkgbase = {0}\n\tpkgver = 1.0\n\tpkgrel = 1\n'
+                             '\t{1}\n\npkgname = {0}\n'.format(
+                                 node.pkgbase,
+                                 srcinfos[node.pkgbase].format(
+                                     pkgbuilder.build.platform.machine())))
+            return nodes
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with mock.patch('pkgbuilder.utils.info', info), \
+                    mock.patch('pkgbuilder.build.fetch_nodes', fetch_nodes), \
+                    mock.patch.object(session, 'fancy_warning2') as warning:
+                graph = pkgbuilder.build.plan_rpc(['app'], destdir=tmp,
+                                                  session=session)
+                warning.assert_called_once_with(
+                    '.SRCINFO of app does not match the AUR metadata, '
+                    'updating the plan')
+
+            self.assertEqual(fetched, ['app', 'lib', 'extra'])
+            app = graph.get('app')
+            self.assertEqual(app.depends, {'lib', 'extra'})
+            self.assertEqual(app.repodeps, ['cmake'])
+            self.assertEqual(graph.get('extra').required, {'extra'})
+            self.assertEqual(graph.get('lib').repodeps, [])
+
+            # a matching .SRCINFO leaves the plan alone
+            lib = graph.get('lib')
+            self.assertEqual(pkgbuilder.build.verify_node(lib, graph,
+                                                          session=session),
+                             [])
+            self.assertEqual(lib.depends, set())
+
+    def test_build_fetch_nodes(self):
+        aurdicts = {name: {'Name': name, 'PackageBase': name,
+                           'Version': '1.0-1'}
+                    for name in ('good', 'broken', 'missing')}
+        session, info, requests = self._rpc_session(aurdicts)
+        session.stream = io.StringIO()
+
+        def fetch_aur(pkg, destdir=None, quiet=False, session=None):
+            if pkg.name == 'broken':
+                raise subprocess.CalledProcessError(1, ['makepkg'])
+            elif pkg.name == 'missing':
+                raise FileNotFoundError(2, 'No such file or directory')
+            path = os.path.join(destdir, pkg.packagebase)
+            os.makedirs(path)
+            with open(os.path.join(path, '.SRCINFO'), 'w') as fh:
+                fh.write('pkgbase = good\n')
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch('pkgbuilder.build.fetch_aur', fetch_aur):
+            graph = pkgbuilder.plan.BuildGraph(tmp)
+            for pkg in info(list(aurdicts)):
+                graph.add(pkg)
+            with self.assertRaises(pkgbuilder.exceptions.FetchError) as cm:
+                pkgbuilder.build.fetch_nodes(list(graph), session=session)
+            # all failures are reported, the rest is still fetched
+            self.assertEqual(sorted(cm.exception.errors),
+                             ['broken', 'missing'])
+            self.assertIn('broken: ', str(cm.exception))
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'good',
+                                                        '.SRCINFO')))
+            self.assertRaises(pkgbuilder.exceptions.FetchError,
+                              pkgbuilder.build.fetch_nodes,
+                              [graph.get('broken')], session=session)
+
+    def test_build_destdir(self):
+        aurdicts = {'foo': {'Name': 'foo', 'PackageBase': 'foo',
+                            'Version': '1.0-1'}}
+        session, info, requests = self._rpc_session(aurdicts)
+        session.stream = io.StringIO()
+        session.buildcachesize = 0
+
+        def fetch_aur(pkg, destdir=None, quiet=False, session=None):
+            path = os.path.join(destdir, pkg.packagebase)
+            os.makedirs(path, exist_ok=True)
+            for name in ('PKGBUILD', '.SRCINFO'):
+                with open(os.path.join(path, name), 'w') as fh:
+                    fh.write('pkgbase = foo\n\tpkgver = 1.0\n\tpkgrel = 1\n'
+                             '\tarch = any\n\npkgname = foo\n')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            self._fake_commands(tmp, makepkg=(
+                'pkg="$PWD/foo-1.0-1-any.pkg.tar.xz"\n'
+                'case "$1" in\n'
+                '--packagelist) echo "$pkg";;\n'
+                '--verifysource) ;;\n'
+                '*) echo "$PWD" >> "$MAKEPKGLOG"; touch "$pkg";;\n'
+                'esac\n'))
+            log = os.path.join(tmp, 'makepkg.log')
+            cwd = os.getcwd()
+            os.environ['MAKEPKGLOG'] = log
+            with mock.patch('pkgbuilder.utils.info', info), \
+                    mock.patch('pkgbuilder.build.fetch_aur', fetch_aur), \
+                    mock.patch('os.chdir',
+                               side_effect=AssertionError('chdir')):
+                for n, func in enumerate((pkgbuilder.build.build_runner,
+                                          pkgbuilder.build.auto_build)):
+                    destdir = os.path.join(tmp, str(n))
+                    os.mkdir(destdir)
+                    status, (pkgpaths, sigpaths) = func(
+                        'foo', destdir=destdir, session=session)
+                    self.assertEqual(status, 0)
+                    self.assertEqual(pkgpaths, [os.path.join(
+                        destdir, 'foo', 'foo-1.0-1-any.pkg.tar.xz')])
+                    self.assertEqual(os.getcwd(), cwd)
+
+            with open(log) as fh:
+                self.assertEqual(fh.read().split(),
+                                 [os.path.join(tmp, '0', 'foo'),
+                                  os.path.join(tmp, '1', 'foo')])
+
+    def test_build_select_packagefiles(self):
+        files = (['/b/foo-1.0-1-x86_64.pkg.tar.xz',
+                  '/b/foo-libs-1.0-1-x86_64.pkg.tar.xz',
+                  '/b/foo-libs-0.9-1-x86_64.pkg.tar.xz'],
+                 ['/b/foo-libs-1.0-1-x86_64.pkg.tar.xz.sig'])
+        self.assertEqual(pkgbuilder.build.split_pkgfile(files[1][0]),
+                         ('foo-libs', '1.0-1', 'x86_64'))
+        # no substring matches
+        self.assertEqual(pkgbuilder.build.select_packagefiles(
+            files, ['foo'], '1.0-1'), (files[0][:1], []))
+        self.assertEqual(pkgbuilder.build.select_packagefiles(
+            files, ['foo-libs'], '1.0-1'), (files[0][1:2], files[1]))
+        self.assertEqual(len(pkgbuilder.build.select_packagefiles(
+            files, ['foo-libs'])[0]), 2)
+
+    def test_build_checkout_state(self):
+        srcinfo = ('pkgbase = pkgbuilder\n\tpkgver = {0}\n\tpkgrel = 1\n'
+                   '\tarch = any\n\npkgname = pkgbuilderts\n')
+        env = dict(os.environ, GIT_AUTHOR_NAME='PB', GIT_COMMITTER_NAME='PB',
+                   GIT_AUTHOR_EMAIL='pb@localhost',
+                   GIT_COMMITTER_EMAIL='pb@localhost',
+                   GIT_COMMITTER_DATE='1395757000 +0000')
+        with tempfile.TemporaryDirectory() as path:
+            with open(os.path.join(path, '.SRCINFO'), 'w') as fh:
+                fh.write(srcinfo.format('3.2.0'))
+            for cmd in (['init', '-q'], ['add', '.SRCINFO'],
+                        ['commit', '-q', '-m', 'init']):
+                subprocess.check_call(['git'] + cmd, cwd=path, env=env)
+            state = pkgbuilder.build.checkout_state
+            # committed before LastModified, nothing recorded
+            self.assertIsNone(state(path, self.fpkg))
+            pkgbuilder.build._record_checkout(path, self.fpkg)
+            self.assertTrue(state(path, self.fpkg))
+            with open(os.path.join(path, '.SRCINFO'), 'w') as fh:
+                fh.write(srcinfo.format('3.1.0'))
+            self.assertFalse(state(path, self.fpkg))
+
+    def test_cache_mirrorstore(self):
+        env = dict(os.environ, GIT_AUTHOR_NAME='PB', GIT_COMMITTER_NAME='PB',
+                   GIT_AUTHOR_EMAIL='pb@localhost',
+                   GIT_COMMITTER_EMAIL='pb@localhost')
+        with tempfile.TemporaryDirectory() as tmp:
+            upstream = os.path.join(tmp, 'upstream')
+            os.mkdir(upstream)
+            with open(os.path.join(upstream, 'PKGBUILD'), 'w') as fh:
+                fh.write('pkgname=foo\n')
+            for cmd in (['init', '-q'], ['add', 'PKGBUILD'],
+                        ['commit', '-q', '-m', 'init']):
+                subprocess.check_call(['git'] + cmd, cwd=upstream, env=env)
+
+            store = pkgbuilder.cache.MirrorStore(os.path.join(tmp, 'git'))
+            mirror = store.update('foo', upstream, 1000, quiet=True)
+            self.assertEqual(mirror, os.path.join(tmp, 'git', 'foo.git'))
+            # recorded modification time matches, no fetch
+            self.assertEqual(store.update('foo', upstream, 1000), mirror)
+            for name, depth in (('deep', None), ('shallow', 1)):
+                checkout = os.path.join(tmp, name)
+                store.checkout('foo', checkout, upstream, quiet=True,
+                               depth=depth)
+                self.assertTrue(os.path.exists(os.path.join(checkout,
+                                                            'PKGBUILD')))
+                # no objects borrowed from the mirror
+                self.assertFalse(os.path.exists(os.path.join(
+                    checkout, '.git', 'objects', 'info', 'alternates')))
+                self.assertEqual(os.path.exists(os.path.join(
+                    checkout, '.git', 'shallow')), depth is not None)
+                self.assertEqual(subprocess.check_output(
+                    ['git', 'remote', 'get-url', 'origin'],
+                    cwd=checkout).decode('utf-8').strip(), upstream)
+
+    def test_build_fetch_asp(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self._fake_commands(tmp, asp=(
+                'if [ "$1" = update ]; then exit $ASPSTATUS; fi\n'
+                'mkdir "$2" && touch "$2/PKGBUILD"\n'))
+            destdir = os.path.join(tmp, 'build')
+            os.mkdir(destdir)
+            pkgs = [pkgbuilder.package.ABSPackage(name=name, version='1-1')
+                    for name in ('foo', 'bar')]
+            os.environ['ASPSTATUS'] = '0'
+            self.assertEqual(pkgbuilder.build.fetch_asp(
+                pkgs, destdir, srcinfo=False), {})
+            self.assertEqual(sorted(os.listdir(destdir)), ['bar', 'foo'])
+
+            os.environ['ASPSTATUS'] = '1'
+            self.assertRaises(pkgbuilder.exceptions.NetworkError,
+                              pkgbuilder.build.fetch_asp, pkgs, destdir)
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+                with self.assertRaises(SystemExit) as cm:
+                    pkgbuilder.build.fetch_runner(pkgs, preprocessed=True,
+                                                  destdir=destdir)
+            self.assertEqual(cm.exception.code, 1)
+            self.assertIn(':: ERROR: Failed to update ASP for foo, bar.',
+                          out.getvalue())
+
+    def test_build_snapshot(self):
+        def tarball(*names):
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+                for name in names:
+                    info = tarfile.TarInfo(name)
+                    info.size = 3
+                    tar.addfile(info, io.BytesIO(b'foo'))
+            return buf.getvalue()
+
+        session = pkgbuilder.pbds.Session()
+        session._aur = types.SimpleNamespace(download=lambda urlpath: data)
+        with tempfile.TemporaryDirectory() as tmp:
+            data = tarball('pkgbuilder/PKGBUILD', 'pkgbuilder/.SRCINFO')
+            path = pkgbuilder.build.snapshot(self.fpkg, tmp, session=session)
+            self.assertEqual(path, os.path.join(tmp, 'pkgbuilder'))
+            self.assertTrue(os.path.exists(os.path.join(path, '.SRCINFO')))
+            # current snapshots are not downloaded again
+            data = None
+            pkgbuilder.build.snapshot(self.fpkg, tmp, session=session)
+            self.assertEqual(sorted(os.listdir(tmp)), ['pkgbuilder'])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            data = tarball('pkgbuilder/PKGBUILD', 'pkgbuilder/../../evil')
+            self.assertRaises(pkgbuilder.exceptions.PackageError,
+                              pkgbuilder.build.snapshot, self.fpkg, tmp,
+                              session=session)
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_cache_buildcache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = pkgbuilder.cache.BuildCache(os.path.join(tmp, 'cache'),
+                                                maxsize=10)
+            paths = []
+            for name, data in (('foo-1-1-any.pkg.tar.xz', b'123456'),
+                               ('bar-1-1-any.pkg.tar.xz', b'abcdef')):
+                paths.append(os.path.join(tmp, name))
+                with open(paths[-1], 'wb') as fh:
+                    fh.write(data)
+
+            cache.store('foo', paths[:1])
+            self.assertIsNone(cache.lookup('nope', tmp))
+            restored = cache.lookup('foo', os.path.join(tmp, 'out'))
+            self.assertEqual(restored, [os.path.join(
+                tmp, 'out', 'foo-1-1-any.pkg.tar.xz')])
+            with open(restored[0], 'rb') as fh:
+                self.assertEqual(fh.read(), b'123456')
+
+            # 12 bytes > 10, the least recently used entry goes
+            os.utime(cache._entry('foo'), (0, 0))
+            cache.store('bar', paths[1:])
+            self.assertIsNone(cache.lookup('foo', tmp))
+            self.assertIsNotNone(cache.lookup('bar', tmp))
+
+    def test_cache_buildcache_shared(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = os.path.join(tmp, 'store')
+            path = os.path.join(tmp, 'foo-1-1-any.pkg.tar.xz')
+            with open(path, 'wb') as fh:
+                fh.write(b'123456')
+            # several hosts publishing the same build at once
+            threads = [threading.Thread(
+                target=pkgbuilder.cache.BuildCache(store).store,
+                args=('foo', [path, path])) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            restored = pkgbuilder.cache.BuildCache(store).lookup(
+                'foo', os.path.join(tmp, 'out'))
+            self.assertEqual(restored, [os.path.join(
+                tmp, 'out', 'foo-1-1-any.pkg.tar.xz')])
+            leftovers = [name for _root, _dirs, files in os.walk(store)
+                         for name in files if name.endswith('.tmp')]
+            self.assertEqual(leftovers, [])
+
+    def test_cache_buildcache_threads(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = os.path.join(tmp, 'store')
+            paths = []
+            for i in range(8):
+                paths.append(os.path.join(tmp, 'p{0}-1-1-any.pkg.tar.xz'
+                                          .format(i)))
+                with open(paths[-1], 'wb') as fh:
+                    fh.write(b'x' * (i + 1))
+            errors = []
+
+            def run(func, *args):
+                try:
+                    for i in range(20):
+                        func(*args)
+                except Exception as e:
+                    errors.append(e)
+
+            # builds of one process storing and evicting at once
+            cache = pkgbuilder.cache.BuildCache(store, maxsize=12)
+            threads = [threading.Thread(target=run, args=(
+                cache.store, 'p{0}'.format(i), [path]))
+                for i, path in enumerate(paths)]
+            threads += [threading.Thread(target=run, args=(cache.evict,))
+                        for i in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(errors, [])
+            # every entry that survived eviction can be restored
+            for i in range(8):
+                key = 'p{0}'.format(i)
+                restored = cache.lookup(key, os.path.join(tmp, 'out'))
+                self.assertEqual(restored is None,
+                                 not os.path.exists(cache._entry(key)))
+                if restored is not None:
+                    with open(restored[0], 'rb') as fh:
+                        self.assertEqual(fh.read(), b'x' * (i + 1))
+            self.assertIsNone(pkgbuilder.cache._cache_lock(store)._fh)
+
+    def test_tmpfs_builds(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pkgdir = os.path.join(tmp, 'foo')
+            os.mkdir(pkgdir)
+            with open(os.path.join(pkgdir, 'foo-1.tar.gz'), 'wb') as fh:
+                fh.write(b'x' * 1024)
+            node = types.SimpleNamespace(pkgbase='foo', path=pkgdir)
+            history = os.path.join(tmp, 'cache', 'tmpfs.json')
+            builds = pkgbuilder.tmpfs.TmpfsBuilds(
+                os.path.join(tmp, 'shm'), history, interval=0.01)
+            self.assertEqual(builds.estimate(node),
+                             pkgbuilder.tmpfs.MIN_ESTIMATE)
+
+            with builds.builddir(node) as builddir:
+                self.assertEqual(builddir, os.path.join(tmp, 'shm'))
+                srcdir = os.path.join(builddir, 'foo', 'src')
+                os.makedirs(srcdir)
+                with open(os.path.join(srcdir, 'big'), 'wb') as fh:
+                    fh.write(b'x' * 1024 * 1024)
+            self.assertFalse(os.path.exists(os.path.join(builddir, 'foo')))
+            peak = builds.peaks['foo']
+            self.assertGreaterEqual(peak, 1024 * 1024)
+
+            # the peak is remembered for the next estimate
+            builds = pkgbuilder.tmpfs.TmpfsBuilds(os.path.join(tmp, 'shm'),
+                                                  history)
+            self.assertEqual(builds.history(), {'foo': peak})
+            builds._capacity = 0
+            with builds.builddir(node) as builddir:
+                self.assertIsNone(builddir)
+
+    def test_tmpfs_builds_full(self):
+        mib = 1024 * 1024
+        with tempfile.TemporaryDirectory() as tmp:
+            node = types.SimpleNamespace(pkgbase='foo', path=tmp)
+            builds = pkgbuilder.tmpfs.TmpfsBuilds(os.path.join(tmp, 'shm'),
+                                                  interval=60)
+            builds._capacity = 100 * mib
+            # another build holds 30 MiB, the tmpfs is full
+            builds._reserved = 30 * mib
+            statvfs = types.SimpleNamespace(f_bavail=0, f_frsize=4096)
+
+            def build(peak, fail):
+                with mock.patch('os.statvfs', return_value=statvfs), \
+                        mock.patch('pkgbuilder.tmpfs.dir_size',
+                                   return_value=peak * mib):
+                    with builds.builddir(node):
+                        if fail:
+                            builds.failed(node)
+                return builds.history()['foo'] // mib
+
+            # successful builds are never blamed
+            self.assertEqual(build(60, False), 60)
+            # neither are small ones that failed next to a big one
+            self.assertEqual(build(1, True), 1)
+            self.assertNotIn('foo', builds.full)
+            # a failed build that used its whole share filled the tmpfs
+            self.assertEqual(build(60, True), 100)
+            self.assertIn('foo', builds.full)
+            self.assertEqual(builds._reserved, 30 * mib)
+
+    def test_ccache_compilercache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cc = pkgbuilder.ccache.CompilerCache(
+                'ccache', os.path.join(tmp, 'ccache'), 100, ['bar'])
+            self.assertTrue(cc.enabled_for('foo', ['strip']))
+            self.assertFalse(cc.enabled_for('foo', ['!ccache']))
+            self.assertFalse(cc.enabled_for('bar'))
+
+            with cc.build('foo', {'PATH': '/usr/bin'}) as env:
+                self.assertEqual(env['PATH'], '/usr/lib/ccache/bin:/usr/bin')
+                self.assertEqual(env['CCACHE_MAXSIZE'], '100M')
+                with open(env['CCACHE_STATSLOG'], 'w') as fh:
+                    fh.write('# a.c\ndirect_cache_hit\n# b.c\ncache_miss\n'
+                             '# c.c\npreprocessed_cache_hit\n')
+            self.assertEqual(cc.stats, {'foo': (2, 1)})
+            self.assertFalse(os.path.exists(env['CCACHE_STATSLOG']))
+
+    def test_scheduler_cpubudget(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self._fake_commands(tmp, make='echo "GNU Make $MAKEVERSION"\n')
+            os.environ['MAKEVERSION'] = '4.3'
+            with pkgbuilder.scheduler.CPUBudget(8, 3) as budget:
+                self.assertEqual(budget.makeflags, '-j2')
+
+            os.environ['MAKEVERSION'] = '4.4.1'
+            with pkgbuilder.scheduler.CPUBudget(8, 3) as budget:
+                fifo = budget.fifo
+                self.assertEqual(
+                    budget.environment({})['MAKEFLAGS'],
+                    '-j2 --jobserver-auth=fifo:' + fifo)
+                fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+                try:
+                    # 8 cores, less one implicit slot for every build
+                    self.assertEqual(os.read(fd, 100), b'+' * 5)
+                finally:
+                    os.close(fd)
+            self.assertFalse(os.path.exists(fifo))
+
+    def test_scheduler_parallelbuilder(self):
+        def fakepkg(name):
+            return pkgbuilder.package.AURPackage(name=name, packagebase=name,
+                                                 version='1.0-1')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            graph = pkgbuilder.plan.BuildGraph(tmp)
+            lib = graph.add(fakepkg('lib'))
+            app = graph.add(fakepkg('app'))
+            broken = graph.add(fakepkg('broken'))
+            plugin = graph.add(fakepkg('plugin'))
+            graph.add_dependency(app, lib)
+            graph.add_dependency(plugin, broken)
+            lib.required.add('lib')
+            broken.required.add('broken')
+            app.targets.add('app')
+            plugin.targets.add('plugin')
+
+            installed = []
+            started = {}
+
+            def build_node(node, pkginstall=True, logfile=None, env=None,
+                           session=None):
+                started[node.pkgbase] = list(installed)
+                status = 1 if node.pkgbase == 'broken' else 0
+                node.result = [status, ([os.path.join(
+                    tmp, node.pkgbase + '-1.0-1-any.pkg.tar.xz')], [])]
+                return node.result
+
+            def install_deps(nodes, session=None):
+                installed.extend(node.pkgbase for node in nodes)
+
+            session = pkgbuilder.pbds.Session(jobserver=False)
+            builder = pkgbuilder.scheduler.ParallelBuilder(graph, 2,
+                                                           session=session)
+            with mock.patch('pkgbuilder.build.build_node', build_node), \
+                    mock.patch('pkgbuilder.build.install_deps',
+                               install_deps):
+                status, (pkgpaths, sigpaths) = builder.run()
+
+            # dependencies are installed as soon as they are built, and
+            # dependents start only after that
+            self.assertEqual(installed, ['lib'])
+            self.assertEqual(started['app'], ['lib'])
+            # dependents of failed builds are skipped
+            self.assertNotIn('plugin', started)
+            self.assertEqual(builder.failed, {'broken': 1, 'plugin': None})
+            self.assertEqual(status, 1)
+            self.assertEqual(pkgpaths, [os.path.join(
+                tmp, 'app-1.0-1-any.pkg.tar.xz')])
+
+    def test_build_install_deps(self):
+        node = pkgbuilder.plan.BuildNode(types.SimpleNamespace(
+            name='foo', packagebase='foo', is_abs=False))
+        node.path = '/tmp/foo'
+        node.subpackages = ['foo', 'libfoo']
+        node.required = {'foo', 'libfoo'}
+        node.targets = {'foo'}
+        node.result = [0, (['/tmp/foo/foo-1.0-1-any.pkg.tar.xz',
+                            '/tmp/foo/libfoo-1.0-1-any.pkg.tar.xz'], [])]
+        session = pkgbuilder.pbds.Session(validation=False)
+        with mock.patch('pkgbuilder.transaction.Transaction') as tx, \
+                mock.patch.object(session, '_pycreload') as reload:
+            pkgbuilder.build.install_deps([node], session=session)
+        # targets are not installed as dependencies
+        self.assertEqual(
+            [(c[1]['pkgnames'], c[1]['pkgpaths'], c[1]['asdeps'])
+             for c in tx.call_args_list],
+            [(['libfoo'], ['/tmp/foo/libfoo-1.0-1-any.pkg.tar.xz'], True),
+             (['foo'], ['/tmp/foo/foo-1.0-1-any.pkg.tar.xz'], False)])
+        self.assertEqual(reload.call_count, 2)
+
+    @mock.patch.dict(os.environ, MAKEFLAGS='-j4 -l3')
+    def test_build_makepkg_env(self):
+        # serial builds keep the MAKEFLAGS of the user
+        session = pkgbuilder.pbds.Session(srcdest='/tmp/sources')
+        mpenv = pkgbuilder.build.makepkg_env(session=session)
+        self.assertEqual(mpenv['MAKEFLAGS'], '-j4 -l3')
+        self.assertEqual(mpenv['SRCDEST'], '/tmp/sources')
+
+        session = pkgbuilder.pbds.Session(cores=2)
+        self.assertEqual(pkgbuilder.build.makepkg_env(
+            session=session)['MAKEFLAGS'], '-j2')
+
+    def test_cache_pacmancacheindex(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            index = pkgbuilder.cache.PacmanCacheIndex([tmp])
+            name = 'foo-1-1-any.pkg.tar.xz'
+            self.assertIsNone(index.find(name))
+            with open(os.path.join(tmp, name), 'w') as fh:
+                fh.write(name)
+            # the listing is stale until the directory mtime changes
+            os.utime(tmp, ns=(0, 0))
+            index._listings[tmp] = (0, set())
+            self.assertIsNone(index.find(name))
+            os.utime(tmp, ns=(0, 1))
+            self.assertEqual(index.find(name), os.path.join(tmp, name))
+
+    def test_build_pacman_cache(self):
+        srcinfo = ('pkgbase = foo\n\tpkgver = 1.0\n\tpkgrel = 1\n'
+                   '\tarch = any\n\npkgname = foo\n')
+        with tempfile.TemporaryDirectory() as tmp:
+            self._fake_commands(
+                tmp, makepkg='echo "$PWD/foo-1.0-1-any.pkg.tar.xz"\n')
+            cachedir = os.path.join(tmp, 'pkg')
+            os.mkdir(cachedir)
+            with open(os.path.join(cachedir, 'foo-1.0-1-any.pkg.tar.xz'),
+                      'w') as fh:
+                fh.write('foo')
+
+            graph = pkgbuilder.plan.BuildGraph(tmp)
+            aur = graph.add(pkgbuilder.package.AURPackage(
+                name='foo', packagebase='foo', version='1.0-1'))
+            aur.targets.add('foo')
+            aur.path = os.path.join(tmp, 'foo')
+            repo = graph.add(pkgbuilder.package.ABSPackage(
+                name='bar', version='1.0-1'))
+            repo.path = os.path.join(tmp, 'bar')
+            for node in (aur, repo):
+                os.mkdir(node.path)
+                for name in ('PKGBUILD', '.SRCINFO'):
+                    with open(os.path.join(node.path, name), 'w') as fh:
+                        fh.write(srcinfo)
+
+            session = pkgbuilder.pbds.Session(buildcachesize=0)
+            session._pacman_cache = pkgbuilder.cache.PacmanCacheIndex(
+                [cachedir])
+            # -w builds do not look at the pacman cache
+            with mock.patch('pkgbuilder.build.plan_rpc',
+                            return_value=graph):
+                pkgbuilder.build.plan_build(['foo', 'bar'],
+                                            pkginstall=False,
+                                            session=session)
+                self.assertIsNone(aur.existing)
+                pkgbuilder.build.plan_build(['foo', 'bar'],
+                                            session=session)
+
+            self.assertEqual(aur.existing, ([os.path.join(
+                cachedir, 'foo-1.0-1-any.pkg.tar.xz')], []))
+            # ABS packages would resolve to the official binaries
+            self.assertIsNone(repo.existing)
+            self.assertFalse(pkgbuilder.build._find_in_pacman_cache(
+                repo, session=session))
+
+    def test_build_find_packagefile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            bindir = os.path.join(tmp, 'bin')
+            os.mkdir(bindir)
+            self._fake_commands(bindir, makepkg=(
+                'echo run >> "$PBLOG"\n'
+                'echo "$PWD/foo-1.0-1-any.pkg.tar.xz"\n'
+                'echo "$PWD/foo-doc-1.0-1-any.pkg.tar.xz"\n'))
+            pkgdir = os.path.join(tmp, 'foo')
+            os.mkdir(pkgdir)
+            for name in ('PKGBUILD', 'foo-1.0-1-any.pkg.tar.xz',
+                         'foo-1.0-1-any.pkg.tar.xz.sig',
+                         'foo-0.9-1-any.pkg.tar.xz'):
+                with open(os.path.join(pkgdir, name), 'w') as fh:
+                    fh.write(name)
+
+            os.environ['PBLOG'] = os.path.join(tmp, 'log')
+            session = pkgbuilder.pbds.Session()
+            for i in range(2):
+                self.assertEqual(
+                    pkgbuilder.build.find_packagefile(pkgdir,
+                                                      session=session),
+                    ([os.path.join(pkgdir, 'foo-1.0-1-any.pkg.tar.xz')],
+                     [os.path.join(pkgdir,
+                                   'foo-1.0-1-any.pkg.tar.xz.sig')]))
+            with open(os.path.join(tmp, 'log')) as fh:
+                self.assertEqual(fh.read(), 'run\n')
+
+    def test_build_fetch_sources(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self._fake_commands(tmp, makepkg=(
+                'echo "$SRCDEST $*" > called\n'
+                'echo "ERROR: One or more files did not pass the '
+                'validity check!"\n'
+                '[ "${PWD##*/}" != broken ]\n'))
+            srcdest = os.path.join(tmp, 'sources')
+            graph = pkgbuilder.plan.BuildGraph(tmp)
+            for name in ('good', 'broken', 'built'):
+                node = graph.add(pkgbuilder.package.AURPackage(
+                    name=name, packagebase=name, version='1.0-1'))
+                os.mkdir(node.path)
+            graph.get('built').existing = ([os.path.join(
+                tmp, 'built-1.0-1-any.pkg.tar.xz')], [])
+
+            session = pkgbuilder.pbds.Session(srcdest=srcdest,
+                                              pgpcheck=False)
+            errors = pkgbuilder.build.fetch_sources(graph,
+                                                    session=session)
+
+            # failures are returned, not raised
+            self.assertEqual(list(errors), ['broken'])
+            self.assertIsInstance(errors['broken'],
+                                  pkgbuilder.exceptions.MakepkgError)
+            self.assertEqual(errors['broken'].retcode, 1)
+            with open(os.path.join(tmp, 'good', 'called')) as fh:
+                self.assertEqual(fh.read(), srcdest + ' --verifysource '
+                                 '--nodeps --noconfirm --nocolor '
+                                 '--skippgpcheck\n')
+            # packages that were found already are not downloaded again
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'built',
+                                                         'called')))
+
+    def test_build_compression(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self._fake_commands(tmp, makepkg=(
+                'echo "$PWD/foo-1.0-1-any${PKGEXT:-.pkg.tar.xz}"\n'))
+            for name in ('PKGBUILD', 'foo-1.0-1-any.pkg.tar.xz',
+                         'foo-1.0-1-any.pkg.tar.zst',
+                         'foo-1.0-1-any.pkg.tar'):
+                with open(os.path.join(tmp, name), 'w') as fh:
+                    fh.write(name)
+
+            os.environ['MAKEPKG_CONF'] = '/etc/my makepkg.conf'
+            for compression, pkgext in (('default', '.pkg.tar.xz'),
+                                        ('fast', '.pkg.tar.zst'),
+                                        ('none', '.pkg.tar')):
+                session = pkgbuilder.pbds.Session(compression=compression,
+                                                  cachedir=tmp, cores=4)
+                self.assertEqual(
+                    pkgbuilder.build.find_packagefile(tmp,
+                                                      session=session),
+                    ([os.path.join(tmp, 'foo-1.0-1-any' + pkgext)], []))
+                mpenv = pkgbuilder.build.makepkg_env(session=session)
+                self.assertEqual(mpenv.get('PKGEXT'),
+                                 None if compression == 'default'
+                                 else pkgext)
+                if compression != 'fast':
+                    self.assertEqual(mpenv['MAKEPKG_CONF'],
+                                     '/etc/my makepkg.conf')
+                    continue
+                # the system makepkg.conf is read first
+                with open(mpenv['MAKEPKG_CONF']) as fh:
+                    conf = fh.read().splitlines()
+                self.assertEqual(conf[1],
+                                 "source '/etc/my makepkg.conf'")
+                self.assertEqual(conf[-1],
+                                 'COMPRESSZST=(zstd -c -T4 -1 -)')
+                self.assertEqual(
+                    pkgbuilder.build.makepkg_env(
+                        session=session)['MAKEPKG_CONF'],
+                    mpenv['MAKEPKG_CONF'])
+
+            # packages that are not installed are not affected
+            mpenv = pkgbuilder.build.makepkg_env(False, session=session)
+            self.assertNotIn('PKGEXT', mpenv)
+            self.assertEqual(mpenv['MAKEPKG_CONF'],
+                             '/etc/my makepkg.conf')
+            self.assertEqual(
+                pkgbuilder.build.find_packagefile(tmp, False,
+                                                  session=session),
+                ([os.path.join(tmp, 'foo-1.0-1-any.pkg.tar.xz')], []))
+
+    def test_build_key(self):
+        srcinfo = ('pkgbase = foo\n\tpkgver = 1\n\tpkgrel = 1\n'
+                   '\tarch = any\n\tsource = {0}\n\npkgname = foo\n')
+        graph = pkgbuilder.plan.BuildGraph()
+        node = types.SimpleNamespace()
+        session = pkgbuilder.pbds.Session()
+        session._dbindex = pkgbuilder.deps.DBIndex(
+            types.SimpleNamespace(pkgcache=[]), [])
+        with tempfile.TemporaryDirectory() as tmp:
+            node.path = tmp
+            for name in ('PKGBUILD', 'foo.patch'):
+                with open(os.path.join(tmp, name), 'w') as fh:
+                    fh.write(name)
+            with open(os.path.join(tmp, '.SRCINFO'), 'w') as fh:
+                fh.write(srcinfo.format('foo.patch'))
+            key = pkgbuilder.build.build_key(node, graph, session=session)
+            self.assertEqual(len(key), 64)
+            with open(os.path.join(tmp, 'foo.patch'), 'w') as fh:
+                fh.write('changed')
+            self.assertNotEqual(
+                pkgbuilder.build.build_key(node, graph, session=session),
+                key)
+            with open(os.path.join(tmp, '.SRCINFO'), 'w') as fh:
+                fh.write(srcinfo.format('git+https://example.com/foo.git'))
+            self.assertIsNone(
+                pkgbuilder.build.build_key(node, graph, session=session))
+
+    def test_pbds_session(self):
+        stream = io.StringIO()
+        session = pkgbuilder.pbds.Session(stream=stream, confirm=False,
+                                          share=pkgbuilder.DS)
+        session.colorsoff()
+        session.fancy_msg('hello')
+        self.assertEqual(stream.getvalue(), '==> hello\n')
+        self.assertIs(session.dbindex, pkgbuilder.DS.dbindex)
+        self.assertIs(session.srcinfo_cache, pkgbuilder.DS.srcinfo_cache)
+        # every session has its own pyalpm handle
+        self.assertIsNone(session._pyc)
+        # the default session has a single AUR client
+        self.assertIs(pkgbuilder.utils.RPC, pkgbuilder.DS.aur)
+        self.assertIs(pkgbuilder.utils._rpc(None), pkgbuilder.DS.aur)
+        self.assertIs(pkgbuilder.utils._rpc(session), session.aur)
+        self.assertIn('--noconfirm',
+                      pkgbuilder.build.makepkg_params(session=session))
+        self.assertTrue(pkgbuilder.DS.confirm)
+        self.assertRaises(TypeError, pkgbuilder.pbds.Session, nonsense=1)
+
+    def test_fetch_pool(self):
+        def fail():
+            raise pkgbuilder.exceptions.PBException('boom', 'fetch')
+
+        stream = io.StringIO()
+        session = pkgbuilder.pbds.Session(stream=stream)
+        pool = pkgbuilder.fetch.FetchPool(2, False, session=session)
+        done = pool.run([('a', lambda: None), ('b', fail), ('c', lambda: 1)])
+        self.assertEqual(sorted(done), ['a', 'c'])
+        self.assertEqual(list(pool.errors), ['b'])
+        self.assertIn('boom', stream.getvalue())
+
+        # progress goes to the session stream, too
+        stream.truncate(0)
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            pkgbuilder.fetch.FetchPool(2, session=session).run(
+                [('a', lambda: None)])
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertIn('(1/1) a: done', stream.getvalue())
+
+    def test_transaction_validate(self):
+        session = pkgbuilder.pbds.Session(stream=io.StringIO())
+        sessions = []
+
+        def info(names, session=None):
+            sessions.append(session)
+            return [pkgbuilder.package.AURPackage(name='foo',
+                                                  version='1.0-1')]
+
+        tx = pkgbuilder.transaction.Transaction(['foo'], [], [],
+                                                session=session)
+        with mock.patch('pkgbuilder.utils.info', info), \
+                mock.patch.object(session, 'pycreload',
+                                  session._pycreload):
+            self.assertEqual(tx.validate(quiet=True), 1)
+        self.assertEqual(sessions, [session])
+
+    def test_fetch_prefetcher(self):
+        started = []
+        session = pkgbuilder.pbds.Session(lookahead=1)
+        with pkgbuilder.fetch.Prefetcher(range(5), started.append,
+                                         session=session) as prefetcher:
+            self.assertIsNone(prefetcher.wait(0))
+            self.assertLessEqual(len(started), 2)
+            self.assertIsNone(prefetcher.wait(2))
+            self.assertEqual(sorted(started)[:3], [0, 1, 2])
+            self.assertLessEqual(len(started), 4)
+        self.assertNotIn(4, started)
+
     def test_pbds_logging(self):
         pbds = pkgbuilder.pbds.PBDS()
         pbds.log.debug('PB unittest/TestPB is running now on this machine.')
@@ -116,6 +1153,26 @@ class TestPB(unittest.TestCase):
         # Can’t test too much here…
         pkgbuilder.__main__.main([])
 
+    def test_main_single_plan(self):
+        def auto_build(*args, **kwargs):
+            raise pkgbuilder.exceptions.AURError('boom', exit=fatal)
+
+        with mock.patch.object(pkgbuilder.DS, 'root_crash'), \
+                mock.patch.object(pkgbuilder.DS, 'fancy_error') as error, \
+                mock.patch('pkgbuilder.build.auto_build',
+                           side_effect=auto_build) as ab:
+            fatal = False
+            pkgbuilder.__main__.main(['-w', 'foo', 'bar'], quit=False)
+            error.assert_called_with('AUR Error: boom')
+            # all targets are planned together
+            self.assertEqual([c[0][0] for c in ab.call_args_list],
+                             [['foo', 'bar']])
+
+            fatal = True
+            with self.assertRaises(SystemExit) as cm:
+                pkgbuilder.__main__.main(['-w', 'foo'], quit=False)
+            self.assertEqual(cm.exception.code, 1)
+
     def test_wrapper(self):
         # …or there…
         pkgbuilder.wrapper.wrapper(['unittests', 'UTshibboleet'])